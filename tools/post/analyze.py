@@ -4,7 +4,8 @@
 
     This module contains classes that do various types of analysis over
     the code, including flop count, state and streaming variable access,
-    working set, and memory traffic estimates.
+    register allocation, prefetch streams, SIMD vectorization, working set,
+    TLB footprint, and memory traffic estimates.
 """
 __author__ = "Cy Chan"
 __copyright__ = "Copyright 2016, The Regents of the University of California, through Lawrence Berkeley National Laboratory"
@@ -19,11 +20,16 @@ import sys
 import os
 import re
 import operator
+import itertools
+import threading
 from copy import deepcopy
+from collections import OrderedDict
 
-from parser import XMLParser, KeyValXMLParser, PollyXMLParser, Collection, Flops, Scalar, Array, ArrayAccess, Conditional
-from box import Box
+from parser import XMLParser, KeyValXMLParser, PollyXMLParser, Collection, Flops, Scalar, Array, ArrayAccess, Conditional, \
+                   Body, parseExpr, doSymRepl
+from box import Box, BoxSet
 from common import options
+import expr
 
 # Helper functions
 
@@ -31,11 +37,201 @@ def get_type_byte_n(word_type, machine):
   return machine[word_type + "_byte_n"]
 
 def get_cache_byte_n(machine):
+  # with a multi-level hierarchy, the last level determines DRAM traffic
+  # (even if cache_kbytes is also given)
+  if 'cache_level_n' in machine:
+    return get_cache_levels(machine)[-1][1]
   return machine['cache_kbytes'] * 1024
 
+def get_cache_levels(machine):
+  """Returns [(name, byte_n, gbs)] for the cache levels from L1 outwards.
+
+     Given by cache_level_n and l<i>_kbytes, l<i>_gbs (GB/s/core delivered
+     by level i) in the machine description.  Without cache_level_n, the
+     single cache_kbytes level is returned (its bandwidth is unknown)."""
+  if 'cache_level_n' not in machine:
+    return [('cache', machine['cache_kbytes'] * 1024, None)]
+  return map(lambda i: ('L%d' % i, machine['l%d_kbytes' % i] * 1024, machine['l%d_gbs' % i]),
+             range(1, int(machine['cache_level_n']) + 1))
+
+def get_level_machine(machine, byte_n):
+  """Copy of the machine description with a single cache of byte_n bytes
+     (any cache hierarchy is dropped)."""
+  result = dict(machine)
+  result['cache_kbytes'] = float(byte_n) / 1024
+  result.pop('cache_level_n', None)
+  return result
+
+def get_transfer_time(byte_n, gbs):
+  """Seconds to move byte_n bytes at gbs GB/s (10**9 bytes/s, like the
+     10**9 flops/s of core_gflops; every *_gbs machine key is in GB/s)."""
+  return byte_n / float(gbs * 10**9)
+
+def get_bandwidth_time(byte_n, gbs, machine):
+  """Seconds to move byte_n bytes at gbs GB/s per core over all cores."""
+  return get_transfer_time(byte_n, gbs * machine['core_n'])
+
+def get_compute_time(wflops, machine):
+  """Seconds to execute wflops weighted flops at core_gflops per core over all cores."""
+  return wflops / float(machine['core_gflops'] * machine['core_n'] * 10**9)
+
+def toFloat(x):
+  """Numeric value of x, or None if x is symbolic."""
+  try:
+    return float(x)
+  except (TypeError, RuntimeError):
+    return None
+
+def get_comm_time(byte_n, message_n, machine):
+  """Seconds to send message_n messages of byte_n bytes in total over the NIC."""
+  return get_transfer_time(byte_n, machine['nic_bw_gbs']) + message_n * machine['nic_lat_us'] * 1e-6
+
+# per-box problem size of a box decomposition (as in the old model)
+box_params = ['__BoxX__', '__BoxY__', '__BoxZ__']
+
+def get_box_n(params):
+  """Points per dimension of the box owned by each node, or None if the
+     parameters do not describe a box decomposition."""
+  # parameter names are parsed into symbols
+  values = dict(map(lambda (k, v): (str(k), v), params.items())) if params else {}
+  if box_params[0] not in values:
+    return None
+  return tuple(map(lambda x: int(values[x]), filter(lambda x: x in values, box_params)))
+
+def get_ws_weight(conds_sat, machine):
+  """Weight of an array accessed with probability conds_sat in the working
+     set that decides reuse, or 0.0 if it is left out.
+
+     By default any array that may be accessed counts in full (worst case).
+     Arrays accessed with a probability below ws_cond_p are left out, and
+     with ws_cond_expected set the others are weighted by their probability
+     (expected working set).  Sampled probabilities are averaged."""
+  if not isTaken(conds_sat):
+    return 0.0
+  p = float(conds_sat.mean() if hasattr(conds_sat, 'mean') else conds_sat)
+  if p < machine.get('ws_cond_p', 0.0):
+    return 0.0
+  return p if machine.get('ws_cond_expected', 0) else 1.0
+
+def get_call_params(call, params):
+  """Parameters of the function called by call (a FuncCall), given those of
+     the caller.  Parameters named by an actual argument (e.g. hi, bound as
+     hi(1), hi(2), ...) are renamed to the formal parameter, and a formal
+     passed an expression of the caller's parameters is bound to its value
+     if that is an integer.  Other parameters keep their values."""
+  result = dict(params)
+  names = dict(map(lambda (k, v): (str(k), v), params.items()))
+  for (formal, actual) in call.args:
+    if not formal or formal == actual:
+      continue
+    if re.match(r'^[A-Za-z_]\w*$', actual):
+      for (name, value) in names.items():
+        if name == actual or name.startswith(actual + '('):
+          result[parseExpr(formal + name[len(actual):], {})] = value
+      continue
+    try:
+      value = parseExpr(actual, {})
+      if type(value) != int:
+        value = doSymRepl(value, params)
+        if int(value) != value:
+          continue # not an extent or a count (e.g. a ratio of the parameters)
+    except (expr.ExprError, TypeError, ValueError):
+      continue # not a function of the parameters (e.g. a pointer or a string)
+    result[parseExpr(formal, {})] = int(value)
+  return result
+
+def get_prefetch_derate(stream_n, machine):
+  """Factor by which the memory time of a loop grows when it walks more
+     concurrent streams than the hardware prefetchers track.
+
+     Given by prefetch_stream_n (streams tracked, no derating if absent) and
+     prefetch_untracked_sf (bandwidth of an untracked stream relative to a
+     prefetched one, default 0) in the machine description."""
+  if 'prefetch_stream_n' not in machine or stream_n <= machine['prefetch_stream_n']:
+    return 1.0
+  tracked_n = machine['prefetch_stream_n']
+  return float(stream_n) / (tracked_n + (stream_n - tracked_n) * machine.get('prefetch_untracked_sf', 0))
+
+def get_page_n(boxes, extents, element_byte_n, page_byte_n, unit_dim, run_limit = 1 << 16):
+  """Distinct pages touched by a list of boxes (inclusive (lo, hi) bounds per
+     dimension) in an array with the given extents, stored with dimension
+     unit_dim (0 for Fortran order, -1 for C order) varying fastest and
+     starting on a page boundary.
+
+     Each box is split into contiguous runs of memory.  Boxes with more than
+     run_limit runs are estimated from their run length and span instead."""
+  dim_n = len(extents)
+  order = range(dim_n) if unit_dim == 0 else range(dim_n - 1, -1, -1)
+  strides = [0] * dim_n
+  stride = 1
+  for d in order:
+    strides[d] = stride
+    stride *= extents[d][1] - extents[d][0] + 1
+  def addr(point):
+    return sum(map(lambda d: (point[d] - extents[d][0]) * strides[d], range(dim_n)))
+  def pages(lo, hi):
+    return (addr(lo) * element_byte_n // page_byte_n, ((addr(hi) + 1) * element_byte_n - 1) // page_byte_n)
+  intervals = []
+  estimate = 0
+  for box in boxes:
+    box = map(lambda (b, e): (max(b[0], e[0]), min(b[1], e[1])), zip(box, extents))
+    if any(map(lambda (lo, hi): lo > hi, box)):
+      continue
+    # dimensions covered fully are contiguous with the next one
+    m = 0
+    while m < dim_n - 1 and box[order[m]] == extents[order[m]]:
+      m += 1
+    fixed = order[m+1:]
+    run_n = reduce(operator.mul, map(lambda d: box[d][1] - box[d][0] + 1, fixed), 1)
+    (lo, hi) = (map(lambda x: x[0], box), map(lambda x: x[1], box))
+    if run_n > run_limit:
+      (first, last) = pages(lo, hi)
+      run_lo = list(lo)
+      run_hi = map(lambda d: lo[d] if d in fixed else hi[d], range(dim_n))
+      (run_first, run_last) = pages(run_lo, run_hi)
+      estimate += min(run_n * (run_last - run_first + 1), last - first + 1)
+      continue
+    for values in itertools.product(*map(lambda d: xrange(box[d][0], box[d][1] + 1), fixed)):
+      for (d, v) in zip(fixed, values):
+        lo[d] = hi[d] = v
+      intervals.append(pages(lo, hi))
+  # union of the page intervals
+  result = 0
+  end = None
+  for (first, last) in sorted(intervals):
+    if end is not None and first <= end:
+      if last > end:
+        result += last - end
+        end = last
+    else:
+      result += last - first + 1
+      end = last
+  return result + estimate
+
 def get_scale_factor(tag, machine):
   return machine[tag + '_sf']
 
+def get_reg_type(word_type):
+  """'fp' for floating point values, 'int' for everything else (including pointers)."""
+  if re.search(r'\b(double|float)\b', word_type) and '*' not in word_type and '&' not in word_type:
+    return 'fp'
+  return 'int'
+
+def split_regs(state, stream, reg_n):
+  """Splits reg_n registers between state and stream variables, given their
+     access counts sorted in descending order.  Registers go to whichever
+     variable has the most accesses (as in regAllocModel of the old runner).
+
+     Returns (state_reg_n, stream_reg_n)."""
+  (state_n, stream_n) = (0, 0)
+  while state_n + stream_n < reg_n and state_n + stream_n < len(state) + len(stream):
+    if state_n >= len(state) or \
+       (stream_n < len(stream) and stream[stream_n] > state[state_n]):
+      stream_n += 1
+    else:
+      state_n += 1
+  return (state_n, stream_n)
+
 def get_access_type(accesses):
   (r,w) = (False, False)
   for x in accesses:
@@ -45,19 +241,94 @@ def get_access_type(accesses):
           (False, True): 'st',
           (True, True) : 'ls'}[(r,w)]
 
-def accessSize(accs):
-  """Returns the number of points in a list of (possibly overlapping) accesses using Box library."""
+def get_line_model(element_byte_n, machine):
+  """Returns (line_words, unit_dim, aligned) if sizes are counted in whole
+     cache lines (machine key line_model=1), otherwise None.
+
+     unit_dim is the index of the unit-stride array dimension (0 for Fortran
+     order, -1 for C order), aligned is whether arrays start on a line boundary."""
+  if not machine or not machine.get('line_model', 0):
+    return None
+  line_words = max(1, int(machine['line_byte_n'] / element_byte_n))
+  return (line_words, int(machine.get('unit_stride_dim', 0)), machine.get('line_aligned', 1) != 0)
+
+def accessSize(accs, line_model = None):
+  """Returns the number of points in a list of (possibly overlapping) accesses using Box library.
+
+     With a line_model (see get_line_model), the points are rounded out to
+     whole cache lines along the unit-stride dimension.  If arrays are not
+     aligned, the size is averaged over all offsets of the array within a line."""
   def makeBox(acc):
     # add 1 since upper bound is inclusive
     return Box(intervals = map(lambda x: (x,x+1) if type(x)==int else (x[0], x[1]+1), acc.index))
   # take the union across boxes to eliminate overlaps
-  return reduce(lambda x,y: x.union(y), map(makeBox, accs)).size()
+  union = reduce(lambda x,y: x.union(y), map(makeBox, accs))
+  if not line_model or line_model[0] == 1:
+    return union.size()
+
+  (line_words, unit_dim, aligned) = line_model
+  boxes = union.contents if isinstance(union, BoxSet) else [union]
+  boxes = filter(lambda x: not x.isEmpty(), boxes)
+  if not boxes or boxes[0].dim == 0:
+    return union.size()
+  try:
+    boxes = map(lambda b: Box(intervals = map(lambda (lo, hi): (float(lo), float(hi)), b.intervals)), boxes)
+  except (TypeError, RuntimeError):
+    return union.size() # symbolic bounds, cannot round to lines
+  steps = [1] * boxes[0].dim
+  steps[unit_dim] = line_words
+  def lineSize(offset):
+    shift = [0] * boxes[0].dim
+    shift[unit_dim] = offset
+    covered = map(lambda b: b.translate(shift).cover(steps), boxes)
+    return reduce(lambda x,y: x.union(y), covered).size()
+  offsets = [0] if aligned else range(line_words)
+  return float(sum(map(lineSize, offsets))) / len(offsets)
+
+def detectUnitStrideDim(functions):
+  """Guesses the storage order of the program's arrays from its innermost
+     loops: 0 if the innermost loop variable mostly indexes the first array
+     dimension (Fortran order), -1 if it mostly indexes the last (C order)."""
+  votes = {0: 0, -1: 0}
+  def visit(loop):
+    map(visit, loop.body.loops)
+    if loop.body.loops:
+      return
+    for block in loop.body.codeblocks:
+      for array in block.arrays:
+        for acc in array.accesses:
+          if len(acc.loopvars) > 1 and loop.loopvar in acc.loopvars:
+            i = acc.loopvars.index(loop.loopvar)
+            if i in [0, len(acc.loopvars) - 1]:
+              votes[0 if i == 0 else -1] += 1
+  for function in functions:
+    map(visit, function.body.loops)
+  return -1 if votes[-1] > votes[0] else 0
 
 def reportReuse(linenum, ws, cache):
   rel = '<=' if ws <= cache else '> '
   print "Reuse report: loop %4d WS: %8.4g %s %.4g KiB (%8d %s %8d bytes)" % \
         (linenum, float(ws) / 2**10, rel, float(cache) / 2**10, ws, rel, cache)
 
+def frozenDict(d):
+  """Hashable form of a parameter or machine dict, for use in memoization keys."""
+  return frozenset(d.items()) if d else None
+
+def totalBytes(coll):
+  """Sums bytes() over a Collection, or returns None if the sizes cannot be
+     computed (e.g. overlapping symbolic boxes when parameters are not substituted)."""
+  try:
+    return sum(map(lambda x: x.bytes(), coll))
+  except (TypeError, IndexError):
+    return None
+
+def isTaken(conds_sat):
+  """True if a block may execute, i.e. Pr[conds] > 0.0.  conds_sat may also be
+     a vector of sampled probabilities (see uncertainty.py), in which case the
+     block is included if it executes in any sample."""
+  taken = conds_sat > 0.0
+  return taken.any() if hasattr(taken, 'any') else taken
+
 # helper class for checking conditionals
 class TableCondsChecker(object):
   __slots__ = ['table']
@@ -65,6 +336,9 @@ class TableCondsChecker(object):
     if options.flag_ignore_conds:
       print "WARNING: flag_ignore_conds is True, including all conditionally executed blocks!"
     self.table = dict(conds_table)
+  def key(self):
+    # hashable summary of the table, used to memoize analysis results
+    return (options.flag_ignore_conds, frozenset(self.table.items()))
   def check_cond(self, cond):
     if cond.condition not in self.table:
       print cond.condition
@@ -116,13 +390,21 @@ class FlopCount(object):
     result.specials *= n
     return result
 
+  @staticmethod
+  def total(coll):
+    """Sums a Collection of FlopCounts (zero if the collection is empty)."""
+    result = FlopCount(Flops())
+    for x in coll:
+      result += x
+    return result
+
   @staticmethod
   def collector(conds_chk):
     # capture condition checker
     def f(arg, conds):
       assert type(arg) == Flops or type(arg) == Scalar or type(arg) == Array
       conds_sat = conds_chk(conds)
-      if type(arg) == Flops and conds_sat > 0.0:
+      if type(arg) == Flops and isTaken(conds_sat):
         return Collection([FlopCount(arg) * conds_sat])
       return Collection()
     return f
@@ -170,9 +452,9 @@ class StateVar(object):
     def f(arg, conds):
       assert type(arg) == Flops or type(arg) == Scalar or type(arg) == Array
       conds_sat = conds_chk(conds)
-      if type(arg) == Scalar and conds_sat > 0.0:
+      if type(arg) == Scalar and isTaken(conds_sat):
         return Collection([StateVar(sv=arg) * conds_sat])
-      elif type(arg) == Array and conds_sat > 0.0:
+      elif type(arg) == Array and isTaken(conds_sat):
         return Collection([StateVar(array=arg) * conds_sat] + \
                           map(lambda ac: StateVar(array=arg, access=ac) * conds_sat,
                               filter(ArrayAccess.isStateVar, arg.accesses)))
@@ -217,20 +499,394 @@ class ArrayVar(object):
     def f(arg, conds):
       assert type(arg) == Flops or type(arg) == Scalar or type(arg) == Array
       conds_sat = conds_chk(conds)
-      if type(arg) == Array and not arg.onlyStateVars() and conds_sat > 0.0:
+      if type(arg) == Array and not arg.onlyStateVars() and isTaken(conds_sat):
         return Collection([ArrayVar(arg) * conds_sat])
       return Collection()
     return f
 
 
+class RegisterUse(object):
+  """Register allocation of a variable in its innermost enclosing loop.
+
+     As in regAllocModel of the old runner, the FP (core_fp_reg_n) and integer
+     (core_int_reg_n) registers are split between state variables (scalars,
+     array pointers and loop-invariant array elements, see StateVar) and
+     stream variables (array elements that change every iteration, see
+     ArrayVar), favoring the most accessed ones.  Every access to a variable
+     without a register (a spill) is an L1 load or store.  Stream variables
+     held in a register are still loaded and/or stored once per iteration.
+
+     Registers are ranked by the static access counts, the L1 counts are
+     weighted by the branch probabilities."""
+  slots = ['name', 'var', 'type', 'kind', 'reads', 'writes', 'static_reads', 'static_writes',
+           'reg_n', 'linenum', 'in_reg', 'l1_loads', 'l1_stores']
+  def __init__(self, var = None, kind = None, conds_sat = 1.0, machine = None, copy = None):
+    if copy:
+      self.name = copy.name
+      self.var = copy.var
+      self.type = copy.type
+      self.kind = copy.kind
+      self.reads = copy.reads
+      self.writes = copy.writes
+      self.static_reads = copy.static_reads
+      self.static_writes = copy.static_writes
+      self.reg_n = copy.reg_n
+      self.linenum = copy.linenum
+      self.in_reg = copy.in_reg
+      self.l1_loads = copy.l1_loads
+      self.l1_stores = copy.l1_stores
+    else:
+      # from a StateVar (kind 'state') or ArrayVar-like access (kind 'stream')
+      self.name = var.name
+      self.var = var.name
+      self.type = var.type
+      self.kind = kind
+      self.reads = var.reads * conds_sat
+      self.writes = var.writes * conds_sat
+      self.static_reads = var.reads
+      self.static_writes = var.writes
+      self.reg_n = {'fp': int(machine['core_fp_reg_n']), 'int': int(machine['core_int_reg_n'])}
+      # not allocated until the innermost loop is reached
+      (self.linenum, self.in_reg, self.l1_loads, self.l1_stores) = (None, None, 0, 0)
+  def regType(self):
+    return get_reg_type(self.type)
+  def staticCount(self):
+    return self.static_reads + self.static_writes
+  def spilled(self):
+    return self.in_reg is False
+  def loop(self, loop, siblings):
+    result = RegisterUse(copy=self)
+    if self.linenum is None:
+      # innermost loop containing the variable, allocate registers per iteration
+      if not hasattr(siblings, 'reg_alloc'):
+        siblings.reg_alloc = RegisterUse.allocate(siblings)
+      result.linenum = loop.linenum
+      result.name = "%d %s" % (loop.linenum, self.var)
+      result.in_reg = siblings.reg_alloc[self.var]
+      if not result.in_reg:
+        (result.l1_loads, result.l1_stores) = (self.reads, self.writes)
+      elif self.kind == 'stream':
+        # weighted by the probability that the access is made in an iteration
+        result.l1_loads = self.reads / float(self.static_reads) if self.static_reads else 0
+        result.l1_stores = self.writes / float(self.static_writes) if self.static_writes else 0
+    n = loop.iter_n()
+    result.reads *= n
+    result.writes *= n
+    result.l1_loads *= n
+    result.l1_stores *= n
+    return result
+  def __str__(self):
+    return "RA %s %s %s, reg=%s, R=%s, W=%s, L1 L=%s, S=%s" % \
+           (self.kind, self.type, self.var, 'yes' if self.in_reg else 'spill',
+            self.reads, self.writes, self.l1_loads, self.l1_stores)
+  def __iadd__(self, other):
+    assert other.name == self.name and other.kind == self.kind
+    self.reads += other.reads
+    self.writes += other.writes
+    self.static_reads += other.static_reads
+    self.static_writes += other.static_writes
+    self.l1_loads += other.l1_loads
+    self.l1_stores += other.l1_stores
+    return self
+
+  @staticmethod
+  def allocate(siblings):
+    """Returns {var: in_reg} for the variables of an innermost loop body."""
+    pending = filter(lambda x: x.linenum is None, siblings)
+    result = {}
+    for reg_type in ['fp', 'int']:
+      ranked = {}
+      for kind in ['state', 'stream']:
+        ranked[kind] = sorted(filter(lambda x: x.kind == kind and x.regType() == reg_type, pending),
+                              key=lambda x: (-x.staticCount(), x.var))
+      reg_n = pending[0].reg_n[reg_type] if pending else 0
+      (state_n, stream_n) = split_regs(map(RegisterUse.staticCount, ranked['state']),
+                                       map(RegisterUse.staticCount, ranked['stream']), reg_n)
+      for (kind, n) in [('state', state_n), ('stream', stream_n)]:
+        for (i, x) in enumerate(ranked[kind]):
+          result[x.var] = i < n
+    return result
+
+  @staticmethod
+  def perLoop(coll):
+    """Summarizes a Collection of RegisterUses by innermost loop.
+
+       Returns a list of dicts with keys linenum, <fp|int>_var_n,
+       <fp|int>_spill_n, l1_loads and l1_stores, sorted by line number."""
+    loops = {}
+    for x in coll:
+      if x.linenum not in loops:
+        loops[x.linenum] = {'linenum': x.linenum, 'fp_var_n': 0, 'fp_spill_n': 0,
+                            'int_var_n': 0, 'int_spill_n': 0, 'l1_loads': 0, 'l1_stores': 0}
+      d = loops[x.linenum]
+      d[x.regType() + '_var_n'] += 1
+      d[x.regType() + '_spill_n'] += 1 if x.spilled() else 0
+      d['l1_loads'] += x.l1_loads
+      d['l1_stores'] += x.l1_stores
+    return map(lambda k: loops[k], sorted(loops.keys()))
+
+  @staticmethod
+  def collector(conds_chk, machine):
+    def f(arg, conds):
+      assert type(arg) == Flops or type(arg) == Scalar or type(arg) == Array
+      conds_sat = conds_chk(conds)
+      if type(arg) == Scalar and isTaken(conds_sat):
+        return Collection([RegisterUse(StateVar(sv=arg), 'state', conds_sat, machine)])
+      elif type(arg) == Array and isTaken(conds_sat):
+        return Collection([RegisterUse(StateVar(array=arg), 'state', conds_sat, machine)] + \
+                          map(lambda ac: RegisterUse(StateVar(array=arg, access=ac),
+                                                     'state' if ac.isStateVar() else 'stream',
+                                                     conds_sat, machine), arg.accesses))
+      return Collection()
+    return f
+
+
+class PrefetchStream(object):
+  """A stream walked by the innermost loop enclosing an array access.
+
+     Accesses to the same array that only differ in the dimension indexed
+     by the innermost loop variable (e.g. a(i-1,j) and a(i+1,j) in a loop
+     over i) walk the same stream, so a loop walks one stream per array and
+     distinct offset in the other dimensions.  Accesses that do not depend
+     on the innermost loop variable are not streamed."""
+  slots = ['name', 'array', 'index', 'loopvars', 'linenum', 'stream']
+  def __init__(self, array = None, access = None, copy = None):
+    if copy:
+      self.name = copy.name
+      self.array = copy.array
+      self.index = copy.index
+      self.loopvars = copy.loopvars
+      self.linenum = copy.linenum
+      self.stream = copy.stream
+    else:
+      self.name = "%s %s" % (array.name, str(access))
+      self.array = array.name
+      self.index = access.index
+      self.loopvars = access.loopvars
+      # not known until the innermost loop is reached
+      (self.linenum, self.stream) = (None, None)
+  def loop(self, loop, siblings):
+    result = PrefetchStream(copy=self)
+    if self.linenum is None:
+      result.linenum = loop.linenum
+      result.stream = loop.loopvar in self.loopvars
+      if result.stream:
+        # drop the offset along the streamed dimension
+        i = self.loopvars.index(loop.loopvar)
+        (result.index, result.loopvars) = (self.index[:i] + self.index[i+1:],
+                                           self.loopvars[:i] + self.loopvars[i+1:])
+      result.name = "%d %s %s+%s" % (loop.linenum, self.array, map(str, result.index), result.loopvars)
+    return result
+  def __str__(self):
+    return "PS %s %s+%s, stream=%s" % (self.array, map(str, self.index), self.loopvars, self.stream)
+  def __iadd__(self, other):
+    assert other.name == self.name
+    return self
+
+  @staticmethod
+  def perLoop(coll):
+    """Summarizes a Collection of PrefetchStreams by innermost loop.
+
+       Returns a list of dicts with keys linenum, stream_n and array_n,
+       sorted by line number."""
+    loops = {}
+    for x in coll:
+      if x.linenum not in loops:
+        loops[x.linenum] = {'linenum': x.linenum, 'stream_n': 0, 'arrays': set()}
+      if x.stream:
+        loops[x.linenum]['stream_n'] += 1
+        loops[x.linenum]['arrays'].add(x.array)
+    return map(lambda k: {'linenum': k, 'stream_n': loops[k]['stream_n'], 'array_n': len(loops[k]['arrays'])},
+               sorted(loops.keys()))
+
+  @staticmethod
+  def maxStreams(coll):
+    """Most streams walked by any innermost loop of a Collection."""
+    return max([0] + map(lambda x: x['stream_n'], PrefetchStream.perLoop(coll)))
+
+  @staticmethod
+  def collector(conds_chk):
+    def f(arg, conds):
+      assert type(arg) == Flops or type(arg) == Scalar or type(arg) == Array
+      if type(arg) == Array and not arg.onlyStateVars() and isTaken(conds_chk(conds)):
+        return Collection(map(lambda ac: PrefetchStream(arg, ac),
+                              filter(lambda ac: not ac.isStateVar(), arg.accesses)))
+      return Collection()
+    return f
+
+
+def get_simd_kind(acc, loopvar, stride, unit_dim):
+  """How an access is vectorized along a loop: 'invariant' if it does not
+     depend on the loop variable, 'unit' if the loop walks its unit-stride
+     dimension with stride 1, and 'gather' otherwise."""
+  dims = filter(lambda d: acc.loopvars[d] == loopvar, range(len(acc.loopvars)))
+  if not dims:
+    return 'invariant'
+  if dims == [unit_dim % len(acc.loopvars)] and stride == 1:
+    return 'unit'
+  return 'gather'
+
+class SimdUse(object):
+  """Vectorization of an access (or of the flops of a code block) by its
+     innermost enclosing loop.
+
+     Accesses are classified by get_simd_kind.  A loop does not vectorize
+     if it encloses other loops, or if an array it writes is also accessed
+     at a different offset along the loop variable (a loop-carried
+     dependence).  Writes to a loop-invariant element are treated as
+     reductions, which vectorize.  Gathered elements are loaded one by one,
+     so the effective vector width of simd_width lanes drops with the
+     fraction g of gathered accesses to simd_width / (1 + g (simd_width - 1))."""
+  slots = ['name', 'array', 'index', 'loopvars', 'reads', 'writes', 'wflops', 'unit_dim',
+           'linenum', 'kind', 'nested']
+  def __init__(self, array = None, access = None, flops = None, conds_sat = 1.0, machine = None,
+               unit_dim = 0, copy = None):
+    if copy:
+      self.name = copy.name
+      self.array = copy.array
+      self.index = copy.index
+      self.loopvars = copy.loopvars
+      self.reads = copy.reads
+      self.writes = copy.writes
+      self.wflops = copy.wflops
+      self.unit_dim = copy.unit_dim
+      self.linenum = copy.linenum
+      self.kind = copy.kind
+      self.nested = copy.nested
+    elif flops:
+      self.name = 'flops'
+      (self.array, self.index, self.loopvars, self.reads, self.writes) = (None, None, None, 0, 0)
+      self.wflops = (flops.adds + flops.multiplies +
+                     get_scale_factor('div', machine) * flops.divides +
+                     get_scale_factor('spc', machine) * flops.specials) * conds_sat
+      self.unit_dim = unit_dim
+      (self.linenum, self.kind, self.nested) = (None, 'flops', None)
+    else:
+      self.name = "%s %s" % (array.name, str(access))
+      self.array = array.name
+      self.index = access.index
+      self.loopvars = access.loopvars
+      self.reads = access.reads * conds_sat
+      self.writes = access.writes * conds_sat
+      self.wflops = 0
+      self.unit_dim = unit_dim # 0 for Fortran order, -1 for C order
+      # not known until the innermost loop is reached
+      (self.linenum, self.kind, self.nested) = (None, None, None)
+  def loop(self, loop, siblings):
+    result = SimdUse(copy=self)
+    if self.linenum is None:
+      result.linenum = loop.linenum
+      result.nested = bool(loop.body.loops)
+      if self.array:
+        result.kind = get_simd_kind(self, loop.loopvar, loop.stride, self.unit_dim)
+        # the offset along the loop variable, if any, is needed to find dependences
+        result.loopvars = tuple(map(lambda x: '*' if x == loop.loopvar else x, self.loopvars))
+      result.name = "%d %s" % (loop.linenum, self.name)
+    n = loop.iter_n()
+    result.reads *= n
+    result.writes *= n
+    result.wflops *= n
+    return result
+  def __str__(self):
+    return "VEC %s %s, R=%s, W=%s, WF=%s" % (self.kind, self.name, self.reads, self.writes, self.wflops)
+  def __iadd__(self, other):
+    assert other.name == self.name
+    self.reads += other.reads
+    self.writes += other.writes
+    self.wflops += other.wflops
+    return self
+
+  @staticmethod
+  def carriedDependence(accesses):
+    """True if a written array is accessed at two different offsets along
+       the loop variable (marked '*' in loopvars) of its innermost loop."""
+    arrays = {}
+    for x in accesses:
+      arrays.setdefault(x.array, []).append(x)
+    for xs in arrays.values():
+      if not any(map(lambda x: x.writes > 0, xs)) or len(xs) < 2:
+        continue
+      for (a, b) in itertools.combinations(xs, 2):
+        if a.loopvars != b.loopvars or not (a.writes > 0 or b.writes > 0):
+          continue
+        dims = range(len(a.index))
+        along = filter(lambda d: a.loopvars[d] == '*', dims)
+        others = filter(lambda d: a.loopvars[d] != '*', dims)
+        if along and all(map(lambda d: a.index[d] == b.index[d], others)) and \
+           any(map(lambda d: a.index[d] != b.index[d], along)):
+          return True
+    return False
+
+  @staticmethod
+  def perLoop(coll, machine):
+    """Summarizes a Collection of SimdUses by innermost loop.
+
+       Returns a list of dicts with keys linenum, wflops, unit, gather and
+       invariant (access counts), vectorizable, reason (why not) and width
+       (effective vector width), sorted by line number."""
+    loops = {}
+    for x in coll:
+      loops.setdefault(x.linenum, []).append(x)
+    simd_width = machine.get('simd_width', 1)
+    result = []
+    for linenum in sorted(loops.keys()):
+      xs = loops[linenum]
+      if any(map(lambda x: x.nested, xs)) and not any(map(lambda x: x.wflops, xs)):
+        continue # only sets up the inner loops
+      d = {'linenum': linenum, 'wflops': sum(map(lambda x: x.wflops, xs))}
+      for kind in ['unit', 'gather', 'invariant']:
+        d[kind] = sum(map(lambda x: x.reads + x.writes, filter(lambda x: x.kind == kind, xs)))
+      accesses = filter(lambda x: x.array, xs)
+      if any(map(lambda x: x.nested, xs)):
+        (d['vectorizable'], d['reason']) = (False, 'encloses loops')
+      elif SimdUse.carriedDependence(accesses):
+        (d['vectorizable'], d['reason']) = (False, 'loop-carried dependence')
+      else:
+        (d['vectorizable'], d['reason']) = (True, None)
+      access_n = d['unit'] + d['gather'] + d['invariant']
+      gather = float(d['gather']) / access_n if access_n else 0.0
+      d['width'] = simd_width / (1 + gather * (simd_width - 1)) if d['vectorizable'] else 1.0
+      result.append(d)
+    return result
+
+  @staticmethod
+  def speedup(coll, machine):
+    """Compute speedup of the flops in a Collection from vectorization."""
+    loops = SimdUse.perLoop(coll, machine)
+    (wflops, vtime) = (sum(map(lambda x: x['wflops'], loops)),
+                       sum(map(lambda x: x['wflops'] / x['width'], loops)))
+    return float(wflops) / vtime if vtime else 1.0
+
+  @staticmethod
+  def collector(conds_chk, machine, unit_dim):
+    def f(arg, conds):
+      assert type(arg) == Flops or type(arg) == Scalar or type(arg) == Array
+      conds_sat = conds_chk(conds)
+      # only the mix of accesses matters, so sampled probabilities are averaged
+      if hasattr(conds_sat, 'mean'):
+        conds_sat = conds_sat.mean()
+      if type(arg) == Flops and isTaken(conds_sat):
+        return Collection([SimdUse(flops=arg, conds_sat=conds_sat, machine=machine)])
+      elif type(arg) == Array and isTaken(conds_sat):
+        return Collection(map(lambda ac: SimdUse(arg, ac, conds_sat=conds_sat, unit_dim=unit_dim),
+                              arg.accesses))
+      return Collection()
+    return f
+
+
 class WorkingSet(object):
-  """The working set associated with an array in a code region."""
-  slots = ['name', 'type', 'accesses', 'word_byte_n', 'size_']
-  def __init__(self, array = None, params = None, machine = None, shallow_copy = None):
+  """The working set associated with an array in a code region.
+
+     The weight (see get_ws_weight) scales the bytes of an array that is
+     only accessed conditionally."""
+  slots = ['name', 'type', 'accesses', 'word_byte_n', 'line_model', 'weight', 'size_']
+  def __init__(self, array = None, params = None, machine = None, shallow_copy = None, weight = 1.0):
     if shallow_copy:
       self.name = shallow_copy.name
       self.type = shallow_copy.type
       self.word_byte_n = shallow_copy.word_byte_n
+      self.line_model = shallow_copy.line_model
+      self.weight = shallow_copy.weight
       # shallow_copy clears accesses
       self.accesses = []
       self.size_ = None
@@ -241,6 +897,8 @@ class WorkingSet(object):
       if params:
         self.accesses = map(lambda x: x.subParams(params), self.accesses)
       self.word_byte_n = get_type_byte_n(self.type, machine)
+      self.line_model = get_line_model(self.word_byte_n, machine)
+      self.weight = weight
       self.size_ = None
   def __str__(self):
     try:
@@ -253,14 +911,16 @@ class WorkingSet(object):
   def __iadd__(self, other):
     assert other.name == self.name and other.type == self.type
     map(self.consume, other.accesses)
+    # as likely as its most likely access
+    self.weight = max(self.weight, other.weight)
     return self
   def size(self):
     # memoize
     if not self.size_:
-      self.size_ = accessSize(self.accesses)
+      self.size_ = accessSize(self.accesses, self.line_model)
     return self.size_
   def bytes(self):
-    return self.size() * self.word_byte_n
+    return self.size() * self.word_byte_n * self.weight
   def consume(self, acc):
     # access regions can overlap
     self.accesses.append(acc)
@@ -306,10 +966,10 @@ class WorkingSet(object):
   def collector(conds_chk, machine):
     def f(arg, conds):
       assert type(arg) == Flops or type(arg) == Scalar or type(arg) == Array
-      # TODO: do something more sophisticated when Pr[conds] < 1.0
-      # for now, just include it in the working set if Pr[conds] > 0.0
-      if type(arg) == Array and not arg.onlyStateVars() and conds_chk(conds) > 0.0:
-        return Collection([WorkingSet(arg, machine=machine)])
+      if type(arg) == Array and not arg.onlyStateVars():
+        weight = get_ws_weight(conds_chk(conds), machine)
+        if weight:
+          return Collection([WorkingSet(arg, machine=machine, weight=weight)])
       return Collection()
     return f
 
@@ -318,9 +978,15 @@ class TrafficRegion(object):
   """The memory traffic associated with a list of regions and a count for how
      many times those regions are accessed."""
   slots = ['accesses', 'size', 'count']
-  def __init__(self, accesses, count = 1):
+  def __init__(self, accesses = None, count = 1, line_model = None, copy = None):
+    if copy:
+      # regions are scaled in place, so copies must not share them
+      self.accesses = copy.accesses
+      self.size = copy.size
+      self.count = copy.count
+      return
     self.accesses = accesses
-    self.size = accessSize(self.accesses)
+    self.size = accessSize(self.accesses, line_model)
     self.count = count
   def __str__(self):
     s = " TrafficRegion, size=%d, count=%g, acc_type=%s:\n" % \
@@ -344,10 +1010,12 @@ class Traffic(object):
   slots = ['name', 'element_type',
            'regions', 'ws', 'ws_block_n',
            'element_byte_n', 'acc_byte_n', 
-           'params', 'block_params', 'cache_byte_n',
-           'conds_chk']
+           'params', 'block_params', 'cache_byte_n', 'line_model',
+           'access_type', 'indices', 'loopvars', 'reused',
+           'streaming_stores', 'nt_loads',
+           'conds_chk', 'verbose']
   def __init__(self, array=None, params=None, block_params=None, machine=None,
-               conds_chk=None, conds_sat=None, copy=None):
+               conds_chk=None, conds_sat=None, copy=None, verbose=None):
     if copy:
       # make a copy (excluding traffic regions and WorkingSet info)
       self.name = copy.name
@@ -357,7 +1025,15 @@ class Traffic(object):
       self.params = copy.params             # for problem size and others
       self.block_params = copy.block_params # for cache blocking only
       self.cache_byte_n = copy.cache_byte_n # cache size
+      self.line_model = copy.line_model     # cache line granularity, if any
+      self.access_type = copy.access_type   # for the cache policy
+      self.indices = copy.indices
+      self.loopvars = copy.loopvars
+      self.reused = copy.reused
+      self.streaming_stores = copy.streaming_stores
+      self.nt_loads = copy.nt_loads
       self.conds_chk = copy.conds_chk
+      self.verbose = copy.verbose
     else:
       # copy from an Array object
       self.name = array.name
@@ -367,16 +1043,18 @@ class Traffic(object):
       accesses = filter(lambda x: not x.isStateVar(), array.accesses)
       accesses = map(lambda x: x.subParams(params), accesses)
 
+      # sizes of elements and accesses
+      self.element_byte_n = get_type_byte_n(self.element_type, machine)
+      self.line_model = get_line_model(self.element_byte_n, machine)
+
       # traffic regions accessed
       # conds_sat is accumulated percentage of *all* branches taken up code tree
-      self.regions = [TrafficRegion(accesses, conds_sat)]
+      self.regions = [TrafficRegion(accesses, conds_sat, self.line_model)]
 
       # need to track working set to compute data reuse
-      self.ws = WorkingSet(array, params=params, machine=machine)
+      self.ws = WorkingSet(array, params=params, machine=machine, weight=get_ws_weight(conds_sat, machine))
       self.ws_block_n = 1 # single iteration
 
-      # sizes of elements and accesses
-      self.element_byte_n = get_type_byte_n(self.element_type, machine)
       self.acc_byte_n = {}
       for acc_type in ['ld', 'st', 'ls']:
         self.acc_byte_n[acc_type] = get_scale_factor(acc_type, machine) * \
@@ -387,10 +1065,23 @@ class Traffic(object):
       self.block_params = block_params
       self.cache_byte_n = get_cache_byte_n(machine)
       self.conds_chk = conds_chk # may need to re-evaluate branch taken percentage
+      # print the reuse report of each loop (default options.flag_verbose_reuse)
+      self.verbose = verbose if verbose is not None else options.flag_verbose_reuse
+
+      # what is needed to decide whether the array bypasses the cache
+      self.access_type = get_access_type(accesses)
+      self.indices = set(map(lambda x: x.index, accesses))
+      self.loopvars = set(reduce(operator.add, map(lambda x: x.loopvars, accesses), ()))
+      self.reused = False # reused across iterations of an enclosing loop
+      self.streaming_stores = bool(machine.get('streaming_stores', 0))
+      self.nt_loads = bool(machine.get('nt_loads', 0))
 
   def __str__(self):
-    s = "MT %s %s, size=%d, words=%g, bytes=%g\n" % \
+    s = "MT %s %s, size=%d, words=%g, bytes=%g" % \
         (self.element_type, self.name, self.size(), self.words(), self.bytes())
+    if self.policy() != 'cache':
+      s += ", policy=%s" % {'stream': 'streaming stores', 'nt': 'non-temporal loads'}[self.policy()]
+    s += "\n"
     for region in self.regions:
       s += str(region)
     return s
@@ -398,6 +1089,11 @@ class Traffic(object):
     assert other.name == self.name and other.element_type == self.element_type
     self.ws += other.ws # add other's working set to ours
     map(self.consume, other.regions)
+    if other.access_type != self.access_type:
+      self.access_type = 'ls'
+    self.indices = self.indices | other.indices
+    self.loopvars = self.loopvars | other.loopvars
+    self.reused = self.reused or other.reused
     return self
   def __imul__(self, n):
     for region in self.regions:
@@ -415,7 +1111,24 @@ class Traffic(object):
   def words(self):
     return sum(map(lambda x: x.words(), self.regions))
   def bytes(self):
-    return sum(map(lambda x: x.bytes(self.acc_byte_n), self.regions))
+    acc_byte_n = self.acc_byte_n
+    if self.policy() == 'stream':
+      # no write-allocate: lines are written without being read first
+      acc_byte_n = dict(acc_byte_n, st=self.element_byte_n)
+    return sum(map(lambda x: x.bytes(acc_byte_n), self.regions))
+  def reusedIn(self, loop):
+    """True if the array is reused across iterations of the loop (it does not
+       depend on the loop variable)."""
+    return self.reused or loop.loopvar not in self.loopvars
+  def policy(self):
+    """Cache policy applied to the array: 'stream' if it is write-only and
+       the machine has streaming stores, 'nt' if it is read-only without
+       reuse and the machine has non-temporal loads, otherwise 'cache'."""
+    if self.streaming_stores and self.access_type == 'st':
+      return 'stream'
+    if self.nt_loads and self.access_type == 'ld' and not self.reused and len(self.indices) == 1:
+      return 'nt'
+    return 'cache'
   def loop(self, origLoop, siblings):
     """If enough cache for reuse within a block, traffic equals the blocked working set times the number of blocks.
 
@@ -423,7 +1136,9 @@ class Traffic(object):
 
     # total working set for all arrays touched in the loop (across all siblings) for one iteration
     # siblings are all different arrays, so assume no aliasing (overlap) between them
-    loop_ws_byte_n = sum(map(lambda x: x.ws.bytes(), siblings))
+    # arrays that bypass the cache (streaming stores, non-temporal loads) do not count
+    loop_ws_byte_n = sum(map(lambda x: x.ws.bytes(),
+                             filter(lambda x: x.policy() == 'cache' or x.reusedIn(origLoop), siblings)))
 
      # only need to substitute params for the loop bounds
     loop = origLoop.subParams(self.params, shallow=True)
@@ -438,11 +1153,12 @@ class Traffic(object):
                 (blockLoop.range[1] - blockLoop.range[0]+1)
 
     result = Traffic(copy = self)
+    result.reused = self.reusedIn(origLoop)
     result.ws = self.ws.loop(blockLoop) # working set of the blocked loop
     result.ws_block_n = self.ws_block_n * numBlocks # number of blocks total
 
     # only report if we are the first of siblings (prevent printing duplicate reports)
-    if self == siblings.iterfirst():
+    if self.verbose and self == siblings.iterfirst():
       reportReuse(loop.linenum, loop_ws_byte_n, self.cache_byte_n)
 #     for s in sorted(siblings, key=lambda x: x.name):
 #       print s.ws
@@ -450,42 +1166,770 @@ class Traffic(object):
       # WS of all siblings fit in cache
       # traffic equals blocked working set times number of total blocks
       # assumes no reuse between blocks (i.e. problem blocked correctly for cache)
-      result.regions = [TrafficRegion(result.ws.accesses, count=result.ws_block_n)]
+      result.regions = [TrafficRegion(result.ws.accesses, count=result.ws_block_n,
+                                      line_model=self.line_model)]
       # re-evaluate percentage branches taken up to this loop
       result *= self.conds_chk(origLoop.conds)
     else:
       # no reuse across iterations, multiply traffic by iteration count
-      result.regions = self.regions
+      result.regions = map(lambda x: TrafficRegion(copy=x), self.regions)
       result *= loop.iter_n()
     return result
 
   @staticmethod
-  def collector(conds_chk, params, block_params, machine):
+  def collector(conds_chk, params, block_params, machine, verbose=None):
     # capture problem size, blocking params, and machine model
     def f(arg, conds):
       assert type(arg) == Flops or type(arg) == Scalar or type(arg) == Array
       conds_sat = conds_chk(conds)
-      if type(arg) == Array and not arg.onlyStateVars() and conds_sat > 0.0:
-        return Collection([Traffic(arg, params, block_params, machine, conds_chk, conds_sat)])
+      if type(arg) == Array and not arg.onlyStateVars() and isTaken(conds_sat):
+        return Collection([Traffic(arg, params, block_params, machine, conds_chk, conds_sat, verbose=verbose)])
       return Collection()
     return f
 
+class GhostDepth(object):
+  """Ghost cell depth an array needs in a code region.
+
+     The depth along each loop-indexed (spatial) dimension is the largest
+     stencil offset read in that dimension.  Dimensions with a constant index
+     select components, which are exchanged separately, as do loop-indexed
+     dimensions beyond those of the box (e.g. a loop over species).  The
+     stencil is 'full' (edges and corners are needed) if some read is offset
+     in more than one dimension, otherwise only the 'faces' are."""
+  slots = ['name', 'type', 'depth', 'spatial', 'loopvars', 'extents', 'components', 'shapes',
+           'read', 'written']
+  def __init__(self, array = None, copy = None):
+    if copy:
+      self.name = copy.name
+      self.type = copy.type
+      self.depth = copy.depth
+      self.spatial = copy.spatial
+      self.loopvars = copy.loopvars
+      self.extents = dict(copy.extents)
+      self.components = copy.components
+      self.shapes = copy.shapes
+      self.read = copy.read
+      self.written = copy.written
+      return
+    self.name = array.name
+    self.type = array.type
+    dim_n = len(array.accesses[0].index)
+    self.depth = [0] * dim_n
+    self.spatial = [False] * dim_n
+    self.loopvars = map(lambda i: frozenset(map(lambda x: x.loopvars[i], array.accesses)) - set(['']),
+                        range(dim_n))
+    self.extents = {} # iteration count of the loop indexing each spatial dimension
+    self.components = set()
+    self.shapes = set() # dimensions offset together by a read
+    self.read = any(map(lambda x: x.reads > 0, array.accesses))
+    self.written = any(map(lambda x: x.writes > 0, array.accesses))
+    for acc in filter(lambda x: not x.isStateVar(), array.accesses):
+      offsets = [0] * dim_n
+      for (i, (x, loopvar)) in enumerate(zip(acc.index, acc.loopvars)):
+        if not loopvar:
+          continue
+        self.spatial[i] = True
+        offset = toFloat(x)
+        if offset is not None and acc.reads > 0:
+          offsets[i] = abs(int(offset))
+      self.depth = map(max, self.depth, offsets)
+      self.shapes.add(frozenset(filter(lambda i: offsets[i], range(dim_n))))
+      self.components.add(tuple(map(lambda (x, loopvar): None if loopvar else x, zip(acc.index, acc.loopvars))))
+    (self.depth, self.spatial) = (tuple(self.depth), tuple(self.spatial))
+  def loop(self, loop, siblings):
+    result = GhostDepth(copy=self)
+    for i in self.spatialDims():
+      if loop.loopvar in self.loopvars[i] and i not in result.extents:
+        result.extents[i] = loop.iter_n()
+    return result
+  def __str__(self):
+    return "GD %s %s, depth=%s, components=%d, stencil=%s" % \
+           (self.type, self.name, self.spatialDepth(), len(self.components), self.stencil())
+  def __iadd__(self, other):
+    assert other.name == self.name and len(other.depth) == len(self.depth)
+    self.depth = tuple(map(max, self.depth, other.depth))
+    self.spatial = tuple(map(operator.or_, self.spatial, other.spatial))
+    self.loopvars = map(operator.or_, self.loopvars, other.loopvars)
+    self.extents = dict(other.extents.items() + self.extents.items())
+    self.components = self.components | other.components
+    self.shapes = self.shapes | other.shapes
+    self.read = self.read or other.read
+    self.written = self.written or other.written
+    return self
+  def spatialDims(self, dim_n = None):
+    """Array dimensions indexed by loop variables (the first dim_n of them)."""
+    return filter(lambda i: self.spatial[i], range(len(self.spatial)))[:dim_n]
+  def spatialDepth(self, dim_n = None):
+    return tuple(map(lambda i: self.depth[i], self.spatialDims(dim_n)))
+  def componentCount(self, dim_n):
+    """Copies of the box due to loop-indexed dimensions beyond the first dim_n."""
+    extents = map(lambda i: toFloat(self.extents.get(i, 1)), self.spatialDims()[dim_n:])
+    return int(reduce(operator.mul, map(lambda x: x if x is not None else 1, extents), 1))
+  def stencil(self, dim_n = None):
+    dims = set(self.spatialDims(dim_n))
+    return 'full' if any(map(lambda x: len(x & dims) > 1, self.shapes)) else 'faces'
+
+  def exchange(self, box_n, element_byte_n):
+    """Halo exchanged for one box of box_n points per spatial dimension.
+
+       The ghost region is built with Box.ghost (full stencils) or
+       Box.extendFaces (face stencils), and one message (holding all
+       components) is sent to every neighboring box that overlaps it.
+       Spatial dimensions beyond those of box_n multiply the components.
+       Returns a dict with keys components, cells, bytes, messages."""
+    depth = self.spatialDepth(len(box_n))
+    box = Box((0,) * len(depth), box_n[:len(depth)])
+    if self.stencil(len(box_n)) == 'full':
+      halo = box.ghost(depth)
+    else:
+      halo = box.extendFaces(depth) - box
+    halo = halo.nonempty()
+    messages = 0
+    for shift in itertools.product(*map(lambda n: (-n, 0, n), box.sizes())):
+      if any(shift) and halo.intersect(box.translate(shift)).size() > 0:
+        messages += 1
+    copies = len(self.components) * self.componentCount(len(box_n))
+    cells = halo.size() * copies
+    return {
+      'components' : copies,
+      'cells'    : cells,
+      'bytes'    : cells * element_byte_n,
+      'messages' : messages,
+    }
+
+  @staticmethod
+  def collector(conds_chk):
+    def f(arg, conds):
+      assert type(arg) == Flops or type(arg) == Scalar or type(arg) == Array
+      if type(arg) == Array and not arg.onlyStateVars() and isTaken(conds_chk(conds)):
+        return Collection([GhostDepth(arg)])
+      return Collection()
+    return f
+
+
+class ExecTime(object):
+  """Roofline estimate of the execution time of a code region.
+
+     Weighted flops (divides and specials scaled by div_sf and spc_sf) are
+     executed at core_gflops per core and memory traffic is moved at core_gbs
+     per core, both decimal (10**9 flops/s and 10**9 bytes/s, see
+     get_transfer_time).  The machine key overlap (default 1.0) is the fraction of the
+     shorter of the two times that is hidden behind the longer one, i.e.
+     1.0 gives max(compute, memory) and 0.0 gives compute + memory.
+
+     L1 loads and stores predicted by the register model (see RegisterUse)
+     are issued by the core alongside the flops, each costing l1_sf
+     (default 0) flops of compute time.  The memory time is scaled by
+     bw_derate, e.g. when a loop walks more streams than the prefetchers
+     track (see get_prefetch_derate), and tlb_time (the cost of TLB
+     misses, see StaticAnalysis.pageFootprint) is added to it.  The flops
+     are executed simd_speedup times faster when vectorized (see SimdUse)."""
+  slots = ['wflops', 'l1_accesses', 'traffic_bytes', 'compute_time', 'memory_time', 'overlap',
+           'bw_derate', 'tlb_time', 'simd_speedup']
+  def __init__(self, flops = None, traffic_bytes = 0, machine = None, memory_time = None,
+               l1_accesses = 0, bw_derate = 1.0, tlb_time = 0, simd_speedup = 1.0):
+    if flops is None:
+      # empty estimate to accumulate into
+      (self.wflops, self.l1_accesses, self.traffic_bytes, self.compute_time, self.memory_time,
+       self.tlb_time) = (0, 0, 0, 0, 0, 0)
+      self.overlap = machine.get('overlap', 1.0) if machine else 1.0
+      self.bw_derate = 1.0
+      self.simd_speedup = 1.0
+      return
+    self.wflops = flops.adds + flops.multiplies + \
+                  get_scale_factor('div', machine) * flops.divides + \
+                  get_scale_factor('spc', machine) * flops.specials
+    self.l1_accesses = l1_accesses
+    self.traffic_bytes = traffic_bytes
+    self.compute_time = get_compute_time(self.wflops / simd_speedup + machine.get('l1_sf', 0) * l1_accesses,
+                                         machine)
+    if memory_time is None:
+      memory_time = get_bandwidth_time(traffic_bytes, machine['core_gbs'], machine)
+    self.memory_time = memory_time * bw_derate + tlb_time
+    self.overlap = machine.get('overlap', 1.0)
+    self.bw_derate = bw_derate
+    self.tlb_time = tlb_time
+    self.simd_speedup = simd_speedup
+  def __iadd__(self, other):
+    self.wflops += other.wflops
+    self.l1_accesses += other.l1_accesses
+    self.traffic_bytes += other.traffic_bytes
+    self.compute_time += other.compute_time
+    self.memory_time += other.memory_time
+    self.bw_derate = max(self.bw_derate, other.bw_derate)
+    self.tlb_time += other.tlb_time
+    return self
+  def __mul__(self, n):
+    """Estimate of the region executed n times."""
+    result = ExecTime()
+    (result.wflops, result.l1_accesses, result.traffic_bytes, result.compute_time, result.memory_time,
+     result.tlb_time) = map(lambda x: x * n, (self.wflops, self.l1_accesses, self.traffic_bytes,
+                                               self.compute_time, self.memory_time, self.tlb_time))
+    (result.overlap, result.bw_derate, result.simd_speedup) = (self.overlap, self.bw_derate, self.simd_speedup)
+    return result
+  def time(self):
+    (c, m) = (toFloat(self.compute_time), toFloat(self.memory_time))
+    if c is None or m is None:
+      return None
+    return max(c, m) + (1.0 - self.overlap) * min(c, m)
+  def intensity(self):
+    """Arithmetic intensity in weighted flops per byte of memory traffic."""
+    (f, b) = (toFloat(self.wflops), toFloat(self.traffic_bytes))
+    if f is None or not b:
+      return None
+    return f / b
+  def bound(self):
+    (c, m) = (toFloat(self.compute_time), toFloat(self.memory_time))
+    if c is None or m is None:
+      return None
+    return 'compute' if c > m else 'bandwidth'
+  def __str__(self):
+    s = "ET time=%s s, compute=%s s, memory=%s s, WF=%s, L1 L/S=%s, AI=%s flops/byte, %s-bound" % \
+        (self.time(), self.compute_time, self.memory_time, self.wflops, self.l1_accesses,
+         self.intensity(), self.bound() or 'unknown')
+    if self.bw_derate != 1.0:
+      s += ", bandwidth derated %gx" % self.bw_derate
+    if self.tlb_time:
+      s += ", TLB=%s s" % self.tlb_time
+    if self.simd_speedup != 1.0:
+      s += ", SIMD speedup %.3gx" % self.simd_speedup
+    return s
+
+
+class Memo(object):
+  """Analysis results by key, keeping the capacity most recently used
+     (default options.memo_n) so that evaluating a program with many
+     params/machine/conds does not grow without limit.  May be shared
+     between threads (e.g. the model server); a result computed by two
+     threads at once is just computed twice."""
+  __slots__ = ['capacity', 'entries', 'lock']
+  def __init__(self, capacity = None):
+    self.capacity = capacity if capacity is not None else options.memo_n
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+  def __call__(self, key, f):
+    with self.lock:
+      if key in self.entries:
+        value = self.entries.pop(key)
+        self.entries[key] = value # reinsert as most recently used
+        return value
+    value = f()
+    with self.lock:
+      self.entries[key] = value
+      while len(self.entries) > self.capacity:
+        self.entries.popitem(last=False)
+    return value
+  def __len__(self):
+    return len(self.entries)
+
+
 class StaticAnalysis(object):
 
-  slots = ['functions', 'scops']
+  slots = ['functions', 'callees', 'scops', 'memo']
 
-  def __init__(self, xml, polly_xml = None, symsubs = None, namesubs = None):
-    self.functions = XMLParser(xml, symsubs, namesubs).functions
+  def __init__(self, xml, polly_xml = None, symsubs = None, namesubs = None, memo = None):
+    # a program may span several XML files (comma-separated), e.g. with the callees in their own files
+    self.functions = sum(map(lambda x: XMLParser(x, symsubs, namesubs).functions,
+                             xml.split(',') if xml else [xml]), [])
+    # functions that calls resolve to, the first definition of a name wins
+    self.callees = dict(map(lambda x: (x.name, x), reversed(self.functions)))
     if polly_xml:
       self.scops = PollyXMLParser(polly_xml).scops
     else:
       self.scops = []
+    # results shared between evaluations of the same program with different
+    # params/machine/conds (e.g. batch runs or the model server), and between
+    # programs if a memo is given (see variants.py); results that depend on
+    # the whole program are keyed by self
+    self.memo = memo if memo is not None else Memo()
+
+  def memoize(self, key, f):
+    return self.memo(key, f)
+
+  def clearMemo(self):
+    self.memo = Memo(self.memo.capacity)
+
+  def lineMachine(self, machine):
+    """The machine with the unit stride dimension filled in if the cache line model needs it."""
+    if machine.get('line_model', 0) and 'unit_stride_dim' not in machine:
+      machine = dict(machine, unit_stride_dim=self.memoize((self, 'unit_stride_dim'),
+                                                           lambda: detectUnitStrideDim(self.functions)))
+    return machine
+
+  def unitStrideDim(self, machine):
+    """Unit-stride array dimension, given by the machine or detected from the program."""
+    if 'unit_stride_dim' in machine:
+      return int(machine['unit_stride_dim'])
+    return self.memoize((self, 'unit_stride_dim'), lambda: detectUnitStrideDim(self.functions))
+
+  analyses = ['flops', 'state_vars', 'array_vars', 'registers', 'streams', 'ws', 'traffic']
+
+  def collectLoop(self, sym_loop, params, block_params, machine, conds_chk, flag_sub_params,
+                  analyses = analyses, verbose = None):
+    """Runs the requested analysis collectors over a top-level loop.
+
+       The traffic model prints its reuse report if verbose (default
+       options.flag_verbose_reuse) when it is first evaluated.
+       Returns a dict of the resulting Collections keyed by analysis type."""
+    machine = self.lineMachine(machine)
+    P = frozenDict(params)
+    B = frozenDict(block_params)
+    M = frozenDict(machine)
+    C = conds_chk.key()
+    # the unit stride dimension may be detected from the whole program (and
+    # the memo shared with other programs), so it is part of the simd key
+    U = self.unitStrideDim(machine) if 'simd' in analyses else None
+    # the traffic model substitutes parameters itself, skip it if only traffic is needed
+    if flag_sub_params and analyses != ['traffic']:
+      loop = self.memoize((sym_loop, 'loop', P), lambda: sym_loop.subParams(params))
+      # only blocked if needed, block_params may not be given otherwise
+      block_loop = lambda: self.memoize((sym_loop, 'block_loop', P, B),
+                                        lambda: sym_loop.blocked(block_params).subParams(params))
+    else:
+      (P, B) = (None, None) # results do not depend on the parameter values
+      loop = sym_loop
+      block_loop = lambda: sym_loop
+    collectors = {
+      'flops'      : lambda: loop.collect(FlopCount.collector(conds_chk)),
+      'state_vars' : lambda: loop.collect(StateVar.collector(conds_chk)),
+      'array_vars' : lambda: loop.collect(ArrayVar.collector(conds_chk)),
+      'registers'  : lambda: loop.collect(RegisterUse.collector(conds_chk, machine)),
+      'streams'    : lambda: loop.collect(PrefetchStream.collector(conds_chk)),
+      'simd'       : lambda: loop.collect(SimdUse.collector(conds_chk, machine, U)),
+      'ghost'      : lambda: loop.collect(GhostDepth.collector(conds_chk)),
+      'ws'         : lambda: block_loop().collect(WorkingSet.collector(conds_chk, machine)),
+      'traffic'    : lambda: sym_loop.collect(Traffic.collector(conds_chk, params, block_params, machine, verbose)),
+    }
+    # which inputs each analysis depends on
+    inputs = {
+      'flops'      : (P, C),
+      'state_vars' : (P, C),
+      'array_vars' : (P, C),
+      'registers'  : (P, M, C),
+      'streams'    : (P, C),
+      'simd'       : (P, M, C, U),
+      'ghost'      : (P, C),
+      'ws'         : (P, B, M, C),
+      'traffic'    : (frozenDict(params), frozenDict(block_params), M, C),
+    }
+    return dict(map(lambda x: (x, self.memoize((sym_loop, x) + inputs[x], collectors[x])), analyses))
+
+  def collectHierarchy(self, sym_loop, params, block_params, machine, conds_chk, flag_sub_params):
+    """Traffic between each adjacent pair of memory levels for a top-level loop.
+
+       The traffic out of cache level i is the traffic model evaluated with
+       only that level's capacity; the last level exchanges data with DRAM.
+       Loads and stores issued by the core are served by L1.
+       Returns a list of dicts with keys src, dst, bytes, and time (or None
+       if the bandwidth of the serving level is unknown)."""
+    levels = get_cache_levels(machine)
+    array_vars = self.collectLoop(sym_loop, params, block_params, machine, conds_chk, flag_sub_params,
+                                  ['array_vars'])['array_vars']
+    # the reuse report would be repeated once per level
+    level_bytes = map(lambda (name, byte_n, gbs): totalBytes(
+                        self.collectLoop(sym_loop, params, block_params,
+                                         get_level_machine(machine, byte_n), conds_chk,
+                                         flag_sub_params, ['traffic'], verbose=False)['traffic']), levels)
+    core_bytes = sum(map(lambda x: (x.reads + x.writes) * get_type_byte_n(x.type, machine), array_vars))
+
+    names = ['core'] + map(lambda x: x[0], levels) + ['DRAM']
+    # bandwidth of the level serving each pair, DRAM bandwidth is core_gbs
+    gbs = map(lambda x: x[2], levels) + [machine['core_gbs']]
+    result = []
+    for (i, byte_n) in enumerate([core_bytes] + level_bytes):
+      result.append({
+        'src'   : names[i],
+        'dst'   : names[i+1],
+        'bytes' : byte_n,
+        'time'  : get_bandwidth_time(byte_n, gbs[i], machine) if gbs[i] else None,
+      })
+    return result
+
+  def execTime(self, sym_loop, params, block_params, machine, conds_chk, flag_sub_params):
+    """Roofline time estimate (ExecTime) for a top-level loop.
+
+       With a multi-level cache hierarchy, the memory time is that of the
+       slowest level, otherwise that of the DRAM traffic.  Flops and register
+       spills are always counted with the parameters substituted, since times
+       must be numeric.  The memory time is derated if an innermost loop
+       walks more streams than the prefetchers track, and TLB misses are
+       added if the machine gives their cost (tlb_miss_ns).  With
+       simd_width, vectorized loops speed up the flops."""
+    colls = self.collectLoop(sym_loop, params, block_params, machine, conds_chk, True,
+                             ['flops', 'registers', 'streams', 'simd'])
+    colls.update(self.collectLoop(sym_loop, params, block_params, machine, conds_chk, flag_sub_params,
+                                  ['traffic']))
+    memory_time = None
+    if 'cache_level_n' in machine:
+      times = filter(lambda x: x is not None,
+                     map(lambda x: x['time'], self.collectHierarchy(sym_loop, params, block_params, machine,
+                                                                    conds_chk, flag_sub_params)))
+      memory_time = max(times) if times else None
+    return ExecTime(FlopCount.total(colls['flops']), sum(map(lambda x: x.bytes(), colls['traffic'])),
+                    machine, memory_time,
+                    sum(map(lambda x: x.l1_loads + x.l1_stores, colls['registers'])),
+                    get_prefetch_derate(PrefetchStream.maxStreams(colls['streams']), machine),
+                    self.tlbTime(sym_loop, params, machine, conds_chk),
+                    SimdUse.speedup(colls['simd'], machine) if 'simd_width' in machine else 1.0)
+
+  def condReuse(self, sym_loop, params, block_params, machine, conds_chk):
+    """Reuse decisions in a top-level loop under each policy for arrays that
+       are accessed conditionally (see get_ws_weight): worst case, expected,
+       and ignoring arrays accessed with a probability below ws_cond_p (0.5 if
+       not given).  As in the traffic model, the working set of one blocked
+       iteration of each loop is compared with the cache.  Only loops whose
+       working set depends on the policy are listed.  Returns a list of dicts
+       with keys linenum, ws_bytes and fits, the latter two keyed by policy."""
+    def decisions():
+      line_machine = self.lineMachine(machine)
+      policies = [('worst', dict(line_machine, ws_cond_p=0.0, ws_cond_expected=0)),
+                  ('expected', dict(line_machine, ws_cond_p=0.0, ws_cond_expected=1)),
+                  ('ignore', dict(line_machine, ws_cond_p=machine.get('ws_cond_p', 0.0) or 0.5,
+                                  ws_cond_expected=0))]
+      cache_byte_n = get_cache_byte_n(machine)
+      def block(loop):
+        result = loop.blocked(block_params).copy()
+        result.body = Body()
+        (result.body.codeblocks, result.body.calls) = (loop.body.codeblocks, loop.body.calls)
+        result.body.loops = map(block, loop.body.loops)
+        return result
+      result = []
+      def visit(loop):
+        ws = dict(map(lambda (name, m): (name, sum(map(lambda x: x.bytes(),
+                                                         loop.body.collect(WorkingSet.collector(conds_chk, m))))),
+                      policies))
+        if len(set(ws.values())) > 1:
+          result.append({'linenum': loop.linenum, 'ws_bytes': ws,
+                         'fits': dict(map(lambda (k, v): (k, v <= cache_byte_n), ws.items()))})
+        map(visit, loop.body.loops)
+      visit(block(sym_loop).subParams(params))
+      return sorted(result, key=lambda x: x['linenum'])
+    return self.memoize((sym_loop, 'cond_reuse', frozenDict(params), frozenDict(block_params), frozenDict(machine),
+                         conds_chk.key()), decisions)
+
+  def arrayExtents(self, params, machine, conds_chk):
+    """Index bounds of each array over all loops of the program, taken from
+       the working sets of the top-level loops with the parameters
+       substituted.  Returns {name: [(lo, hi)] per dimension}."""
+    def extents():
+      result = {}
+      for function in self.functions:
+        for sym_loop in function.body.loops:
+          loop = self.memoize((sym_loop, 'loop', frozenDict(params)), lambda: sym_loop.subParams(params))
+          for ws in loop.collect(WorkingSet.collector(conds_chk, machine)):
+            for acc in ws.accesses:
+              bounds = map(lambda x: (x, x) if type(x) == int else tuple(x), acc.index)
+              if ws.name not in result:
+                result[ws.name] = bounds
+              elif len(result[ws.name]) == len(bounds):
+                result[ws.name] = map(lambda (a, b): (min(a[0], b[0]), max(a[1], b[1])),
+                                      zip(result[ws.name], bounds))
+      return result
+    return self.memoize((self, 'extents', frozenDict(params), frozenDict(machine), conds_chk.key()), extents)
+
+  def pageFootprint(self, sym_loop, params, machine, conds_chk):
+    """Distinct pages touched per iteration of each innermost loop of a
+       top-level loop, and per iteration of the loop enclosing it (the
+       middle loop, i.e. one sweep of the innermost loop).
+
+       Pages of page_byte_n (default 4096) bytes are counted in the working
+       set boxes of one iteration, with every enclosing loop variable at the
+       middle of its range, and the arrays laid out with the extents from
+       arrayExtents.  If the pages of an iteration exceed tlb_entry_n, every
+       iteration misses the TLB on each of its pages.  Returns a list of
+       dicts with keys linenum, inner_pages, middle (line number or None),
+       middle_pages, thrash and misses."""
+    def footprint():
+      extents = self.arrayExtents(params, machine, conds_chk)
+      unit_dim = self.unitStrideDim(machine)
+      page_byte_n = int(machine.get('page_byte_n', 4096))
+      entry_n = machine.get('tlb_entry_n', None)
+      def pages(body, loops):
+        values = dict(map(lambda x: (x.loopvar, (x.range[0] + x.range[1]) // 2), loops))
+        page_n = 0
+        for ws in body.collect(WorkingSet.collector(conds_chk, machine)):
+          if ws.name not in extents:
+            continue
+          boxes = []
+          for acc in ws.accesses:
+            if len(acc.index) != len(extents[ws.name]):
+              continue
+            boxes.append(map(lambda (x, lv): (x, x) if not lv and type(x) == int else
+                                             (tuple(x) if not lv else (values[lv] + x, values[lv] + x)),
+                             zip(acc.index, acc.loopvars)))
+          page_n += get_page_n(boxes, extents[ws.name], ws.word_byte_n, page_byte_n, unit_dim)
+        return page_n
+      result = []
+      counted = set()
+      def visit(loop, enclosing):
+        if loop.body.loops:
+          for inner in loop.body.loops:
+            visit(inner, enclosing + [loop])
+          return
+        middle = enclosing[-1] if enclosing else None
+        inner_pages = pages(loop.body, enclosing + [loop])
+        middle_pages = pages(middle.body, enclosing) if middle else None
+        iter_n = reduce(operator.mul, map(lambda x: x.iter_n(), enclosing), 1)
+        (thrash, misses) = (False, 0)
+        if entry_n and inner_pages > entry_n:
+          (thrash, misses) = (True, inner_pages * iter_n * loop.iter_n())
+        elif entry_n and middle and middle_pages > entry_n:
+          # counted once for all the innermost loops of a middle loop
+          (thrash, misses) = (True, 0 if middle in counted else middle_pages * iter_n)
+          counted.add(middle)
+        result.append({'linenum': loop.linenum, 'inner_pages': inner_pages,
+                       'middle': middle.linenum if middle else None, 'middle_pages': middle_pages,
+                       'thrash': thrash, 'misses': misses})
+      visit(self.memoize((sym_loop, 'loop', frozenDict(params)), lambda: sym_loop.subParams(params)), [])
+      return sorted(result, key=lambda x: x['linenum'])
+    return self.memoize((self, sym_loop, 'pages', frozenDict(params), frozenDict(machine), conds_chk.key()),
+                        footprint)
+
+  def tlbTime(self, sym_loop, params, machine, conds_chk):
+    """Seconds spent on TLB misses (tlb_miss_ns each, spread over all cores)
+       in a top-level loop, or 0 if the machine does not give their cost."""
+    if 'tlb_miss_ns' not in machine:
+      return 0
+    misses = sum(map(lambda x: x['misses'], self.pageFootprint(sym_loop, params, machine, conds_chk)))
+    return misses * machine['tlb_miss_ns'] * 1e-9 / machine['core_n']
+
+  def haloExchange(self, function, params, machine, conds_chk):
+    """Ghost cell exchange needed before a function runs on one box of a
+       box decomposition (see get_box_n).
+
+       Arrays whose first access (in loop order) is a read come from outside
+       the function and are exchanged, with the ghost depth read before they
+       are first written.  Other arrays are computed locally, including their
+       ghost cells.  Only arrays indexed by loop variables in at least as many
+       dimensions as the box are distributed.  Returns a dict with keys arrays (a list of dicts with
+       keys name, depth, components, stencil, cells, bytes, messages), bytes,
+       messages, and time (the NIC time), or None without a box decomposition."""
+    box_n = get_box_n(params)
+    if not box_n:
+      return None
+    ghosts = {}
+    done = set()
+    for sym_loop in function.body.loops:
+      for g in self.collectLoop(sym_loop, params, None, machine, conds_chk, True, ['ghost'])['ghost']:
+        if g.name in done:
+          continue
+        if g.name in ghosts:
+          ghosts[g.name] += g
+        elif g.read:
+          ghosts[g.name] = GhostDepth(copy=g)
+        if g.written:
+          done.add(g.name)
+    arrays = []
+    for g in sorted(ghosts.values(), key=lambda x: x.name):
+      # only fields spanning every box dimension are distributed
+      if len(g.spatialDims()) < len(box_n) or not any(g.spatialDepth(len(box_n))):
+        continue
+      arrays.append(dict(g.exchange(box_n, get_type_byte_n(g.type, machine)),
+                         name=g.name, depth=g.spatialDepth(len(box_n)), stencil=g.stencil(len(box_n))))
+    byte_n = sum(map(lambda x: x['bytes'], arrays))
+    message_n = sum(map(lambda x: x['messages'], arrays))
+    return {
+      'arrays'   : arrays,
+      'bytes'    : byte_n,
+      'messages' : message_n,
+      'time'     : get_comm_time(byte_n, message_n, machine) if 'nic_bw_gbs' in machine else None,
+    }
+
+  def liveMemory(self, function, params, machine, conds_chk):
+    """Timeline of the memory held by the arrays of a function.
+
+       An array is live from the first to the last top-level loop of the
+       function that accesses it, and occupies its whole extent (see
+       arrayExtents).  Returns a dict with keys arrays (a list of dicts with
+       keys name, bytes, first and last, the line numbers of the first and
+       last loops), timeline (a list of (linenum, live bytes) per top-level
+       loop), peak (the high-water mark in bytes) and peak_loops (the line
+       numbers of the loops where it is reached)."""
+    def live():
+      extents = self.arrayExtents(params, machine, conds_chk)
+      arrays = {}
+      for (i, sym_loop) in enumerate(function.body.loops):
+        loop = self.memoize((sym_loop, 'loop', frozenDict(params)), lambda: sym_loop.subParams(params))
+        for ws in loop.collect(WorkingSet.collector(conds_chk, machine)):
+          # scalars take no memory worth counting
+          if not extents.get(ws.name, None):
+            continue
+          if ws.name not in arrays:
+            byte_n = int(reduce(operator.mul, map(lambda (lo, hi): hi - lo + 1, extents[ws.name]), ws.word_byte_n))
+            arrays[ws.name] = {'name': ws.name, 'bytes': byte_n, 'first': i}
+          arrays[ws.name]['last'] = i
+      linenums = map(lambda x: x.linenum, function.body.loops)
+      timeline = map(lambda i: (linenums[i], sum(map(lambda x: x['bytes'],
+                                                     filter(lambda x: x['first'] <= i <= x['last'],
+                                                            arrays.values())))),
+                     range(len(linenums)))
+      peak = max([0] + map(lambda (l, b): b, timeline))
+      for x in arrays.values():
+        (x['first'], x['last']) = (linenums[x['first']], linenums[x['last']])
+      return {
+        'arrays'     : sorted(arrays.values(), key=lambda x: (x['first'], x['name'])),
+        'timeline'   : timeline,
+        'peak'       : peak,
+        'peak_loops' : map(lambda (l, b): l, filter(lambda (l, b): b == peak, timeline)) if timeline else [],
+      }
+    return self.memoize((function, 'live', frozenDict(params), frozenDict(machine), conds_chk.key()), live)
+
+  def callSites(self, function, params, conds_chk):
+    """Calls in a function to other functions of the program, with the number
+       of times each is made: the product of the trip counts of the enclosing
+       loops (parameters substituted) and the probability of its conditions.
+       Returns a list of (FuncCall, count) in line order."""
+    def resolved(body):
+      return any(map(lambda x: x.name in self.callees, body.calls)) or \
+             any(map(lambda x: resolved(x.body), body.loops))
+    result = []
+    def visit(body, count):
+      for call in body.calls:
+        conds_sat = conds_chk(call.conds)
+        if call.name in self.callees and isTaken(conds_sat):
+          result.append((call, count * conds_sat))
+      # only loops enclosing calls need their bounds substituted
+      for loop in filter(lambda x: resolved(x.body), body.loops):
+        visit(loop.body, count * loop.subParams(params, shallow=True).iter_n())
+    visit(function.body, 1)
+    return sorted(result, key=lambda (call, count): call.linenum)
+
+  def callSummary(self, function, params, block_params, machine, conds_chk, active = None):
+    """Flops and execution time of the top-level loops of a function and of
+       the functions it calls, with the parameters substituted.
+
+       At each call site the callee's summary is instantiated with the
+       parameters bound by the actual-to-formal argument mapping (see
+       get_call_params) and scaled by the number of calls.  Summaries are
+       memoized per binding, so a function called with the same argument
+       extents from many sites or call chains is analyzed once.  Calls to a
+       function still being summarized (in active, the names of the
+       callers up the call chain) are recursive and not followed.  Returns
+       a dict with keys flops (FlopCount), time (ExecTime) and calls (a
+       list of dicts with keys linenum, name, count, and the flops and time
+       of one call)."""
+    active = active if active is not None else set()
+    def summarize():
+      flops = FlopCount(Flops())
+      et = ExecTime(machine=machine)
+      for sym_loop in function.body.loops:
+        flops += FlopCount.total(self.collectLoop(sym_loop, params, block_params, machine, conds_chk, True,
+                                                  ['flops'])['flops'])
+        et += self.execTime(sym_loop, params, block_params, machine, conds_chk, True)
+      calls = []
+      active.add(function.name)
+      try:
+        for (call, count) in self.callSites(function, params, conds_chk):
+          if call.name in active:
+            continue
+          callee = self.callSummary(self.callees[call.name], get_call_params(call, params), block_params,
+                                    machine, conds_chk, active)
+          flops += callee['flops'] * count
+          et += callee['time'] * count
+          calls.append({'linenum': call.linenum, 'name': call.name, 'count': count,
+                        'flops': callee['flops'], 'time': callee['time']})
+      finally:
+        active.discard(function.name)
+      return {'flops': flops, 'time': et, 'calls': calls}
+    return self.memoize((function, 'calls', frozenDict(params), frozenDict(block_params), frozenDict(machine),
+                         conds_chk.key()), summarize)
+
+  def summary(self, params, block_params, machine, conds_chk, flag_sub_params):
+    """Returns the per-loop analysis results as a list of dicts (one per function).
+
+       Unlike dump(), only totals are kept, so the result is cheap to
+       serialize and compare across configurations."""
+    result = []
+    for function in self.functions:
+      loops = []
+      function_time = ExecTime(machine=machine)
+      for sym_loop in function.body.loops:
+        colls = self.collectLoop(sym_loop, params, block_params, machine, conds_chk, flag_sub_params)
+        flops = FlopCount.total(colls['flops'])
+        et = self.execTime(sym_loop, params, block_params, machine, conds_chk, flag_sub_params)
+        function_time += et
+        regs = RegisterUse.perLoop(colls['registers'])
+        simd = SimdUse.perLoop(self.collectLoop(sym_loop, params, block_params, machine, conds_chk, True,
+                                                ['simd'])['simd'], machine)
+        loops.append({
+          'linenum'       : sym_loop.linenum,
+          'adds'          : flops.adds,
+          'multiplies'    : flops.multiplies,
+          'divides'       : flops.divides,
+          'specials'      : flops.specials,
+          'ws_bytes'      : totalBytes(colls['ws']),
+          'traffic_bytes' : sum(map(lambda x: x.bytes(), colls['traffic'])),
+          'spills'        : sum(map(lambda x: x['fp_spill_n'] + x['int_spill_n'], regs)),
+          'l1_loads'      : sum(map(lambda x: x['l1_loads'], regs)),
+          'l1_stores'     : sum(map(lambda x: x['l1_stores'], regs)),
+          'streams'       : PrefetchStream.maxStreams(colls['streams']),
+          'tlb_pages'     : max([0] + map(lambda x: max(x['inner_pages'], x['middle_pages']),
+                                          self.pageFootprint(sym_loop, params, machine, conds_chk))),
+          'tlb_misses'    : sum(map(lambda x: x['misses'],
+                                    self.pageFootprint(sym_loop, params, machine, conds_chk))),
+          'vectorizable'  : all(map(lambda x: x['vectorizable'], simd)),
+          'simd_speedup'  : et.simd_speedup,
+          'wflops'        : et.wflops,
+          'compute_time'  : et.compute_time,
+          'memory_time'   : et.memory_time,
+          'time'          : et.time(),
+          'intensity'     : et.intensity(),
+          'bound'         : et.bound(),
+        })
+        if 'cache_level_n' in machine:
+          for pair in self.collectHierarchy(sym_loop, params, block_params, machine, conds_chk,
+                                            flag_sub_params):
+            loops[-1]['traffic_bytes_%s_%s' % (pair['src'], pair['dst'])] = pair['bytes']
+            loops[-1]['time_%s_%s' % (pair['src'], pair['dst'])] = pair['time']
+      result.append({
+        'name'          : function.name,
+        'loops'         : loops,
+        'adds'          : sum(map(lambda x: x['adds'], loops)),
+        'multiplies'    : sum(map(lambda x: x['multiplies'], loops)),
+        'divides'       : sum(map(lambda x: x['divides'], loops)),
+        'specials'      : sum(map(lambda x: x['specials'], loops)),
+        'traffic_bytes' : sum(map(lambda x: x['traffic_bytes'], loops)),
+        'spills'        : sum(map(lambda x: x['spills'], loops)),
+        'l1_loads'      : sum(map(lambda x: x['l1_loads'], loops)),
+        'l1_stores'     : sum(map(lambda x: x['l1_stores'], loops)),
+        'streams'       : max([0] + map(lambda x: x['streams'], loops)),
+        'tlb_misses'    : sum(map(lambda x: x['tlb_misses'], loops)),
+        'wflops'        : function_time.wflops,
+        'compute_time'  : function_time.compute_time,
+        'memory_time'   : function_time.memory_time,
+        'time'          : function_time.time(),
+        'intensity'     : function_time.intensity(),
+        'bound'         : function_time.bound(),
+      })
+      # per-level traffic and time totals, if any
+      for key in sorted(loops[0].keys()) if loops else []:
+        if key.startswith('traffic_bytes_') or key.startswith('time_'):
+          values = map(lambda x: x[key], loops)
+          result[-1][key] = None if None in values else sum(values)
+      calls = self.callSummary(function, params, block_params, machine, conds_chk)
+      result[-1]['call_n'] = len(calls['calls'])
+      result[-1]['incl_adds'] = calls['flops'].adds
+      result[-1]['incl_multiplies'] = calls['flops'].multiplies
+      result[-1]['incl_divides'] = calls['flops'].divides
+      result[-1]['incl_specials'] = calls['flops'].specials
+      result[-1]['incl_traffic_bytes'] = calls['time'].traffic_bytes
+      result[-1]['incl_time'] = calls['time'].time()
+      live = self.liveMemory(function, params, machine, conds_chk)
+      result[-1]['live_peak_bytes'] = live['peak']
+      result[-1]['live_peak_loops'] = live['peak_loops']
+      halo = self.haloExchange(function, params, machine, conds_chk)
+      if halo:
+        result[-1]['comm_bytes'] = halo['bytes']
+        result[-1]['comm_messages'] = halo['messages']
+        result[-1]['comm_time'] = halo['time']
+    return result
 
   def dump(self, params, block_params, machine, conds_chk, flag_sub_params):
     for function in self.functions:
       print "*" * (4+len(function.name))
       print "* %s *" % function.name
       print "*" * (4+len(function.name))
+      function_time = ExecTime(machine=machine)
       for sym_loop in function.body.loops:
         print
         print "*" * (9+len(str(sym_loop.linenum)))
@@ -493,31 +1937,136 @@ class StaticAnalysis(object):
         print "*" * (9+len(str(sym_loop.linenum)))
         print
 
-        if flag_sub_params:
-          loop = sym_loop.subParams(params)
-          block_loop = sym_loop.blocked(block_params)
-          block_loop = block_loop.subParams(params)
-        else:
-          loop = sym_loop
-          block_loop = sym_loop
+        colls = self.collectLoop(sym_loop, params, block_params, machine, conds_chk, flag_sub_params,
+                                 ['flops', 'state_vars', 'array_vars', 'ws'])
 
         print "Floating Point Ops (A/S/M/D):"
-        print loop.collect(FlopCount.collector(conds_chk))
+        print colls['flops']
 
         print "State Variables (R/W):"
-        print loop.collect(StateVar.collector(conds_chk))
+        print colls['state_vars']
 
         print "Array Variables (L/S):"
-        print loop.collect(ArrayVar.collector(conds_chk))
+        print colls['array_vars']
+
+        print "Register Allocation (per innermost loop):"
+        regs = self.collectLoop(sym_loop, params, block_params, machine, conds_chk, flag_sub_params,
+                                ['registers'])['registers']
+        for x in RegisterUse.perLoop(regs):
+          print "RA loop %4d: FP vars %d (%d spilled, %d regs), int vars %d (%d spilled, %d regs), L1 L=%s, S=%s" % \
+                (x['linenum'], x['fp_var_n'], x['fp_spill_n'], machine['core_fp_reg_n'],
+                 x['int_var_n'], x['int_spill_n'], machine['core_int_reg_n'], x['l1_loads'], x['l1_stores'])
+        print
+
+        print "Prefetch Streams (per innermost loop):"
+        streams = self.collectLoop(sym_loop, params, block_params, machine, conds_chk, flag_sub_params,
+                                   ['streams'])['streams']
+        for x in PrefetchStream.perLoop(streams):
+          s = "PS loop %4d: %d streams over %d arrays" % (x['linenum'], x['stream_n'], x['array_n'])
+          if get_prefetch_derate(x['stream_n'], machine) > 1.0:
+            s += ", exceeds %d prefetch streams" % machine['prefetch_stream_n']
+          print s
+        print
+
+        print "SIMD Vectorization (per innermost loop):"
+        simd = self.collectLoop(sym_loop, params, block_params, machine, conds_chk, True, ['simd'])['simd']
+        for x in SimdUse.perLoop(simd, machine):
+          s = "VEC loop %4d: unit-stride=%g, gather=%g, invariant=%g accesses" % \
+              (x['linenum'], x['unit'], x['gather'], x['invariant'])
+          if x['vectorizable']:
+            s += ", width=%.3g of %g" % (x['width'], machine.get('simd_width', 1))
+          else:
+            s += ", not vectorizable (%s)" % x['reason']
+          print s
+        print
+
+        print "TLB Footprint (pages per iteration, per innermost loop):"
+        for x in self.pageFootprint(sym_loop, params, machine, conds_chk):
+          s = "TLB loop %4d: %d pages" % (x['linenum'], x['inner_pages'])
+          if x['middle'] is not None:
+            s += ", %d pages per iteration of loop %d" % (x['middle_pages'], x['middle'])
+          if x['thrash']:
+            s += ", exceeds %d TLB entries" % machine['tlb_entry_n']
+            if x['misses']:
+              s += " (%g misses)" % x['misses']
+          print s
+        print
 
         print "Working Set:"
-        print block_loop.collect(WorkingSet.collector(conds_chk, machine))
+        print colls['ws']
+
+        cond_reuse = self.condReuse(sym_loop, params, block_params, machine, conds_chk)
+        if cond_reuse:
+          print "Conditional Working Set (worst case / expected / p >= %g, per loop iteration):" % \
+                (machine.get('ws_cond_p', 0.0) or 0.5)
+          for x in cond_reuse:
+            print "CW loop %4d: %.4g / %.4g / %.4g KiB, reuse: %s" % \
+                  ((x['linenum'],) + tuple(map(lambda k: x['ws_bytes'][k] / 2.0**10, ['worst', 'expected', 'ignore'])) +
+                   ('/'.join(map(lambda k: 'yes' if x['fits'][k] else 'no', ['worst', 'expected', 'ignore'])),))
+          print
 
         print "Memory Traffic:"
-        mt = sym_loop.collect(Traffic.collector(conds_chk, params, block_params, machine))
+        mt = self.collectLoop(sym_loop, params, block_params, machine, conds_chk, flag_sub_params,
+                              ['traffic'])['traffic']
         total_bytes = sum(map(lambda x: x.bytes(), mt))
         print
         print "Total Memory Traffic (L/S) using cache model: %g GiB (%g bytes)" % \
               (float(total_bytes) / 2**30, total_bytes)
         print
         print mt
+
+        if 'cache_level_n' in machine:
+          print "Memory Hierarchy Traffic:"
+          for pair in self.collectHierarchy(sym_loop, params, block_params, machine, conds_chk,
+                                            flag_sub_params):
+            print "MH %4s <-> %-4s %s GiB (%s bytes), time=%s s" % \
+                  (pair['src'], pair['dst'], pair['bytes'] / 2.0**30, pair['bytes'], pair['time'])
+          print
+
+        print "Execution Time (roofline):"
+        et = self.execTime(sym_loop, params, block_params, machine, conds_chk, flag_sub_params)
+        function_time += et
+        print et
+        print
+
+      print "*" * (28+len(function.name))
+      print "* Execution Time of %s total *" % function.name
+      print "*" * (28+len(function.name))
+      print function_time
+      print
+
+      live = self.liveMemory(function, params, machine, conds_chk)
+      if live['arrays']:
+        print "Live Memory (arrays live from first to last accessing loop):"
+        for x in live['arrays']:
+          print "LM %s, %s bytes, loops %d-%d" % (x['name'], x['bytes'], x['first'], x['last'])
+        for (linenum, byte_n) in live['timeline']:
+          print "LM loop %4d: %g MiB (%s bytes)%s" % \
+                (linenum, byte_n / 2.0**20, byte_n, " <- peak" if linenum in live['peak_loops'] else "")
+        print "Peak Live Memory: %g MiB (%s bytes) at loop %s" % \
+              (live['peak'] / 2.0**20, live['peak'], ', '.join(map(str, live['peak_loops'])))
+        print
+
+      halo = self.haloExchange(function, params, machine, conds_chk)
+      if halo and halo['arrays']:
+        print "Halo Exchange (box %s):" % ' x '.join(map(str, get_box_n(params)))
+        for x in halo['arrays']:
+          print "HX %s, depth=%s, components=%d, stencil=%s, cells=%s, bytes=%s, messages=%d" % \
+                (x['name'], x['depth'], x['components'], x['stencil'], x['cells'], x['bytes'], x['messages'])
+        print "Communication: %g MiB (%s bytes) in %d messages, NIC time=%s s, compute time=%s s" % \
+              (halo['bytes'] / 2.0**20, halo['bytes'], halo['messages'], halo['time'], function_time.compute_time)
+        print
+
+    # after all functions, so the callees' own reports come first
+    for function in self.functions:
+      calls = self.callSummary(function, params, block_params, machine, conds_chk)
+      if calls['calls']:
+        print "Calls of %s (per call, including the callee's own calls):" % function.name
+        for x in calls['calls']:
+          print "CALL line %4d: %s x %g, A=%s, M=%s, D=%s, S=%s, traffic=%s bytes, time=%s s" % \
+                (x['linenum'], x['name'], x['count'], x['flops'].adds, x['flops'].multiplies,
+                 x['flops'].divides, x['flops'].specials, x['time'].traffic_bytes, x['time'].time())
+        print "Execution Time of %s including calls:" % function.name
+        print calls['flops']
+        print calls['time']
+        print
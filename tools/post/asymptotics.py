@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+""" Asymptotic scaling laws of flops, traffic and working set in the problem size.
+
+    The model is evaluated with all problem-size parameters scaled
+    together (every extent hi - lo + 1 of the hi/lo bound pairs, and the
+    __BoxX__ style box sizes), and with each other selected parameter
+    (e.g. nspecies) scaled on its own.  Each metric m of a top-level loop
+    or function is fitted to a leading-order law
+
+      m ~ c * N^a * nspecies^b ...
+
+    where N is the extent of the first size parameter (e.g. hi(1) - lo(1) + 1).
+    The exponents are measured between two large scale factors (default
+    32 and 64 times the given params), so lower-order terms (ghost cell
+    faces, nspecies + 5 style counts) and cache effects at small sizes
+    drop out, and are rounded to the nearest half-integer if within 0.05.
+    A loop whose traffic changes regime between the two scales keeps a
+    fractional exponent.
+
+    The laws extrapolate to production sizes: the value of the leading
+    term at any N and parameter values is reported if targets are given.
+    At the given params the law is reported next to the model's value,
+    and their relative difference shows the weight of the lower-order
+    terms there.
+"""
+__author__ = "Cy Chan"
+__copyright__ = "Copyright 2016, The Regents of the University of California, through Lawrence Berkeley National Laboratory"
+__credits__ = ["Cy Chan"]
+__license__ = "Modified BSD License (see LICENSE file)"
+__version__ = "2.0"
+__maintainer__ = "Cy Chan"
+__email__ = "cychan@lbl.gov"
+__status__ = "Production"
+
+import sys
+import re
+import math
+
+from analyze import FlopCount, totalBytes
+import expr
+
+# upper bounds of extents (hi(1), fine_hi(1), ihi1, ...) and box sizes
+size_re = re.compile(r'^(\w+_)?i?hi(\d|\(|$)|^__Box[XYZ]__$')
+
+metrics = ["flops", "traffic_bytes", "ws_bytes"]
+
+def size_n(params):
+  """Extent of the first size parameter (hi(1) if given), the unit of N."""
+  names = dict(map(lambda k: (str(k), k), params.keys()))
+  sizes = sorted(filter(lambda x: size_re.match(x), names.keys()), key=lambda x: (x != 'hi(1)', x))
+  if not sizes:
+    raise Exception("No problem-size parameters (hi/lo bounds or __BoxX__) in the params")
+  hi = sizes[0]
+  lo = hi.replace('hi', 'lo', 1)
+  return int(params[names[hi]]) - (int(params[names[lo]]) - 1 if lo in names else 0)
+
+def scaled_params(params, size_factor, var_factors):
+  """Params with every extent scaled by size_factor (lower bounds fixed)
+     and each parameter in var_factors scaled by its factor."""
+  names = dict(map(lambda k: (str(k), k), params.keys()))
+  result = dict(params)
+  for (name, key) in names.items():
+    if size_re.match(name):
+      lo = name.replace('hi', 'lo', 1)
+      if lo != name and lo in names:
+        (l, h) = (int(params[names[lo]]), int(params[key]))
+        result[key] = expr.parse(str(l + size_factor * (h - l + 1) - 1))
+      else:
+        result[key] = expr.parse(str(int(params[key]) * size_factor))
+  for (var, factor) in var_factors.items():
+    if var not in names:
+      raise Exception("Parameter '%s' not found in the params" % var)
+    result[names[var]] = expr.parse(str(int(params[names[var]]) * factor))
+  return result
+
+def evaluate(sa, params, block_params, machine, conds_chk):
+  """{(function name, linenum or 'total'): {metric: value}} with the given params."""
+  result = {}
+  for function in sa.functions:
+    loops = []
+    for sym_loop in function.body.loops:
+      colls = sa.collectLoop(sym_loop, params, block_params, machine, conds_chk, True, ['flops', 'ws', 'traffic'])
+      flops = FlopCount.total(colls['flops'])
+      loops.append({
+        'flops'         : flops.adds + flops.multiplies + flops.divides + flops.specials,
+        'traffic_bytes' : sum(map(lambda x: x.bytes(), colls['traffic'])),
+        'ws_bytes'      : totalBytes(colls['ws']),
+      })
+      result[(function.name, sym_loop.linenum)] = loops[-1]
+    # loops run one after the other, the largest working set is the function's
+    result[(function.name, 'total')] = {
+      'flops'         : sum(map(lambda x: x['flops'], loops)),
+      'traffic_bytes' : sum(map(lambda x: x['traffic_bytes'], loops)),
+      'ws_bytes'      : max([0] + map(lambda x: x['ws_bytes'], loops)),
+    }
+  return result
+
+def exponent(m0, m1, x0, x1):
+  """Exponent a of m ~ x^a through (x0, m0) and (x1, m1), None if undefined."""
+  if not m0 or not m1 or m0 <= 0 or m1 <= 0:
+    return None
+  return math.log(float(m1) / m0) / math.log(float(x1) / x0)
+
+def round_exponent(a, tolerance = 0.05):
+  """Nearest half-integer, if within tolerance (the remainder is taken
+     to be a lower-order term)."""
+  r = round(a * 2) / 2.0
+  return r if abs(a - r) <= tolerance else a
+
+class ScalingLaw(object):
+  """Leading-order law coef * prod(var^exponent) of a metric."""
+  __slots__ = ['metric', 'coef', 'exponents']
+  def __init__(self, metric, coef, exponents):
+    self.metric = metric
+    self.coef = coef
+    self.exponents = exponents # [(variable, exponent or None)]
+  def __call__(self, values):
+    if self.coef == 0:
+      return 0
+    if self.coef is None or None in map(lambda (v, a): a, self.exponents):
+      return None
+    return reduce(lambda x, (v, a): x * values[v] ** a, self.exponents, self.coef)
+  def __str__(self):
+    if not self.coef:
+      return "0"
+    terms = []
+    for (v, a) in self.exponents:
+      if a is None:
+        terms.append("%s^?" % v)
+        continue
+      if a == 1:
+        terms.append(v)
+      elif a:
+        terms.append("%s^%g" % (v, a))
+    return ' * '.join(["%.4g" % self.coef] + terms)
+
+def scalingLaws(sa, params, block_params, machine, conds_chk, variables = ['nspecies'], scales = (32, 64)):
+  """Fits a ScalingLaw to each metric of every top-level loop and function.
+
+     The size exponent is measured between N scaled by the two scales, and
+     each variable's exponent between the variable scaled by the same
+     factors at the larger size.  Returns (n, {(function name, linenum or
+     'total'): [ScalingLaw per metric]}) where n is the unscaled N."""
+  n = size_n(params)
+  (s0, s1) = scales
+  base = lambda size, var_factors: evaluate(sa, scaled_params(params, size, var_factors), block_params,
+                                            machine, conds_chk)
+  at_s0 = base(s0, {})
+  at_s1 = base(s1, {})
+  var_evals = dict(map(lambda v: (v, (base(s1, {v: s0}), base(s1, {v: s1}))), variables))
+  values = dict(map(lambda (k, v): (str(k), v), params.items()))
+  result = {}
+  for x in at_s1.keys():
+    laws = []
+    for metric in metrics:
+      exponents = [('N', exponent(at_s0[x][metric], at_s1[x][metric], s0, s1))]
+      for v in variables:
+        (e0, e1) = var_evals[v]
+        exponents.append((v, exponent(e0[x][metric], e1[x][metric], s0, s1)))
+      exponents = map(lambda (v, a): (v, round_exponent(a) if a is not None else None), exponents)
+      # coefficient from the largest size with every variable unscaled
+      m = at_s1[x][metric]
+      point = dict([('N', n * s1)] + map(lambda v: (v, int(values[v])), variables))
+      if not m or None in map(lambda (v, a): a, exponents):
+        coef = m and None
+      else:
+        coef = m / reduce(lambda p, (v, a): p * point[v] ** a, exponents, 1.0)
+      laws.append(ScalingLaw(metric, coef, exponents))
+    result[x] = laws
+  return (n, result)
+
+def run_asymptotics(args, variables = ['nspecies'], scales = (32, 64), targets = None, out = sys.stdout):
+  """Writes a tab-separated table with the fitted law of each metric per
+     top-level loop and function total: the exponents of N and of each
+     variable, the coefficient, the law, the value of the law and of the
+     model at the given params and the law's relative error there, and
+     (if given, a dict of N and variable values) the law at the targets."""
+  from run_model import load_numeric_analysis
+
+  (sa, model_kw_args) = load_numeric_analysis(args)
+
+  (n, laws) = scalingLaws(sa, variables=variables, scales=scales, **model_kw_args)
+  model = evaluate(sa, **model_kw_args)
+  values = dict(map(lambda (k, v): (str(k), v), model_kw_args["params"].items()))
+  current = dict([('N', n)] + map(lambda v: (v, int(values[v])), variables))
+  out.write('\t'.join(["function", "loop", "metric", "exp_N"] + map(lambda v: "exp_" + v, variables) +
+                      ["coef", "law", "law_at_params", "model_at_params", "law_error"] +
+                      (["at_targets"] if targets else [])) + '\n')
+  fmt = lambda v: "%g" % v if v is not None else "None"
+  for function in sa.functions:
+    for loop in map(lambda x: x.linenum, function.body.loops) + ['total']:
+      for law in laws[(function.name, loop)]:
+        (fitted, actual) = (law(current), model[(function.name, loop)][law.metric])
+        error = (fitted - actual) / float(actual) if fitted is not None and actual else None
+        row = [function.name, str(loop), law.metric] + map(lambda (v, a): fmt(a), law.exponents) + \
+              [fmt(law.coef), str(law), fmt(fitted), fmt(actual), fmt(error)]
+        if targets:
+          row.append(fmt(law(dict(current, **targets))))
+        out.write('\t'.join(row) + '\n')
+  out.flush()
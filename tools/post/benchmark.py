@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+""" Benchmark suite for the performance model component.
+
+    Each case runs in a fresh interpreter so that import costs (notably
+    sympy) are included, which is what sweep scripts pay per process.
+
+    Usage: ./benchmark.py [case ...] [-n <repeats>]
+      With no case names, all cases are run.
+    Usage: ./benchmark.py --check [cns|smc]
+      Checks that the symbolic (subparams=False) per-loop summaries computed
+      with the symengine backend are identical to the sympy ones.
+"""
+__author__ = "Cy Chan"
+__copyright__ = "Copyright 2016, The Regents of the University of California, through Lawrence Berkeley National Laboratory"
+__credits__ = ["Cy Chan"]
+__license__ = "Modified BSD License (see LICENSE file)"
+__version__ = "2.0"
+__maintainer__ = "Cy Chan"
+__email__ = "cychan@lbl.gov"
+__status__ = "Production"
+
+import sys
+import os
+import time
+import subprocess
+import json
+
+# statement run by the child interpreter: import, parse and model, then
+# report whether sympy ended up being imported
+child_tem = """
+import sys, os
+import run_model
+from common import options
+options.flag_verbose_reuse = False
+stdout = sys.stdout
+sys.stdout = open(os.devnull, 'w')
+run_model.main(['run_model.py'%s])
+sys.stdout = stdout
+print 'sympy' in sys.modules
+"""
+
+import_tem = """
+import sys
+import run_model
+print 'sympy' in sys.modules
+"""
+
+# statement run by the child interpreter to print a JSON per-loop summary
+summary_tem = """
+import sys, json
+import run_model, expr, model_server
+from analyze import StaticAnalysis
+from common import options
+options.flag_verbose_reuse = False
+args = getattr(run_model, '%s_args')()
+run_model.select_expr_backend(args)
+(sa_kw_args, model_kw_args) = run_model.load_args(args)
+sa = StaticAnalysis(**sa_kw_args)
+print json.dumps(model_server.to_json_summary(sa.summary(**model_kw_args)))
+"""
+
+def have_symengine():
+  try:
+    import symengine
+    return True
+  except ImportError:
+    return False
+
+def cold_start_case(mode, env):
+  return (child_tem % (", '%s'" % mode if mode else ""), env)
+
+# name -> (child program, environment overrides)
+cases = [
+  ("import",                 (import_tem, {})),
+  ("cns-fast",               cold_start_case("cns", {"subparams": "True", "expr_backend": "fast"})),
+  ("cns-sympy",              cold_start_case("cns", {"subparams": "True", "expr_backend": "sympy"})),
+  ("smc-fast",               cold_start_case("smc", {"subparams": "True", "expr_backend": "fast"})),
+  ("smc-sympy",              cold_start_case("smc", {"subparams": "True", "expr_backend": "sympy"})),
+  ("smc-symbolic-sympy",     cold_start_case("smc", {"subparams": "False", "expr_backend": "sympy"})),
+  ("smc-symbolic-symengine", cold_start_case("smc", {"subparams": "False", "expr_backend": "symengine"})),
+]
+
+def run_case(program, env_overrides, repeats):
+  env = dict(os.environ)
+  env.update(env_overrides)
+  times = []
+  for i in xrange(repeats):
+    start = time.time()
+    p = subprocess.Popen([sys.executable, "-c", program], env=env,
+                         stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)))
+    out = p.communicate()[0]
+    times.append(time.time() - start)
+    if p.returncode != 0:
+      raise Exception("benchmark child failed with code %d" % p.returncode)
+  return (sorted(times), out.strip().split('\n')[-1] == 'True')
+
+def run_summary(mode, backend):
+  env = dict(os.environ)
+  env.update({"subparams": "False", "expr_backend": backend})
+  p = subprocess.Popen([sys.executable, "-c", summary_tem % mode], env=env,
+                       stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)))
+  out = p.communicate()[0]
+  if p.returncode != 0:
+    raise Exception("summary child failed with code %d" % p.returncode)
+  return json.loads(out.strip().split('\n')[-1])
+
+def same_value(a, b):
+  """Symbolic results are compared by expanding their difference with sympy."""
+  if type(a) in [int, long, float] and type(b) in [int, long, float]:
+    return abs(a - b) <= 1e-9 * max(abs(a), abs(b), 1.0)
+  if a is None or b is None:
+    return a is b
+  if type(a) == list or type(b) == list:
+    return type(a) == type(b) and len(a) == len(b) and all(map(lambda (x, y): same_value(x, y), zip(a, b)))
+  from sympy import sympify, expand
+  return expand(sympify(str(a)) - sympify(str(b))) == 0
+
+def check(mode):
+  """Returns the number of values that differ between the sympy and symengine summaries."""
+  (reference, candidate) = (run_summary(mode, "sympy"), run_summary(mode, "symengine"))
+  mismatches = 0
+  for (f_ref, f_cand) in zip(reference, candidate):
+    rows = [(f_ref['name'], 'total', f_ref, f_cand)] + \
+           map(lambda (l_ref, l_cand): (f_ref['name'], l_ref['linenum'], l_ref, l_cand),
+               zip(f_ref['loops'], f_cand['loops']))
+    for (name, loop, ref, cand) in rows:
+      for key in sorted(ref.keys()):
+        if key in ['name', 'loops', 'linenum']:
+          continue
+        if not same_value(ref[key], cand[key]):
+          mismatches += 1
+          print "%s loop %s %s: sympy=%s symengine=%s" % (name, loop, key, ref[key], cand[key])
+  if len(reference) != len(candidate):
+    mismatches += 1
+    print "function counts differ: sympy=%d symengine=%d" % (len(reference), len(candidate))
+  print "%s: %d mismatches" % (mode, mismatches)
+  return mismatches
+
+def main(args):
+  if len(args) > 1 and args[1] == '--check':
+    if not have_symengine():
+      print "symengine is not installed"
+      sys.exit(1)
+    sys.exit(1 if check(args[2] if len(args) > 2 else "smc") else 0)
+
+  repeats = 3
+  names = []
+  i = 1
+  while i < len(args):
+    if args[i] == '-n':
+      repeats = int(args[i+1])
+      i += 1
+    else:
+      names.append(args[i])
+    i += 1
+
+  selected = filter(lambda (name, case): not names or name in names, cases)
+  print "%-24s %10s %10s %8s" % ("case", "min (s)", "median (s)", "sympy")
+  for (name, (program, env)) in selected:
+    if env.get("expr_backend", None) == "symengine" and not have_symengine():
+      print "%-24s %10s %10s %8s" % (name, "n/a", "n/a", "n/a")
+      continue
+    (times, used_sympy) = run_case(program, env, repeats)
+    print "%-24s %10.3f %10.3f %8s" % (name, times[0], times[len(times)/2], used_sympy)
+    sys.stdout.flush()
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -24,11 +24,37 @@ def collapse(a):
 def diff(a):
   return a[1] - a[0]
 
+num_types = (int, long, float)
+
+def sign(a, b):
+  """Sign of a - b for interval bounds that may be symbolic expressions.
+
+     Raises TypeError if the sign cannot be decided, rather than relying on
+     the truth value of a symbolic relational (which some expression
+     libraries, e.g. symengine, do not raise an error for)."""
+  d = a - b
+  if getattr(d, 'is_number', True) is not True:
+    raise TypeError("cannot compare symbolic bounds %s and %s" % (a, b))
+  d = float(d)
+  return (d > 0) - (d < 0)
+
+def smax(a, b):
+  if type(a) in num_types and type(b) in num_types:
+    return max(a, b)
+  return a if sign(a, b) >= 0 else b
+
+def smin(a, b):
+  if type(a) in num_types and type(b) in num_types:
+    return min(a, b)
+  return a if sign(a, b) <= 0 else b
+
 def intervalIntersect(a, b):
-  return [max(a[0], b[0]), min(a[1], b[1])]
+  return [smax(a[0], b[0]), smin(a[1], b[1])]
 
 def intervalIsEmpty(a):
-  return a[1] <= a[0]
+  if type(a[0]) in num_types and type(a[1]) in num_types:
+    return a[1] <= a[0]
+  return sign(a[1], a[0]) <= 0
 
 
 # Represents a box
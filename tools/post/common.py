@@ -19,6 +19,9 @@ class options:
   flag_ignore_conds = False # conservatively assume *all* code within *all* conditional blocks are executed
   flag_verbose_conditionals = False
   flag_verbose_parser = False
+  flag_verbose_reuse = True # print the per-loop reuse report from the traffic model
+  expr_backend = 'sympy' # see expr.py: 'fast' avoids importing sympy when parameters are substituted
+  memo_n = 10000 # analysis results kept per memo, least recently used are dropped (see analyze.Memo)
   warned = set()
 
 def numIters(x):
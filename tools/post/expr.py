@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+
+""" Expression layer for parameters, loop bounds and array offsets.
+
+    The XML contains small integer expressions such as "lo(3) - ng" or
+    "hi(1) + 1 - (ilo2 - 1)".  When parameters are substituted up front
+    (subparams=True) every one of them ends up as an integer, so paying for
+    the sympy import is wasted.  This module offers three backends:
+
+      fast:      a tiny polynomial evaluator (Poly) that handles +, -, *, / by
+                 constants and integer powers over named symbols, including
+                 function-call style names like lo(3).
+      symengine: the compiled symengine library, preferred for symbolic
+                 (subparams=False) analyses when it is installed.
+      sympy:     sympy.parsing.sympy_parser.parse_expr, imported on first use.
+
+    All backends return objects supporting the operations the analysis
+    needs (arithmetic, xreplace, subs, int()); use has() from this module
+    rather than the has() method, whose semantics differ between libraries.
+    If the fast or symengine backend cannot represent an expression it
+    raises ExprError, and callers can retry with the sympy backend using
+    with_fallback().
+"""
+__author__ = "Cy Chan"
+__copyright__ = "Copyright 2016, The Regents of the University of California, through Lawrence Berkeley National Laboratory"
+__credits__ = ["Cy Chan"]
+__license__ = "Modified BSD License (see LICENSE file)"
+__version__ = "2.0"
+__maintainer__ = "Cy Chan"
+__email__ = "cychan@lbl.gov"
+__status__ = "Production"
+
+import re
+import copy
+from fractions import Fraction
+
+from common import options
+
+backends = ['fast', 'sympy', 'symengine']
+
+# names that sympy would interpret as functions rather than symbols
+reserved = set(['max', 'min', 'abs', 'mod', 'Max', 'Min', 'Abs', 'Mod', 'sqrt', 'exp', 'log',
+                'floor', 'ceiling', 'int', 'float', 'sin', 'cos', 'tan', 'sign'])
+
+
+class ExprError(Exception):
+  """Raised when the fast backend cannot represent an expression."""
+  pass
+
+
+def number(x):
+  """Normalizes a Fraction coefficient to an int when it is integral."""
+  if type(x) == Fraction and x.denominator == 1:
+    return int(x.numerator)
+  return x
+
+
+class Poly(object):
+  """Polynomial over named symbols with numeric coefficients.
+
+     terms maps a monomial, a sorted tuple of (symbol, power) pairs, to its
+     coefficient.  The constant term has the empty monomial ()."""
+  __slots__ = ['terms', 'hash_']
+  def __init__(self, terms = None):
+    self.terms = dict(filter(lambda (m, c): c != 0, terms.items())) if terms else {}
+    self.hash_ = None
+
+  @staticmethod
+  def symbol(name):
+    return Poly({((name, 1),): 1})
+
+  @staticmethod
+  def const(c):
+    return Poly({(): c})
+
+  @staticmethod
+  def lift(x):
+    if isinstance(x, Poly):
+      return x
+    if type(x) in [int, long, float, Fraction]:
+      return Poly.const(x)
+    raise ExprError("cannot combine expression with %s" % type(x))
+
+  # queries
+
+  @property
+  def is_number(self):
+    return all(map(lambda m: m == (), self.terms.keys()))
+  def value(self):
+    if not self.is_number:
+      raise ExprError("expression is not constant: %s" % self)
+    return number(self.terms.get((), 0))
+  def isSymbol(self):
+    return len(self.terms) == 1 and self.terms.values()[0] == 1 and \
+           len(self.terms.keys()[0]) == 1 and self.terms.keys()[0][0][1] == 1
+  def symbols(self):
+    return set([s for m in self.terms for (s, p) in m])
+  def has(self, other):
+    """True if other (a symbol, or a sum of terms) appears in this expression."""
+    other = Poly.lift(other)
+    if other.isSymbol():
+      return other.terms.keys()[0][0][0] in self.symbols()
+    return all(map(lambda (m, c): self.terms.get(m, 0) == c, other.terms.items()))
+  def __int__(self):
+    return int(self.value())
+  def __long__(self):
+    return long(self.value())
+  def __float__(self):
+    return float(self.value())
+  def __nonzero__(self):
+    return len(self.terms) > 0
+
+  # substitution
+
+  def xreplace(self, repl):
+    """Replaces symbols (keys that are single symbols) and whole expressions."""
+    if self in repl:
+      return Poly.lift(repl[self])
+    syms = {}
+    for (k, v) in repl.items():
+      if isinstance(k, Poly) and k.isSymbol():
+        syms[k.terms.keys()[0][0][0]] = Poly.lift(v)
+    if not syms:
+      return self
+    result = Poly()
+    for (m, c) in self.terms.items():
+      t = Poly.const(c)
+      for (s, p) in m:
+        t = t * (syms[s] ** p if s in syms else Poly({((s, p),): 1}))
+      result = result + t
+    return result
+  def subs(self, repl):
+    return self.xreplace(repl)
+
+  # arithmetic
+
+  def __add__(self, other):
+    other = Poly.lift(other)
+    terms = dict(self.terms)
+    for (m, c) in other.terms.items():
+      terms[m] = number(terms.get(m, 0) + c)
+    return Poly(terms)
+  __radd__ = __add__
+  def __neg__(self):
+    return Poly(dict(map(lambda (m, c): (m, -c), self.terms.items())))
+  def __pos__(self):
+    return self
+  def __sub__(self, other):
+    return self + (-Poly.lift(other))
+  def __rsub__(self, other):
+    return Poly.lift(other) - self
+  def __mul__(self, other):
+    other = Poly.lift(other)
+    terms = {}
+    for (m1, c1) in self.terms.items():
+      for (m2, c2) in other.terms.items():
+        powers = dict(m1)
+        for (s, p) in m2:
+          powers[s] = powers.get(s, 0) + p
+        m = tuple(sorted(powers.items()))
+        terms[m] = number(terms.get(m, 0) + c1 * c2)
+    return Poly(terms)
+  __rmul__ = __mul__
+  def __div__(self, other):
+    other = Poly.lift(other)
+    if not other.is_number or other.value() == 0:
+      raise ExprError("division by non-constant expression: %s" % other)
+    d = other.value()
+    def div(c):
+      if type(c) == float or type(d) == float:
+        return c / float(d)
+      return number(Fraction(c) / d)
+    return Poly(dict(map(lambda (m, c): (m, div(c)), self.terms.items())))
+  __truediv__ = __div__
+  def __rdiv__(self, other):
+    return Poly.lift(other) / self
+  __rtruediv__ = __rdiv__
+  def __pow__(self, n):
+    if type(n) == Poly:
+      n = n.value()
+    if type(n) not in [int, long] or n < 0:
+      raise ExprError("unsupported exponent: %s" % n)
+    result = Poly.const(1)
+    for i in xrange(n):
+      result = result * self
+    return result
+
+  # comparison (only meaningful for constants)
+
+  def __eq__(self, other):
+    try:
+      other = Poly.lift(other)
+    except ExprError:
+      return False
+    return self.terms == other.terms
+  def __ne__(self, other):
+    return not self.__eq__(other)
+  def __lt__(self, other):
+    return self.value() < Poly.lift(other).value()
+  def __le__(self, other):
+    return self.value() <= Poly.lift(other).value()
+  def __gt__(self, other):
+    return self.value() > Poly.lift(other).value()
+  def __ge__(self, other):
+    return self.value() >= Poly.lift(other).value()
+  def __hash__(self):
+    if self.hash_ is None:
+      if self.is_number:
+        self.hash_ = hash(self.value()) # consistent with == on plain numbers
+      else:
+        self.hash_ = hash(frozenset(self.terms.items()))
+    return self.hash_
+
+  def __str__(self):
+    if not self.terms:
+      return "0"
+    def monoStr(m):
+      return '*'.join(map(lambda (s, p): s if p == 1 else '%s**%d' % (s, p), m))
+    # symbols in alphabetical order, constant last (as sympy prints simple sums)
+    s = ''
+    for (m, c) in sorted(self.terms.items(), key=lambda (m, c): (m == (), m)):
+      if m == ():
+        t = str(abs(c))
+      elif abs(c) == 1:
+        t = monoStr(m)
+      else:
+        t = '%s*%s' % (abs(c), monoStr(m))
+      if s:
+        s += (' - ' if c < 0 else ' + ') + t
+      else:
+        s = ('-' if c < 0 else '') + t
+    return s
+  __repr__ = __str__
+
+# tokenizer and recursive descent parser for the fast backend
+
+token_re = re.compile(r'\s*(?:(\d+\.\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?|\d+)|([A-Za-z_]\w*)|(\*\*|[-+*/(),]))')
+
+def tokenize(s):
+  tokens = []
+  pos = 0
+  s = s.rstrip()
+  while pos < len(s):
+    m = token_re.match(s, pos)
+    if not m:
+      raise ExprError("cannot parse '%s' at '%s'" % (s, s[pos:]))
+    (num, name, op) = m.groups()
+    if num is not None:
+      tokens.append(('num', float(num) if ('.' in num or 'e' in num or 'E' in num) else int(num)))
+    elif name is not None:
+      tokens.append(('name', name))
+    else:
+      tokens.append(('op', op))
+    pos = m.end()
+  return tokens
+
+class FastParser(object):
+  __slots__ = ['s', 'tokens', 'pos']
+  def __init__(self, s):
+    self.s = s
+    self.tokens = tokenize(s)
+    self.pos = 0
+  def peek(self):
+    return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+  def accept(self, op):
+    if self.peek() == ('op', op):
+      self.pos += 1
+      return True
+    return False
+  def expect(self, op):
+    if not self.accept(op):
+      raise ExprError("expected '%s' in '%s'" % (op, self.s))
+  def parse(self):
+    result = self.expr()
+    if self.pos != len(self.tokens):
+      raise ExprError("unexpected '%s' in '%s'" % (self.peek()[1], self.s))
+    return result
+  def expr(self):
+    result = self.term()
+    while True:
+      if self.accept('+'):
+        result = result + self.term()
+      elif self.accept('-'):
+        result = result - self.term()
+      else:
+        return result
+  def term(self):
+    result = self.unary()
+    while True:
+      if self.accept('*'):
+        result = result * self.unary()
+      elif self.accept('/'):
+        result = result / self.unary()
+      else:
+        return result
+  def unary(self):
+    if self.accept('-'):
+      return -self.unary()
+    if self.accept('+'):
+      return self.unary()
+    return self.power()
+  def power(self):
+    result = self.atom()
+    if self.accept('**'):
+      result = result ** self.unary()
+    return result
+  def atom(self):
+    (kind, val) = self.peek()
+    self.pos += 1
+    if kind == 'num':
+      return Poly.const(val)
+    if kind == 'name':
+      if val in reserved:
+        raise ExprError("function '%s' not supported in '%s'" % (val, self.s))
+      if self.accept('('):
+        # function-call style names (e.g. lo(3)) are treated as opaque symbols
+        args = self.exprList()
+        return Poly.symbol('%s(%s)' % (val, ', '.join(map(str, args))))
+      return Poly.symbol(val)
+    if (kind, val) == ('op', '('):
+      items = self.exprList()
+      return items[0] if len(items) == 1 else tuple(items)
+    raise ExprError("unexpected '%s' in '%s'" % (val, self.s))
+  def exprList(self):
+    items = [self.expr()]
+    while self.accept(','):
+      items.append(self.expr())
+    self.expect(')')
+    return items
+
+
+def parse_fast(s):
+  return FastParser(s).parse()
+
+def parse_sympy(s):
+  from sympy.parsing.sympy_parser import parse_expr, TokenError
+  try:
+    result = parse_expr(s)
+  except (SyntaxError, TokenError) as e:
+    raise ExprError("sympy cannot parse '%s': %s" % (s, e))
+  if isinstance(result, basestring):
+    raise ExprError("'%s' is a string literal, not an expression" % s)
+  return result
+
+def split_tuple(s):
+  """Splits "(a, b(1), c)" at its top-level commas, or returns None if s is not a tuple."""
+  s = s.strip()
+  if not (s.startswith('(') and s.endswith(')')):
+    return None
+  (items, depth, start) = ([], 0, 1)
+  for (i, c) in enumerate(s):
+    if c == '(':
+      depth += 1
+    elif c == ')':
+      depth -= 1
+      if depth == 0 and i != len(s) - 1:
+        return None # e.g. "(a) + (b)"
+    elif c == ',' and depth == 1:
+      items.append(s[start:i])
+      start = i + 1
+  return items + [s[start:-1]] if items else None
+
+def import_symengine():
+  """Imports symengine and registers its (immutable) expression types as
+     atomic for deepcopy, since the wrapped C++ objects cannot be pickled."""
+  import symengine
+  if symengine.Basic not in copy._deepcopy_dispatch:
+    pending = [symengine.Basic]
+    while pending:
+      cls = pending.pop()
+      copy._deepcopy_dispatch[cls] = copy._deepcopy_atomic
+      pending.extend(cls.__subclasses__())
+  return symengine
+
+def parse_symengine(s):
+  symengine = import_symengine()
+  items = split_tuple(s)
+  if items is not None:
+    return tuple(map(parse_symengine, items))
+  try:
+    # symengine only accepts byte strings, while minidom attributes are unicode
+    return symengine.sympify(str(s))
+  except (RuntimeError, symengine.SympifyError) as e:
+    raise ExprError("symengine cannot parse '%s': %s" % (s, e))
+
+parsers = {
+  'fast'      : parse_fast,
+  'sympy'     : parse_sympy,
+  'symengine' : parse_symengine,
+}
+
+def symbolic_backend():
+  """Preferred backend for symbolic analyses: symengine if installed, else sympy."""
+  try:
+    import symengine
+    return 'symengine'
+  except ImportError:
+    return 'sympy'
+
+def set_backend(name):
+  if name not in parsers:
+    raise Exception("Unknown expression backend: %s (choose from %s)" % (name, ', '.join(backends)))
+  options.expr_backend = name
+
+def parse(s):
+  """Parses a string into an expression (or tuple of expressions) of the current backend."""
+  return parsers[options.expr_backend](s)
+
+def has(e, sub):
+  """True if sub (a symbol, or a sum of terms) appears in expression e.
+
+     For sums this follows sympy's Basic.has, i.e. the terms of sub must be
+     a subset of the terms of e."""
+  if isinstance(e, Poly) or options.expr_backend != 'symengine':
+    return e.has(sub)
+  import symengine
+  if type(sub) == symengine.Add:
+    terms = set(e.args) if type(e) == symengine.Add else set([e])
+    return set(sub.args) <= terms
+  # symengine's has() only accepts plain symbols, so test by substitution
+  return e.subs({sub: symengine.Symbol('__has_dummy__')}) != e
+
+def with_fallback(f):
+  """Calls f() with the current backend, retrying with sympy if the fast or
+     symengine backend cannot represent one of the expressions encountered."""
+  try:
+    return f()
+  except ExprError as e:
+    if options.expr_backend == 'sympy':
+      raise
+    print "WARNING: %s; falling back to the sympy expression backend" % e
+    set_backend('sympy')
+    return f()
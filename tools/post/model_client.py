@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+""" Thin client for the ExaSAT model server (see model_server.py).
+
+    Example:
+      client = ModelClient(socket_path="/tmp/exasat.sock")
+      summary = client.evaluate("cns", machine="../../examples/machine.xml", subparams="True")
+"""
+__author__ = "Cy Chan"
+__copyright__ = "Copyright 2016, The Regents of the University of California, through Lawrence Berkeley National Laboratory"
+__credits__ = ["Cy Chan"]
+__license__ = "Modified BSD License (see LICENSE file)"
+__version__ = "2.0"
+__maintainer__ = "Cy Chan"
+__email__ = "cychan@lbl.gov"
+__status__ = "Production"
+
+import sys
+import os
+import json
+import socket
+import httplib
+
+
+class ModelServerError(Exception):
+  pass
+
+
+class ModelClient(object):
+  """Sends JSON requests to a model server over a Unix socket or localhost HTTP."""
+  __slots__ = ['socket_path', 'host', 'port', 'timeout']
+  def __init__(self, socket_path = None, host = 'localhost', port = 8642, timeout = None):
+    self.socket_path = socket_path
+    self.host = host
+    self.port = port
+    self.timeout = timeout
+
+  def request(self, request):
+    if self.socket_path:
+      response = self.request_unix(request)
+    else:
+      response = self.request_http(request)
+    if response["status"] != "ok":
+      raise ModelServerError(response["message"])
+    return response["result"]
+
+  def request_unix(self, request):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(self.timeout)
+    try:
+      s.connect(self.socket_path)
+      f = s.makefile('rw')
+      f.write(json.dumps(request) + '\n')
+      f.flush()
+      line = f.readline()
+      f.close()
+    finally:
+      s.close()
+    if not line:
+      raise ModelServerError("Connection closed by server")
+    return json.loads(line)
+
+  def request_http(self, request):
+    conn = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+    try:
+      conn.request("POST", "/", json.dumps(request), {"Content-Type": "application/json"})
+      body = conn.getresponse().read()
+    finally:
+      conn.close()
+    return json.loads(body)
+
+  def ping(self):
+    return self.request({"op": "ping"})
+
+  def programs(self):
+    return self.request({"op": "programs"})
+
+  def evaluate(self, program, **kwargs):
+    """program is a preset name ("cns", "smc") or a dict with xml, polly, symsubs, namesubs.
+
+       kwargs may give params, block_params, conds, machine, subparams."""
+    request = {"op": "evaluate", "program": program}
+    request.update(kwargs)
+    return self.request(request)
+
+
+def main(args):
+  """Evaluate a preset program once and print the per-loop summary."""
+  client = ModelClient(socket_path=os.getenv("server_socket", None),
+                       port=int(os.getenv("server_port", "8642")))
+  kwargs = {}
+  for tag in ["params", "block_params", "conds", "machine", "subparams"]:
+    val = os.getenv(tag, None)
+    if val:
+      kwargs[tag] = val
+  for function in client.evaluate(args[1], **kwargs):
+    print "%s: traffic=%s bytes" % (function['name'], function['traffic_bytes'])
+    for loop in function['loops']:
+      print "  Loop %4d: A=%s M=%s D=%s S=%s WS=%s bytes, traffic=%s bytes" % \
+            (loop['linenum'], loop['adds'], loop['multiplies'], loop['divides'], loop['specials'],
+             loop['ws_bytes'], loop['traffic_bytes'])
+
+if __name__ == '__main__':
+  if len(sys.argv) < 2:
+    print "Usage: <me> <program-preset>"
+    sys.exit(1)
+  main(sys.argv)
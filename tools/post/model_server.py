@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+""" Long-lived model server for the ExaSAT performance model.
+
+    Parsing a program XML (and importing sympy) dominates the run time of
+    short analyses, so this server keeps parsed StaticAnalysis objects in
+    an LRU cache and answers JSON queries against them.  It listens either
+    on a Unix domain socket (one JSON request per line, one JSON response
+    per line) or on a localhost HTTP port (JSON request in a POST body).
+
+    A request looks like:
+      { "op"           : "evaluate",
+        "program"      : "cns" or { "xml": ..., "symsubs": ..., "namesubs": ..., "polly": ... },
+        "params"       : <params-XML-file>,
+        "block_params" : <block-params-XML-file>,
+        "machine"      : <machine-XML-file>,
+        "conds"        : <conds-XML-file>,
+        "subparams"    : "True" }
+    Other ops are "ping" and "programs" (list the programs currently loaded).
+    See model_client.py for a thin client library.
+"""
+__author__ = "Cy Chan"
+__copyright__ = "Copyright 2016, The Regents of the University of California, through Lawrence Berkeley National Laboratory"
+__credits__ = ["Cy Chan"]
+__license__ = "Modified BSD License (see LICENSE file)"
+__version__ = "2.0"
+__maintainer__ = "Cy Chan"
+__email__ = "cychan@lbl.gov"
+__status__ = "Production"
+
+import sys
+import os
+import json
+import threading
+import traceback
+import SocketServer
+import BaseHTTPServer
+from collections import OrderedDict
+
+from analyze import StaticAnalysis
+from common import options
+import expr
+import run_model
+
+# named program setups that can be requested by id instead of by file names
+presets = {
+  "cns" : run_model.cns_args,
+  "smc" : run_model.smc_args,
+}
+
+program_tags = ["xml", "polly", "symsubs", "namesubs"]
+model_tags = ["params", "block_params", "conds", "machine", "subparams"]
+
+
+def to_json_value(x):
+  """Numeric results are passed through, symbolic results are sent as strings."""
+  if type(x) in [int, long, float, bool] or x is None:
+    return x
+  if type(x) in [list, tuple]:
+    return map(to_json_value, x)
+  try:
+    return float(x) if x.is_number else str(x)
+  except (AttributeError, TypeError):
+    # sympy reports unevaluated calls like hi(1) as numbers
+    return str(x)
+
+def to_json_summary(summary):
+  def convert(d):
+    return dict(map(lambda (k, v): (k, to_json_value(v)), d.items()))
+  result = []
+  for function in summary:
+    f = convert(dict(filter(lambda (k, v): k != 'loops', function.items())))
+    f['loops'] = map(convert, function['loops'])
+    result.append(f)
+  return result
+
+
+class ProgramCache(object):
+  """LRU cache of parsed programs, keyed by the files used to parse them."""
+  __slots__ = ['capacity', 'programs', 'loading', 'lock', 'hits', 'misses']
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self.programs = OrderedDict()
+    self.loading = {} # key: Event set once the program is parsed (or failed)
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+  def get(self, args):
+    key = tuple(map(lambda x: args[x], program_tags))
+    # parsing is done outside the lock so requests for other programs are
+    # not held up, and a program is only parsed once even if several
+    # clients ask for it at the same time: the others wait for its Event
+    while True:
+      with self.lock:
+        if key in self.programs:
+          self.hits += 1
+          sa = self.programs.pop(key)
+          self.programs[key] = sa # reinsert as most recently used
+          return sa
+        loaded = self.loading.get(key, None)
+        if loaded is None:
+          self.misses += 1
+          loaded = self.loading[key] = threading.Event()
+          break
+      # parsed by another request, look again (or parse it if that failed)
+      loaded.wait()
+    try:
+      sa = StaticAnalysis(**run_model.load_program_args(args))
+      with self.lock:
+        while len(self.programs) >= self.capacity:
+          self.programs.popitem(last=False) # evict least recently used
+        self.programs[key] = sa
+      return sa
+    finally:
+      with self.lock:
+        del self.loading[key]
+      loaded.set()
+  def keys(self):
+    with self.lock:
+      return self.programs.keys()
+
+
+class ModelService(object):
+  """Answers decoded JSON requests using the cached programs."""
+  __slots__ = ['cache']
+  def __init__(self, capacity):
+    self.cache = ProgramCache(capacity)
+
+  def request_args(self, request):
+    program = request.get("program", None)
+    if program in presets:
+      args = presets[program]()
+    elif type(program) == dict:
+      args = run_model.default_args()
+      args.update(program)
+    else:
+      raise Exception("Unknown program: %s" % program)
+    for tag in model_tags:
+      if tag in request:
+        args[tag] = request[tag]
+    return args
+
+  def evaluate(self, request):
+    args = self.request_args(request)
+    sa = self.cache.get(args)
+    return to_json_summary(sa.summary(**run_model.load_model_args(args)))
+
+  def handle(self, request):
+    try:
+      op = request.get("op", "evaluate")
+      if op == "ping":
+        result = "pong"
+      elif op == "programs":
+        result = {"loaded" : map(lambda x: dict(zip(program_tags, x)), self.cache.keys()),
+                  "hits"   : self.cache.hits,
+                  "misses" : self.cache.misses}
+      elif op == "evaluate":
+        result = self.evaluate(request)
+      else:
+        raise Exception("Unknown op: %s" % op)
+      return {"status": "ok", "result": result}
+    except Exception as e:
+      if options.flag_debug:
+        traceback.print_exc()
+      return {"status": "error", "message": str(e)}
+
+
+class UnixRequestHandler(SocketServer.StreamRequestHandler):
+  """One JSON request per line, answered with one JSON response per line."""
+  def handle(self):
+    for line in iter(self.rfile.readline, ''):
+      if not line.strip():
+        continue
+      try:
+        response = self.server.service.handle(json.loads(line))
+      except ValueError as e:
+        response = {"status": "error", "message": "Invalid JSON: %s" % e}
+      self.wfile.write(json.dumps(response) + '\n')
+      self.wfile.flush()
+
+class HTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """JSON request in the body of a POST, GET is equivalent to a ping."""
+  def reply(self, response):
+    body = json.dumps(response)
+    self.send_response(200 if response["status"] == "ok" else 400)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+  def do_GET(self):
+    self.reply(self.server.service.handle({"op": "ping"}))
+  def do_POST(self):
+    length = int(self.headers.getheader('content-length', 0))
+    try:
+      request = json.loads(self.rfile.read(length))
+    except ValueError as e:
+      self.reply({"status": "error", "message": "Invalid JSON: %s" % e})
+      return
+    self.reply(self.server.service.handle(request))
+  def log_message(self, format, *args):
+    if options.flag_debug:
+      BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class ThreadingUnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  daemon_threads = True
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+def make_server(socket_path = None, port = None, capacity = 8):
+  if socket_path:
+    if os.path.exists(socket_path):
+      os.remove(socket_path) # stale socket from a previous run
+    server = ThreadingUnixServer(socket_path, UnixRequestHandler)
+  else:
+    server = ThreadingHTTPServer(('localhost', port), HTTPRequestHandler)
+  server.service = ModelService(capacity)
+  return server
+
+def main(cl_args):
+  """Environment variables:
+       server_socket=<path>: listen on a Unix domain socket, or
+       server_port=<port>:   listen on localhost HTTP port (default 8642)
+       server_cache_n=<n>:   number of parsed programs kept in memory (default 8)
+       server_memo_n=<n>:    analysis results kept per program (default 10000)"""
+  socket_path = os.getenv("server_socket", None)
+  port = int(os.getenv("server_port", "8642"))
+  capacity = int(os.getenv("server_cache_n", "8"))
+  options.memo_n = int(os.getenv("server_memo_n", str(options.memo_n)))
+
+  # per-loop reports from concurrent requests would be interleaved on stdout
+  options.flag_verbose_reuse = False
+  # cached programs may be queried both symbolically and numerically, and the
+  # import cost of sympy is only paid once by a long-lived server
+  expr.set_backend('sympy')
+
+  server = make_server(socket_path, port, capacity)
+  print "ExaSAT model server listening on %s" % (socket_path if socket_path else "localhost:%d" % port)
+  sys.stdout.flush()
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    if socket_path and os.path.exists(socket_path):
+      os.remove(socket_path)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
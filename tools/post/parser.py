@@ -5,7 +5,7 @@
     This module contains classes to represent different parts of the program:
       A file contains a set of functions.
       A function contain a body.
-      A body contains a set of code blocks and a set of loops, each guarded by a set of conditionals.
+      A body contains a set of code blocks, loops and function calls, each guarded by a set of conditionals.
       A code block contains a set of flops, and a set of scalar and array accesses.
       A loop contains a body.
     Each class supports the "collect" traversal routine that aids in traversing the code tree.
@@ -24,7 +24,7 @@ import ast
 import operator
 import copy
 import re
-from sympy.parsing.sympy_parser import parse_expr
+import expr
 
 from box import Box
 from collection import Collection
@@ -45,7 +45,7 @@ def dprint(s):
     print s
 
 def to_sym_dict(list_of_pairs):
-  return dict(map(lambda (x,y): (parse_expr(x), parse_expr(y)), list_of_pairs))
+  return dict(map(lambda (x,y): (expr.parse(x), expr.parse(y)), list_of_pairs))
 
 # direct text replacement using string replace
 def doTextRepl(s, textsubs):
@@ -53,11 +53,11 @@ def doTextRepl(s, textsubs):
     s = re.sub(sub[0], sub[1], s)
   return s
 
-# symbolic replacement using sympy xreplace
-def doSymRepl(expr, repl):
-  if type(expr) == type('') or type(expr) == unicode:
-    expr = parse_expr(expr)
-  return expr.xreplace(repl)
+# symbolic replacement using xreplace (see expr.py for the expression backends)
+def doSymRepl(e, repl):
+  if type(e) == type('') or type(e) == unicode:
+    e = expr.parse(e)
+  return e.xreplace(repl)
 
 def parseExpr(s, symsubs):
   s = doTextRepl(s, textsubs)
@@ -88,7 +88,7 @@ def subToInt(x, params):
 
 def arrayName(name, component, namesubs):
   if component != '':
-    component = parse_expr(component).subs(namesubs)
+    component = expr.parse(component).subs(namesubs)
     return '%s.%s' % (name, component)
   else:
     return name
@@ -103,9 +103,9 @@ def getChildren(node, tag):
 
 class Flops(object):
   slots = ['adds', 'multiplies', 'divides', 'specials']
-  def __init__(self, node):
+  def __init__(self, node = None):
     for x in self.slots:
-      self.__setattr__(x, int(node.getAttribute(x)))
+      self.__setattr__(x, int(node.getAttribute(x)) if node else 0)
     dprint(self)
   def __str__(self):
     return "Flops(%g, %g, %g, %g)" % \
@@ -158,6 +158,10 @@ class ArrayAccess(object):
     result.reads = self.reads
     result.writes = self.writes
     return result
+  def renameLoopvars(self, names):
+    result = ArrayAccess(index=self.index, reads=self.reads, writes=self.writes)
+    result.loopvars = tuple(map(lambda x: names.get(x, x), self.loopvars))
+    return result
 
 
 class Array(object):
@@ -178,6 +182,12 @@ class Array(object):
     result.type = self.type
     result.accesses = map(lambda x: x.subParams(params), self.accesses)
     return result
+  def renameLoopvars(self, names):
+    result = Array()
+    result.name = self.name
+    result.type = self.type
+    result.accesses = map(lambda x: x.renameLoopvars(names), self.accesses)
+    return result
 
 
 class CodeBlock(object):
@@ -208,6 +218,13 @@ class CodeBlock(object):
     result.arrays = map(lambda x: x.subParams(params), self.arrays)
     result.conds = self.conds
     return result
+  def renameLoopvars(self, names):
+    result = CodeBlock()
+    result.flops = self.flops
+    result.scalars = self.scalars
+    result.arrays = map(lambda x: x.renameLoopvars(names), self.arrays)
+    result.conds = self.conds
+    return result
 
 
 class Conditional(object):
@@ -225,10 +242,28 @@ class Conditional(object):
     return "Conditional: " + str((self.linenum, self.condition, self.when))
 
 
+class FuncCall(object):
+  """A call to another function, with the actual argument passed for each formal parameter."""
+  slots = ['name', 'linenum', 'args', 'conds']
+  def __init__(self, node, conds = [], env = None):
+    self.name = str(node.getAttribute('origname'))
+    self.linenum = int(node.getAttribute('linenum'))
+    # (formal, actual) pairs, formals may be unknown ('') for external functions
+    self.args = map(lambda x: (str(x.getAttribute('paramname')), str(x.getAttribute('argname'))),
+                    getChildren(node, 'arg'))
+    self.conds = conds
+    dprint(self)
+  def __str__(self):
+    return "Call %d: %s(%s), %s" % \
+           (self.linenum, self.name, ', '.join(map(lambda (f, a): '%s=%s' % (f, a), self.args)),
+            str(map(str, self.conds)))
+
+
 class Body(object):
-  """A function or loop body: contains information on enclosed code blocks and loops."""
-  slots = ['codeblocks', 'loops']
+  """A function or loop body: contains information on enclosed code blocks, loops and calls."""
+  slots = ['codeblocks', 'loops', 'calls']
   def __init__(self, node = None, conds = [], env = None):
+    self.calls = []
 
     """Does recursive traversal of conditional blocks within body."""
     def traverse(node, tag, conds):
@@ -257,6 +292,7 @@ class Body(object):
     if node:
       self.codeblocks = map(lambda x: CodeBlock(*x), sorted(traverse(node, None, conds), key=sort_key))
       self.loops = map(lambda x: Loop(*x), sorted(traverse(node, 'loop', conds), key=sort_key))
+      self.calls = map(lambda x: FuncCall(*x), sorted(traverse(node, 'funccall', conds), key=sort_key))
 
   def collect(self, f):
     return Collection(colls = map(lambda x: x.collect(f), self.codeblocks) + \
@@ -265,6 +301,13 @@ class Body(object):
     result = Body()
     result.codeblocks = map(lambda x: x.subParams(params), self.codeblocks)
     result.loops = map(lambda x: x.subParams(params), self.loops)
+    result.calls = self.calls
+    return result
+  def renameLoopvars(self, names):
+    result = Body()
+    result.codeblocks = map(lambda x: x.renameLoopvars(names), self.codeblocks)
+    result.loops = map(lambda x: x.renameLoopvars(names), self.loops)
+    result.calls = self.calls
     return result
 
 
@@ -302,12 +345,12 @@ class Loop(object):
     for (orig_range, blocked_range) in block_params.items():
       # check to see if loop matches the orig_range params
       if (type(self.range[0]) != int and \
-          self.range[0].has(orig_range[0]) and \
+          expr.has(self.range[0], orig_range[0]) and \
           type(self.range[1]) != int and \
-          self.range[1].has(orig_range[1])) or \
+          expr.has(self.range[1], orig_range[1])) or \
          (self.range[0] == 0 and \
           type(self.range[1]) != int and \
-          self.range[1].has(orig_range[1] - orig_range[0])):
+          expr.has(self.range[1], orig_range[1] - orig_range[0])):
         return self.copy(blocked_range)
     return self
   def subParams(self, params, shallow = False):
@@ -316,6 +359,12 @@ class Loop(object):
     if not shallow:
       result.body = self.body.subParams(params)
     return result
+  def renameLoopvars(self, names):
+    """Copy with loop variables renamed (names maps old to new names)."""
+    result = self.copy()
+    result.loopvar = names.get(self.loopvar, self.loopvar)
+    result.body = self.body.renameLoopvars(names)
+    return result
 
 
 class Function(object):
@@ -432,3 +481,42 @@ class PollyXMLParser(object):
     self.doc = xml.dom.minidom.parse(filename)
     program = getChildren(self.doc, 'program')[0]
     self.scops = map(PollyScop, getChildren(program, 'scop'))
+
+# parser for XML generated by the PIN loop profiler
+
+class PinLoop(object):
+  """Measured counts of a loop, totals over all entries of the loop."""
+  __slots__ = ['num', 'linenum', 'counts']
+  counters = ['entries', 'iters', 'ops', 'reads', 'writes', 'bytereads', 'bytewrites',
+              'uniquereads', 'uniquewrites', 'adds', 'subs', 'muls', 'divs', 'cachehits', 'cachemisses']
+  def __init__(self, node):
+    # position in the loop tree, e.g. 2.1 is the first loop nested in loop 2
+    self.num = str(node.getAttribute('num'))
+    self.linenum = int(node.getAttribute('line'))
+    # counters missing from the profile (e.g. cachemisses) are left out
+    self.counts = dict(map(lambda x: (x, int(node.getAttribute(x))),
+                           filter(node.hasAttribute, PinLoop.counters)))
+    dprint("  Parsing PIN loop (%s, %s, %s) ..." % (self.num, self.linenum, self.counts))
+  def isTopLevel(self):
+    return '.' not in self.num
+  def encloses(self, other):
+    """True if other is this loop or nested in it."""
+    return other.num == self.num or other.num.startswith(self.num + '.')
+
+class PinFunction(object):
+  """Contains the profiled loops of a function."""
+  __slots__ = ['name', 'filename', 'loops']
+  def __init__(self, node):
+    self.name = str(node.getAttribute('name'))
+    self.filename = str(node.getAttribute('file'))
+    dprint("Parsing PIN function (%s, %s) ..." % (self.name, self.filename))
+    self.loops = map(PinLoop, getChildren(node, 'loop'))
+
+class PinXMLParser(object):
+  """Contains the per-loop counts measured by the PIN loop profiler."""
+  __slots__ = ['doc', 'functions']
+  def __init__(self, filename):
+    assert type(filename) == type('')
+    self.doc = xml.dom.minidom.parse(filename)
+    program = getChildren(self.doc, 'program')[0]
+    self.functions = map(PinFunction, getChildren(program, 'function'))
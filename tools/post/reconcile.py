@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+""" Reconciliation of the static model with PIN loop profiles.
+
+    The PIN loop profiler reports, per loop of each function, totals over
+    all entries of the loop: iterations, loads and stores (in bytes), the
+    unique addresses read and written, adds, subs, muls and divs, and
+    (with a cache simulator) cache hits and misses.  Each top-level loop
+    of the program is matched to a top-level PIN loop:
+
+      line   the PIN function is the same function (after removing the
+             Fortran module mangling, e.g. advance_module_ctoprim_ or
+             __advance_module_MOD_ctoprim) and the loop is on the same line
+      order  the function has as many unmatched top-level loops as the
+             PIN function, which are paired in order (the profiled source
+             is a different revision)
+      file   no PIN function has the same name (e.g. a flattened variant),
+             but a loop of the profiled source file is on the same line
+
+    File matches need the source file to be given (pin_file, matched
+    against the file name without the directory), which also restricts
+    the PIN functions considered; the profile covers library code too.
+
+    The measured counts of the whole PIN loop nest are divided by the
+    entries of its top-level loop (except the unique addresses, which
+    repeated entries touch again) and compared, per execution of the nest,
+    with the model evaluated with the given params (which must describe
+    the profiled run, e.g. the box size):
+
+      iters          iterations of the innermost loops
+      adds           adds + subs
+      multiplies     muls
+      divides        divs
+      bytereads      bytes loaded, vs the L1 loads of the register model
+      bytewrites     bytes stored, vs the L1 stores of the register model
+      unique_bytes   unique addresses read and written (each counted at
+                     the loop's average access size), vs the working set
+                     of the loop nest
+      traffic_bytes  cache misses * line_byte_n, vs the traffic model
+                     (only if the profile has cachemisses)
+
+    The error is (model - measured) / measured, and loops whose error
+    exceeds a threshold (default 25%) are flagged.
+"""
+__author__ = "Cy Chan"
+__copyright__ = "Copyright 2016, The Regents of the University of California, through Lawrence Berkeley National Laboratory"
+__credits__ = ["Cy Chan"]
+__license__ = "Modified BSD License (see LICENSE file)"
+__version__ = "2.0"
+__maintainer__ = "Cy Chan"
+__email__ = "cychan@lbl.gov"
+__status__ = "Production"
+
+import sys
+import os
+
+from analyze import FlopCount, totalBytes, frozenDict, get_type_byte_n
+from parser import PinXMLParser
+
+metrics = ["iters", "adds", "multiplies", "divides", "bytereads", "bytewrites", "unique_bytes", "traffic_bytes"]
+
+def demangle(name):
+  """Function name without the Fortran module prefix and trailing underscores."""
+  name = name.rstrip('_')
+  for sep in ['_MOD_', '_mp_', '_module_']:
+    if sep in name:
+      name = name.split(sep)[-1]
+  return name.lower()
+
+def nest(pin_function, top):
+  """PIN loops of the nest rooted at the top-level PIN loop top."""
+  return filter(top.encloses, pin_function.loops)
+
+def measured(pin_loops, machine):
+  """{metric: value per entry of the nest} of a PIN loop nest (top-level loop first)."""
+  entries = float(pin_loops[0].counts.get('entries', 1) or 1)
+  total = lambda x: sum(map(lambda y: y.counts.get(x, 0), pin_loops))
+  # loops without loops nested in them
+  leaves = filter(lambda x: not any(map(lambda y: y is not x and x.encloses(y), pin_loops)), pin_loops)
+  def unique(x):
+    accesses = x.counts.get('reads', 0) + x.counts.get('writes', 0)
+    byte_n = x.counts.get('bytereads', 0) + x.counts.get('bytewrites', 0)
+    return (x.counts.get('uniquereads', 0) + x.counts.get('uniquewrites', 0)) * \
+           (float(byte_n) / accesses if accesses else 0)
+  result = {
+    'iters'        : sum(map(lambda x: x.counts.get('iters', 0), leaves)),
+    'adds'         : total('adds') + total('subs'),
+    'multiplies'   : total('muls'),
+    'divides'      : total('divs'),
+    'bytereads'    : total('bytereads'),
+    'bytewrites'   : total('bytewrites'),
+  }
+  if any(map(lambda x: 'cachemisses' in x.counts, pin_loops)):
+    result['traffic_bytes'] = total('cachemisses') * machine['line_byte_n']
+  result = dict(map(lambda (k, v): (k, v / entries), result.items()))
+  # every entry touches the same addresses again, so these are not divided
+  result['unique_bytes'] = sum(map(unique, pin_loops))
+  return result
+
+def leaf_iters(loop, n = 1):
+  """Iterations of the innermost loops of a loop nest (parameters substituted)."""
+  n *= loop.iter_n()
+  if not loop.body.loops:
+    return n
+  return sum(map(lambda x: leaf_iters(x, n), loop.body.loops))
+
+def modeled(sa, sym_loop, params, block_params, machine, conds_chk):
+  """{metric: value} of a top-level loop, for one execution."""
+  colls = sa.collectLoop(sym_loop, params, block_params, machine, conds_chk, True,
+                         ['flops', 'registers', 'ws', 'traffic'])
+  flops = FlopCount.total(colls['flops'])
+  # pointers (e.g. array base addresses held in registers) are long words
+  byte_n = lambda x: machine['long_byte_n'] if '*' in x.type or '&' in x.type else get_type_byte_n(x.type, machine)
+  return {
+    'iters'         : leaf_iters(sa.memoize((sym_loop, 'loop', frozenDict(params)),
+                                            lambda: sym_loop.subParams(params))),
+    'adds'          : flops.adds,
+    'multiplies'    : flops.multiplies,
+    'divides'       : flops.divides,
+    'bytereads'     : sum(map(lambda x: x.l1_loads * byte_n(x), colls['registers'])),
+    'bytewrites'    : sum(map(lambda x: x.l1_stores * byte_n(x), colls['registers'])),
+    'unique_bytes'  : totalBytes(colls['ws']),
+    'traffic_bytes' : sum(map(lambda x: x.bytes(), colls['traffic'])),
+  }
+
+def match(functions, pin_functions, by_file = False):
+  """Pairs the top-level loops of the program with top-level PIN loops,
+     by line in any PIN function if by_file and none has the same name.
+
+     Returns a list of (function, loop, PinFunction or None, PinLoop or None, match kind)."""
+  result = []
+  for function in functions:
+    same = filter(lambda x: demangle(x.name) == function.name.lower(), pin_functions)
+    tops = sum(map(lambda f: map(lambda x: (f, x), filter(lambda x: x.isTopLevel(), f.loops)),
+                   same or (pin_functions if by_file else [])), [])
+    kind = 'line' if same else 'file'
+    pairs = dict(map(lambda x: (x, None), function.body.loops))
+    used = set()
+    for sym_loop in function.body.loops:
+      lines = filter(lambda x: x[1].linenum == sym_loop.linenum and x not in used, tops)
+      if lines:
+        pairs[sym_loop] = lines[0] + (kind,)
+        used.add(lines[0])
+    # a different revision of the same function
+    unmatched = filter(lambda x: pairs[x] is None, function.body.loops)
+    rest = filter(lambda x: x not in used, tops)
+    if same and unmatched and len(unmatched) == len(rest):
+      for (sym_loop, x) in zip(unmatched, rest):
+        pairs[sym_loop] = x + ('order',)
+    for sym_loop in function.body.loops:
+      result.append((function, sym_loop) + (pairs[sym_loop] or (None, None, '-')))
+  return result
+
+def error(model, measure):
+  if not measure or model is None:
+    return None
+  return (model - measure) / float(measure)
+
+def run_reconcile(args, pin_xml, threshold = 0.25, pin_file = None, out = sys.stdout):
+  """Writes a tab-separated table with the measured and modeled value and
+     the relative error of each metric per matched top-level loop, flagging
+     errors above threshold, followed per metric by the totals over the
+     matched loops and the number of loops flagged."""
+  from run_model import load_numeric_analysis
+
+  (sa, model_kw_args) = load_numeric_analysis(args)
+  machine = model_kw_args["machine"]
+
+  pin_functions = PinXMLParser(pin_xml).functions
+  if pin_file:
+    pin_functions = filter(lambda x: os.path.basename(x.filename) == pin_file, pin_functions)
+
+  pairs = match(sa.functions, pin_functions, bool(pin_file))
+  if not filter(lambda x: x[3], pairs):
+    print "WARNING: no loop of %s matches a loop of the PIN profile %s" % (args["xml"], pin_xml)
+
+  out.write('\t'.join(["function", "loop", "pin_function", "pin_line", "match", "metric",
+                       "measured", "model", "error", "flag"]) + '\n')
+  fmt = lambda v: "%g" % v if v is not None else "None"
+  sums = dict(map(lambda x: (x, [0, 0, 0, 0]), metrics)) # loops, measured, model, flagged
+  for (function, sym_loop, pin_function, pin_loop, kind) in pairs:
+    place = [function.name, str(sym_loop.linenum)]
+    if not pin_loop:
+      out.write('\t'.join(place + ["-", "-", kind] + ["-"] * 5) + '\n')
+      continue
+    meas = measured(nest(pin_function, pin_loop), machine)
+    model = modeled(sa, sym_loop, **model_kw_args)
+    for metric in filter(lambda x: x in meas, metrics):
+      e = error(model[metric], meas[metric])
+      flag = e is not None and abs(e) > threshold
+      out.write('\t'.join(place + [pin_function.name, str(pin_loop.linenum), kind, metric] +
+                          map(fmt, [meas[metric], model[metric], e]) + ["yes" if flag else "no"]) + '\n')
+      sums[metric] = map(sum, zip(sums[metric], [1, meas[metric], model[metric] or 0, 1 if flag else 0]))
+  for metric in metrics:
+    (n, meas, model, flagged) = sums[metric]
+    if n:
+      out.write('\t'.join(["all", "all", "-", "-", "%d loops" % n, metric] +
+                          map(fmt, [meas, model, error(model, meas)]) + [str(flagged)]) + '\n')
+  out.flush()
@@ -17,10 +17,14 @@ __status__ = "Production"
 
 import sys
 import os
+import glob
+import itertools
 from distutils.util import strtobool
 
-from analyze import StaticAnalysis, TableCondsChecker
+from analyze import StaticAnalysis, TableCondsChecker, Memo
 from parser import KeyValXMLParser, to_sym_dict
+from common import options
+import expr
 
 # default args
 def default_args():
@@ -34,6 +38,7 @@ def default_args():
     "conds"        : None,
     "machine"      : "../../examples/machine.xml",
     "subparams"    : "False",
+    "expr_backend" : None,
   }
 
 # setup for CNS code
@@ -49,6 +54,7 @@ def cns_args():
     "conds"        : "../../examples/cns-smc/conds.xml",
     "machine"      : "../../examples/machine.xml",
     "subparams"    : os.getenv("subparams", "False"),
+    "expr_backend" : os.getenv("expr_backend", None),
   }
 
 # setup for SMC code
@@ -74,25 +80,138 @@ def get_env_args():
               # bool: T: substitute parameters first for numeric results (faster)
               #       F: generate symbolic results in terms of the parameters (slower)
               "subparams", 
+              # expression backend (see expr.py), default depends on subparams
+              "expr_backend",
              ]:
     val = os.getenv(tag, None)
     if val:
       result[tag] = val
   return result
 
+def load_program_args(args):
+  """Keyword args for StaticAnalysis (what is needed to parse a program)."""
+  return { "xml"             : args["xml"],
+           "polly_xml"       : args["polly"],
+           "symsubs"         : to_sym_dict(KeyValXMLParser(args["symsubs"]).items),
+           "namesubs"        : to_sym_dict(KeyValXMLParser(args["namesubs"]).items),
+         }
+
+def load_model_args(args):
+  """Keyword args for StaticAnalysis.dump/summary (problem and machine setup)."""
+  return { "params"          : to_sym_dict(KeyValXMLParser(args["params"]).items),
+           "block_params"    : to_sym_dict(KeyValXMLParser(args["block_params"]).items),
+           "machine"         : dict(KeyValXMLParser(args["machine"], float).items),
+           "conds_chk"       : TableCondsChecker(KeyValXMLParser(args["conds"], float).items),
+           "flag_sub_params" : strtobool(args["subparams"]),
+         }
+
 def load_args(args):
-  return (
-    { "xml"             : args["xml"],
-      "polly_xml"       : args["polly"],
-      "symsubs"         : to_sym_dict(KeyValXMLParser(args["symsubs"]).items),
-      "namesubs"        : to_sym_dict(KeyValXMLParser(args["namesubs"]).items),
-    },
-    { "params"          : to_sym_dict(KeyValXMLParser(args["params"]).items),
-      "block_params"    : to_sym_dict(KeyValXMLParser(args["block_params"]).items),
-      "machine"         : dict(KeyValXMLParser(args["machine"], float).items),
-      "conds_chk"       : TableCondsChecker(KeyValXMLParser(args["conds"], float).items),
-      "flag_sub_params" : strtobool(args["subparams"]),
-    })
+  return (load_program_args(args), load_model_args(args))
+
+def select_expr_backend(args):
+  """Use the fast (sympy-free) expression backend when parameters are
+     substituted up front, and symengine (if installed) for symbolic runs,
+     unless a backend is chosen explicitly."""
+  backend = args.get("expr_backend", None)
+  if not backend:
+    backend = "fast" if strtobool(args["subparams"]) else expr.symbolic_backend()
+  expr.set_backend(backend)
+
+def load_numeric_analyses(args, xmls):
+  """Parses each of xmls (comma-separated lists of files, like the xml arg)
+     for the tables of numbers written by the analysis commands (mc,
+     fusion, scaling, ...): parameters are always substituted, the programs
+     share one memo, and the per-loop reuse reports, which would be
+     interleaved with the table, are turned off.
+
+     Returns ([StaticAnalysis per xml], keyword args for the model
+     without flag_sub_params)."""
+  args = dict(args, subparams="True")
+  memo = Memo()
+  def load():
+    model_kw_args = load_model_args(args)
+    return (map(lambda x: StaticAnalysis(memo=memo, **load_program_args(dict(args, xml=x))), xmls), model_kw_args)
+  select_expr_backend(args)
+  (programs, model_kw_args) = expr.with_fallback(load)
+  del model_kw_args["flag_sub_params"]
+  options.flag_verbose_reuse = False
+  return (programs, model_kw_args)
+
+def load_numeric_analysis(args):
+  """The program of args parsed for a table of numbers, see load_numeric_analyses."""
+  (programs, model_kw_args) = load_numeric_analyses(args, [args["xml"]])
+  return (programs[0], model_kw_args)
+
+# tags that may be given as a list of files in batch mode
+batch_tags = ["params", "block_params", "machine", "conds"]
+
+def expand_paths(val):
+  """Expands a comma-separated list of file names and/or glob patterns."""
+  if not val:
+    return [val]
+  result = []
+  for pattern in val.split(','):
+    pattern = pattern.strip()
+    matches = sorted(glob.glob(pattern))
+    if not matches and not glob.has_magic(pattern):
+      matches = [pattern] # let the XML parser report missing files
+    result.extend(matches)
+  return result
+
+def batch_loaders():
+  """Loaders that turn a file name into the corresponding load_model_args value."""
+  return {
+    "params"       : lambda x: to_sym_dict(KeyValXMLParser(x).items),
+    "block_params" : lambda x: to_sym_dict(KeyValXMLParser(x).items),
+    "machine"      : lambda x: dict(KeyValXMLParser(x, float).items),
+    "conds"        : lambda x: TableCondsChecker(KeyValXMLParser(x, float).items),
+  }
+
+def run_batch(args, out = sys.stdout):
+  """Evaluates the cross product of the params, block_params, machine and
+     conds file lists against a single parsed program.
+
+     Writes one combined tab-separated table with a row per
+     (configuration, function, loop)."""
+  paths = dict(map(lambda x: (x, expand_paths(args[x])), batch_tags))
+  loaders = batch_loaders()
+  flag_sub_params = strtobool(args["subparams"])
+
+  def load():
+    # load each file only once, even if it appears in many combinations
+    loaded = dict(map(lambda x: (x, dict(map(lambda y: (y, loaders[x](y)), paths[x]))), batch_tags))
+    # parse once, memoized results are shared across all combinations
+    return (loaded, StaticAnalysis(**load_program_args(args)))
+  select_expr_backend(args)
+  (loaded, sa) = expr.with_fallback(load)
+
+  # per-loop reports would be interleaved with the table
+  options.flag_verbose_reuse = False
+
+  columns = ["adds", "multiplies", "divides", "specials", "ws_bytes", "traffic_bytes", "spills", "streams",
+             "time", "intensity", "bound"]
+  out.write('\t'.join(batch_tags + ["function", "loop"] + columns) + '\n')
+  for combo in itertools.product(*map(lambda x: paths[x], batch_tags)):
+    kw_args = dict(zip(["params", "block_params", "machine", "conds_chk"],
+                       map(lambda (tag, path): loaded[tag][path], zip(batch_tags, combo))))
+    kw_args["flag_sub_params"] = flag_sub_params
+    for function in sa.summary(**kw_args):
+      for loop in function["loops"]:
+        row = list(map(str, combo)) + [function["name"], str(loop["linenum"])] + \
+              map(lambda x: str(loop[x]), columns)
+        out.write('\t'.join(row) + '\n')
+      row = list(map(str, combo)) + [function["name"], "total"] + \
+            map(lambda x: str(function[x]) if x in function else "", columns)
+      out.write('\t'.join(row) + '\n')
+  out.flush()
+
+def preset_env_args(preset):
+  """Args of a preset setup (or the defaults), overridden by any environment variables set."""
+  args = {"cns": cns_args, "smc": smc_args}.get(preset, default_args)()
+  for (tag, val) in get_env_args().items():
+    if os.getenv(tag, None):
+      args[tag] = val
+  return args
 
 def main(cl_args):
 
@@ -101,13 +220,90 @@ def main(cl_args):
       args = cns_args()
     elif cl_args[1] == "smc":
       args = smc_args()
+    elif cl_args[1] == "batch":
+      # one parsed program, cross product of params/block_params/machine/conds lists
+      run_batch(preset_env_args(cl_args[2] if len(cl_args) > 2 else None))
+      return
+    elif cl_args[1] == "mc":
+      # Monte Carlo over the branch probabilities, see uncertainty.py
+      import uncertainty
+      args = preset_env_args(cl_args[2] if len(cl_args) > 2 else None)
+      if not os.getenv("conds_dist", None):
+        print "Set conds_dist=<XML file> to give a distribution per conditional"
+        sys.exit(1)
+      uncertainty.run_monte_carlo(args, os.getenv("conds_dist"),
+                                  int(os.getenv("mc_samples", "1000")),
+                                  int(os.getenv("mc_seed")) if os.getenv("mc_seed", None) else None,
+                                  map(float, os.getenv("mc_percentiles", "5,50,95").split(',')))
+      return
+    elif cl_args[1] == "fusion":
+      # what-if fusion of consecutive top-level loops, see transform.py
+      import transform
+      transform.run_fusion(preset_env_args(cl_args[2] if len(cl_args) > 2 else None))
+      return
+    elif cl_args[1] == "interchange":
+      # what-if permutations of perfect loop nests, see transform.py
+      import transform
+      transform.run_interchange(preset_env_args(cl_args[2] if len(cl_args) > 2 else None))
+      return
+    elif cl_args[1] == "scaling":
+      # traffic and time versus thread count, see scaling.py
+      import scaling
+      scaling.run_scaling(preset_env_args(cl_args[2] if len(cl_args) > 2 else None),
+                          map(int, os.getenv("threads").split(',')) if os.getenv("threads", None) else None,
+                          float(os.getenv("scaling_efficiency", "0.5")),
+                          os.getenv("numa_placement", "first_touch"))
+      return
+    elif cl_args[1] == "sensitivity":
+      # derivatives and elasticities of the time per machine key, see sensitivity.py
+      import sensitivity
+      sensitivity.run_sensitivity(preset_env_args(cl_args[2] if len(cl_args) > 2 else None),
+                                  float(os.getenv("sensitivity_step", "0.1")))
+      return
+    elif cl_args[1] == "asymptotic":
+      # leading-order laws of flops, traffic and working set, see asymptotics.py
+      import asymptotics
+      asymptotics.run_asymptotics(preset_env_args(cl_args[2] if len(cl_args) > 2 else None),
+                                  os.getenv("law_vars", "nspecies").split(',') if os.getenv("law_vars", "nspecies") else [],
+                                  tuple(map(int, os.getenv("law_scales", "32,64").split(','))),
+                                  dict(map(lambda x: (x.split('=')[0], float(x.split('=')[1])),
+                                           os.getenv("law_at").split(','))) if os.getenv("law_at", None) else None)
+      return
+    elif cl_args[1] == "diff":
+      # per-loop deltas between variants of the program, see variants.py
+      import variants
+      rest = cl_args[2:]
+      preset = rest.pop(0) if rest and not rest[0].endswith('.xml') else None
+      if not rest:
+        print "Usage: run_model.py diff [cns|smc] <variant XML files> ... (compared to the xml of the setup)"
+        sys.exit(1)
+      variants.run_diff(preset_env_args(preset), rest)
+      return
+    elif cl_args[1] == "reconcile":
+      # model error per loop against PIN loop profiles, see reconcile.py
+      import reconcile
+      rest = cl_args[2:]
+      preset = rest.pop(0) if len(rest) > 1 else None
+      if not rest:
+        print "Usage: run_model.py reconcile [cns|smc] <PIN XML file>"
+        sys.exit(1)
+      reconcile.run_reconcile(preset_env_args(preset), rest[0],
+                              float(os.getenv("pin_threshold", "0.25")), os.getenv("pin_file", None))
+      return
+    elif cl_args[1] == "serve":
+      # daemon mode: keep parsed programs in memory and answer queries
+      import model_server
+      model_server.main(cl_args[2:])
+      return
   else:
     args = get_env_args()
 
-  (sa_kw_args, dump_kw_args) = load_args(args)
-
-  # parse the XML files and do substitutions
-  sa = StaticAnalysis(**sa_kw_args)
+  def load():
+    (sa_kw_args, dump_kw_args) = load_args(args)
+    # parse the XML files and do substitutions
+    return (StaticAnalysis(**sa_kw_args), dump_kw_args)
+  select_expr_backend(args)
+  (sa, dump_kw_args) = expr.with_fallback(load)
 
   # do performance analysis at granularity of first-level loops in all functions
   sa.dump(**dump_kw_args)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+""" Thread-scaling model for the ExaSAT performance model.
+
+    The single-node model compares the working set of a loop against the
+    whole cache, as if one thread owned it.  Here the outermost loop of each
+    top-level loop nest is partitioned statically across T threads (chunks
+    of ceil(N / T) iterations), and each thread's chunk is analyzed on its
+    own with its share of the cache: cache_core_n cores (default 1) share
+    one cache, so min(T, cache_core_n) threads split it.  With a cache
+    hierarchy, the last level is the shared one.
+
+    The traffic of all chunks is moved at T * core_gbs, capped by the node
+    memory bandwidth node_gbs (GB/s, default unlimited), while the compute
+    time is that of the largest chunk on a single core.  The reuse decisions
+    of the traffic model (see analyze.Traffic.loop) change once the
+    per-thread working set no longer fits in the per-thread cache share, so
+    the predicted time shows where a kernel stops scaling.
+
+    NUMA: with numa_domain_n domains of numa_core_n cores each, threads are
+    placed compactly (filling one domain before the next) and the traffic
+    is split into local and remote parts by the placement policy of the
+    data (see placements).  Each domain's memory serves the bytes placed
+    there at numa_local_gbs, and the bytes a domain fetches from other
+    domains cross the interconnect at numa_remote_gbs, so the memory time
+    is that of the busiest of the cores, memories and links.
+"""
+__author__ = "Cy Chan"
+__copyright__ = "Copyright 2016, The Regents of the University of California, through Lawrence Berkeley National Laboratory"
+__credits__ = ["Cy Chan"]
+__license__ = "Modified BSD License (see LICENSE file)"
+__version__ = "2.0"
+__maintainer__ = "Cy Chan"
+__email__ = "cychan@lbl.gov"
+__status__ = "Production"
+
+import sys
+
+from analyze import ExecTime, FlopCount, totalBytes, frozenDict, \
+                    get_cache_byte_n, get_level_machine, get_transfer_time
+
+def default_thread_ns(machine):
+  """Powers of two up to core_n."""
+  result = [1]
+  while result[-1] * 2 <= machine['core_n']:
+    result.append(result[-1] * 2)
+  return result
+
+# where the pages of the arrays are placed
+placements = {
+  'first_touch' : "each thread's chunk in the domain of that thread (parallel initialization)",
+  'interleave'  : "pages round-robin over all domains",
+  'serial'      : "all pages in the first domain (serial initialization)",
+}
+
+def domain_threads(thread_n, machine):
+  """Threads per NUMA domain under compact placement."""
+  (domain_n, core_n) = (int(machine['numa_domain_n']), int(machine['numa_core_n']))
+  result = [0] * domain_n
+  for i in xrange(thread_n):
+    # fill the domains in order, then oversubscribe them round-robin
+    result[i // core_n if i < domain_n * core_n else i % domain_n] += 1
+  return result
+
+def numa_traffic(traffic_bytes, thread_n, machine, placement):
+  """Splits traffic_bytes, moved evenly by thread_n threads, by NUMA domain.
+
+     Returns (served, remote): the bytes served by the memory of each domain,
+     and the bytes each domain fetches from the other domains."""
+  threads = domain_threads(thread_n, machine)
+  domain_n = len(threads)
+  requested = map(lambda t: traffic_bytes * t / float(thread_n), threads)
+  if placement == 'first_touch':
+    return (requested, [0.0] * domain_n)
+  elif placement == 'interleave':
+    return ([traffic_bytes / float(domain_n)] * domain_n,
+            map(lambda x: x * (domain_n - 1) / float(domain_n), requested))
+  elif placement == 'serial':
+    return ([traffic_bytes] + [0.0] * (domain_n - 1), [0.0] + requested[1:])
+  raise Exception("Unknown NUMA placement '%s' (expected one of %s)" % (placement, sorted(placements.keys())))
+
+def memory_time(traffic_bytes, thread_n, machine, placement):
+  """Seconds to move traffic_bytes with thread_n threads, each limited to
+     core_gbs, the whole node to node_gbs (if given), and the NUMA memories
+     and links to numa_local_gbs and numa_remote_gbs (if NUMA domains are
+     given).  Returns (time, local_bytes, remote_bytes)."""
+  gbs = thread_n * machine['core_gbs']
+  if 'node_gbs' in machine:
+    gbs = min(gbs, machine['node_gbs'])
+  time = get_transfer_time(traffic_bytes, gbs)
+  if 'numa_domain_n' not in machine:
+    return (time, traffic_bytes, 0.0)
+  (served, remote) = numa_traffic(traffic_bytes, thread_n, machine, placement)
+  time = max([time] + map(lambda x: get_transfer_time(x, machine['numa_local_gbs']), served) +
+             map(lambda x: get_transfer_time(x, machine['numa_remote_gbs']), remote))
+  return (time, traffic_bytes - sum(remote), sum(remote))
+
+def cache_share(thread_n, machine):
+  """Bytes of the shared cache available to each of thread_n threads."""
+  return float(get_cache_byte_n(machine)) / min(thread_n, machine.get('cache_core_n', 1))
+
+
+class ThreadScaling(object):
+  """Predicted traffic and time of a top-level loop run by thread_n threads."""
+  __slots__ = ['function', 'linenum', 'thread_n', 'chunk', 'ws_bytes', 'cache_bytes',
+               'traffic', 'remote', 'time']
+  def __init__(self, function, linenum, thread_n, chunk, ws_bytes, cache_bytes, traffic, remote, time):
+    self.function = function
+    self.linenum = linenum
+    self.thread_n = thread_n
+    self.chunk = chunk             # outer iterations per thread
+    self.ws_bytes = ws_bytes       # working set of one thread's chunk
+    self.cache_bytes = cache_bytes # cache share of one thread
+    self.traffic = traffic         # over all threads
+    self.remote = remote           # part of the traffic crossing NUMA domains
+    self.time = time
+  def __str__(self):
+    return "TS %s loop %s, %d threads: chunk=%s, WS=%s bytes, cache share=%g bytes, traffic=%g bytes (%g remote), time=%s s" % \
+           (self.function, self.linenum, self.thread_n, self.chunk, self.ws_bytes, self.cache_bytes,
+            self.traffic, self.remote, self.time)
+
+
+def chunkLoop(sa, sym_loop, params, chunk):
+  """The top-level loop restricted to its first chunk outer iterations (memoized)."""
+  def f():
+    loop = sym_loop.subParams(params, shallow=True)
+    lb = loop.range[0]
+    return sym_loop.copy((lb, lb + (chunk - 1) * loop.stride))
+  return sa.memoize((sym_loop, 'chunk', frozenDict(params), chunk), f)
+
+def loopScaling(sa, function, sym_loop, thread_n, params, block_params, machine, conds_chk,
+                placement = 'first_touch'):
+  """ThreadScaling of a top-level loop run by thread_n threads."""
+  outer_n = int(sym_loop.subParams(params, shallow=True).iter_n())
+  chunk = max(1, -(-outer_n // thread_n))
+  (full_n, rest) = divmod(outer_n, chunk)
+  share = cache_share(thread_n, machine)
+  # the shared cache level determines the traffic, so drop the others
+  thread_machine = get_level_machine(machine, share)
+
+  def traffic(n):
+    loop = chunkLoop(sa, sym_loop, params, n)
+    return sum(map(lambda x: x.bytes(), sa.collectLoop(loop, params, block_params, thread_machine, conds_chk,
+                                                      True, ['traffic'])['traffic']))
+  traffic_bytes = full_n * traffic(chunk) + (traffic(rest) if rest else 0)
+  ws = sa.collectLoop(chunkLoop(sa, sym_loop, params, chunk), params, block_params, thread_machine,
+                      conds_chk, True, ['ws'])['ws']
+
+  # the largest chunk runs on one core, all chunks share the memory bandwidth
+  colls = sa.collectLoop(sym_loop, params, block_params, machine, conds_chk, True, ['flops', 'registers'])
+  fraction = float(chunk) / outer_n
+  active_n = full_n + (1 if rest else 0)
+  (time, local, remote) = memory_time(traffic_bytes, active_n, machine, placement)
+  core_machine = dict(machine, core_n=1)
+  et = ExecTime(FlopCount.total(colls['flops']) * fraction, traffic_bytes, core_machine, time,
+                sum(map(lambda x: x.l1_loads + x.l1_stores, colls['registers'])) * fraction)
+  return ThreadScaling(function.name, sym_loop.linenum, thread_n, chunk, totalBytes(ws), share,
+                       traffic_bytes, remote, et.time())
+
+def threadScaling(sa, thread_ns, params, block_params, machine, conds_chk, placement = 'first_touch'):
+  """Evaluates every top-level loop for each thread count in thread_ns.
+
+     Returns {function name: [(linenum, [ThreadScaling per thread count])]}."""
+  result = {}
+  for function in sa.functions:
+    result[function.name] = map(lambda sym_loop: (sym_loop.linenum, map(
+                                  lambda t: loopScaling(sa, function, sym_loop, t, params, block_params,
+                                                        machine, conds_chk, placement), thread_ns)),
+                                function.body.loops)
+  return result
+
+def scalingLimit(times, thread_ns, efficiency):
+  """Largest thread count whose parallel efficiency (relative to the first
+     thread count) is at least efficiency."""
+  result = thread_ns[0]
+  for (t, time) in zip(thread_ns, times):
+    if time and times[0] / time / (float(t) / thread_ns[0]) >= efficiency:
+      result = t
+  return result
+
+def run_scaling(args, thread_ns = None, efficiency = 0.5, placement = 'first_touch', out = sys.stdout):
+  """Writes a tab-separated table of traffic and time per thread count, for
+     each top-level loop and function total, with the speedup and parallel
+     efficiency relative to one thread.  The last column repeats the largest
+     thread count that still runs at the given parallel efficiency."""
+  from run_model import load_numeric_analysis
+
+  (sa, model_kw_args) = load_numeric_analysis(args)
+  if not thread_ns:
+    thread_ns = default_thread_ns(model_kw_args["machine"])
+
+  out.write('\t'.join(["function", "loop", "threads", "chunk", "ws_bytes", "cache_share_bytes",
+                       "traffic_bytes", "remote_bytes", "time", "speedup", "efficiency", "scaling_limit"]) + '\n')
+  def write(function, loop, rows):
+    times = map(lambda x: x.time, rows)
+    limit = scalingLimit(times, thread_ns, efficiency)
+    for x in rows:
+      speedup = times[0] / x.time if x.time else None
+      values = [x.chunk, x.ws_bytes, x.cache_bytes, x.traffic, x.remote, x.time, speedup,
+                speedup / (float(x.thread_n) / thread_ns[0]) if speedup else None]
+      out.write('\t'.join([function, loop, str(x.thread_n)] +
+                          map(lambda v: "%g" % v if v is not None else "None", values) +
+                          [str(limit)]) + '\n')
+  if placement not in placements:
+    raise Exception("Unknown NUMA placement '%s' (expected one of %s)" % (placement, sorted(placements.keys())))
+  for (name, loops) in threadScaling(sa, thread_ns, placement=placement, **model_kw_args).items():
+    for (linenum, rows) in loops:
+      write(name, str(linenum), rows)
+    if loops:
+      # loops run one after the other, each partitioned across all threads
+      totals = map(lambda i: ThreadScaling(name, "total", thread_ns[i], None, None,
+                                           cache_share(thread_ns[i], model_kw_args["machine"]),
+                                           sum(map(lambda (l, rows): rows[i].traffic, loops)),
+                                           sum(map(lambda (l, rows): rows[i].remote, loops)),
+                                           sum(map(lambda (l, rows): rows[i].time, loops))),
+                   range(len(thread_ns)))
+      write(name, "total", totals)
+  out.flush()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+""" Sensitivity of the predicted execution time to the machine parameters.
+
+    Every numeric key of the machine description is perturbed down and up
+    by a relative step (default 10%) and the roofline time of each top-level
+    loop and function is evaluated again, reusing all results that do not
+    depend on the machine.  The derivative d(time)/d(key) is the central
+    difference, and the elasticity (d(time)/d(key)) * key / time is the
+    relative change in time per relative change of the key.
+
+    The time is only piecewise smooth: the reuse decisions of the traffic
+    model jump where a working set stops fitting in cache.  The step is
+    finite so that such jumps within it are seen, and keys whose
+    elasticities below and above the current value differ are flagged as
+    kinks (smooth power laws, e.g. time ~ 1 / core_gbs, have equal ones).
+
+    Keys that select a model variant (e.g. cache_level_n, line_model,
+    streaming_stores) are not perturbed.  Counts (keys ending in _n, and
+    simd_width) are perturbed by whole units, keys at zero by the step
+    itself, and probabilities and fractions stay within [0, 1].
+"""
+__author__ = "Cy Chan"
+__copyright__ = "Copyright 2016, The Regents of the University of California, through Lawrence Berkeley National Laboratory"
+__credits__ = ["Cy Chan"]
+__license__ = "Modified BSD License (see LICENSE file)"
+__version__ = "2.0"
+__maintainer__ = "Cy Chan"
+__email__ = "cychan@lbl.gov"
+__status__ = "Production"
+
+import sys
+import math
+
+from analyze import ExecTime
+
+# keys that select a model variant rather than scale a quantity
+fixed_keys = ['cache_level_n', 'line_model', 'line_aligned', 'unit_stride_dim', 'streaming_stores',
+              'nt_loads', 'ws_cond_expected', 'numa_domain_n']
+
+# keys counted in whole units, besides those ending in _n
+count_keys = ['simd_width']
+
+# keys bounded to [0, 1]
+fraction_keys = ['overlap', 'prefetch_untracked_sf', 'ws_cond_p']
+
+def perturbations(key, value, step):
+  """Values of key just below and above value (the former is None if the
+     key cannot go lower)."""
+  if key.endswith('_n') or key in count_keys:
+    delta = max(1, int(round(value * step)))
+  else:
+    delta = value * step if value else step
+  (down, up) = (value - delta, value + delta)
+  if down < 0 or (key.endswith('_n') or key in count_keys) and down < 1:
+    down = None
+  if key in fraction_keys and up > 1:
+    up = None
+  return (down, up)
+
+def slope(t0, v0, t1, v1):
+  return (t1 - t0) / (v1 - v0)
+
+class Sensitivity(object):
+  """Sensitivity of a predicted time to one machine key."""
+  __slots__ = ['key', 'value', 'time', 'down', 'up']
+  def __init__(self, key, value, time, down, up):
+    self.key = key
+    self.value = value
+    self.time = time
+    self.down = down # (value, time) below, or None
+    self.up = up     # (value, time) above, or None
+  def slopes(self):
+    """Slopes below and above the current value (None if not evaluated)."""
+    return tuple(map(lambda x: slope(self.time, self.value, x[1], x[0]) if x else None, [self.down, self.up]))
+  def derivative(self):
+    (down, up) = (self.down, self.up)
+    if down and up:
+      return slope(down[1], down[0], up[1], up[0])
+    (s_down, s_up) = self.slopes()
+    return s_up if s_down is None else s_down
+  def elasticity(self):
+    d = self.derivative()
+    if d is None or not self.time:
+      return None
+    return d * self.value / self.time
+  def kink(self, tolerance = 0.1):
+    """True if the elasticities below and above the value differ by more
+       than tolerance, e.g. where a working set stops fitting in cache
+       within the step."""
+    if not (self.down and self.up) or not all(map(lambda x: x > 0, [self.down[1], self.time, self.up[1]])):
+      return False
+    def elasticity((v0, t0), (v1, t1)):
+      return math.log(t1 / t0) / math.log(float(v1) / v0)
+    (e_down, e_up) = (elasticity(self.down, (self.value, self.time)), elasticity((self.value, self.time), self.up))
+    return abs(e_up - e_down) > tolerance
+
+def times(sa, params, block_params, machine, conds_chk):
+  """{(function name, linenum or 'total'): time} for a machine."""
+  result = {}
+  for function in sa.functions:
+    function_time = ExecTime(machine=machine)
+    for sym_loop in function.body.loops:
+      et = sa.execTime(sym_loop, params, block_params, machine, conds_chk, True)
+      function_time += et
+      result[(function.name, sym_loop.linenum)] = et.time()
+    result[(function.name, 'total')] = function_time.time()
+  return result
+
+def sensitivities(sa, params, block_params, machine, conds_chk, step = 0.1, keys = None):
+  """Sensitivity of every loop and function time to every machine key.
+
+     Returns {(function name, linenum or 'total'): [Sensitivity per key]}."""
+  base = times(sa, params, block_params, machine, conds_chk)
+  result = dict(map(lambda x: (x, []), base.keys()))
+  for key in sorted(keys or machine.keys()):
+    if key in fixed_keys:
+      continue
+    value = machine[key]
+    (down, up) = perturbations(key, value, step)
+    (t_down, t_up) = map(lambda v: times(sa, params, block_params, dict(machine, **{key: v}), conds_chk)
+                                   if v is not None else None, [down, up])
+    for (x, t) in base.items():
+      if t is None:
+        continue
+      result[x].append(Sensitivity(key, value, t, (down, t_down[x]) if t_down and t_down[x] is not None else None,
+                                   (up, t_up[x]) if t_up and t_up[x] is not None else None))
+  return result
+
+def run_sensitivity(args, step = 0.1, out = sys.stdout):
+  """Writes a tab-separated table with the derivative and elasticity of the
+     time of each top-level loop and function total with respect to each
+     machine key, plus the slopes below and above the key's value and
+     whether they differ (a kink)."""
+  from run_model import load_numeric_analysis
+
+  (sa, model_kw_args) = load_numeric_analysis(args)
+
+  out.write('\t'.join(["function", "loop", "key", "value", "time", "d_time", "elasticity",
+                       "slope_down", "slope_up", "kink"]) + '\n')
+  result = sensitivities(sa, step=step, **model_kw_args)
+  # functions in program order, loops in line order, then the total
+  for function in sa.functions:
+    for loop in map(lambda x: x.linenum, function.body.loops) + ['total']:
+      for x in result.get((function.name, loop), []):
+        values = [x.value, x.time, x.derivative(), x.elasticity()] + list(x.slopes())
+        out.write('\t'.join([function.name, str(loop), x.key] +
+                            map(lambda v: "%g" % (v + 0.0) if v is not None else "None", values) +
+                            ["yes" if x.kink() else "no"]) + '\n')
+  out.flush()
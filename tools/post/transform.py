@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+
+""" What-if loop transformations for the performance model.
+
+    Fusion: consecutive top-level loops of a function are fused level by
+    level as long as their loop headers (bounds after parameter
+    substitution, stride, and guarding conditionals) match.  The fused loop
+    is an ordinary Loop, so the working set and traffic models (including
+    the reuse decision in Traffic.loop) apply to it unchanged; arrays
+    touched by both loops are merged and only moved once if they fit.
+
+    Fusion is legal if no array dependence between the loops is reversed:
+    for every pair of accesses to the same array where one is a write, the
+    element touched by the first loop must be touched by the second one in
+    the same or a later fused iteration.  Accesses whose dependence distance
+    cannot be determined (e.g. an array invariant in a fused loop) make the
+    fusion illegal.  Scalars are assumed to be private to an iteration.
+
+    Interchange: the perfectly nested levels of a top-level loop (see
+    perfectNest) are permuted.  The working set and traffic collapse
+    accesses level by level in nesting order, so the reuse decisions, and
+    with them the traffic, depend on the order.  A permutation is legal if
+    the loop bounds do not depend on each other and every dependence
+    direction vector in the nest stays lexicographically positive.  The
+    collection of each inner suffix of an order is memoized, so orders
+    sharing their innermost levels share the analysis of those levels.
+"""
+__author__ = "Cy Chan"
+__copyright__ = "Copyright 2016, The Regents of the University of California, through Lawrence Berkeley National Laboratory"
+__credits__ = ["Cy Chan"]
+__license__ = "Modified BSD License (see LICENSE file)"
+__version__ = "2.0"
+__maintainer__ = "Cy Chan"
+__email__ = "cychan@lbl.gov"
+__status__ = "Production"
+
+import sys
+import re
+import itertools
+
+from analyze import ExecTime, FlopCount, WorkingSet, Traffic, totalBytes, frozenDict
+from parser import Body
+
+# Helper functions
+
+def condsKey(conds):
+  return tuple(map(lambda x: (x.condition, x.when), conds))
+
+def sameHeader(a, b, params):
+  """True if loops a and b iterate over the same values under the same conditionals."""
+  if a.stride != b.stride or condsKey(a.conds) != condsKey(b.conds):
+    return False
+  return a.subParams(params, shallow=True).range == b.subParams(params, shallow=True).range
+
+def arrayAccesses(body):
+  """Returns {array name: [ArrayAccess]} for all accesses in a body (any conditionals)."""
+  result = {}
+  def visit(body):
+    for block in body.codeblocks:
+      for array in block.arrays:
+        result.setdefault(array.name, []).extend(array.accesses)
+    for loop in body.loops:
+      visit(loop.body)
+  visit(body)
+  return result
+
+def distance(a, b, loopvars):
+  """Dependence distance (per fused loop variable, outermost first) from access a
+     in the first loop to access b in the second one.
+
+     Returns () if the accesses never touch the same element, or None if the
+     distance cannot be determined."""
+  dist = {}
+  for (ia, ib, la, lb) in zip(a.index, b.index, a.loopvars, b.loopvars):
+    if la != lb:
+      return None
+    if not la:
+      # constant indices: different components never overlap
+      if type(ia) == int and type(ib) == int and ia != ib:
+        return ()
+      continue
+    if la in loopvars:
+      if type(ia) != int or type(ib) != int or dist.get(la, ia - ib) != ia - ib:
+        return None
+      dist[la] = ia - ib
+  if len(dist) < len(loopvars):
+    return None # invariant in some fused loop
+  return tuple(map(lambda x: dist[x], loopvars))
+
+def isLegal(first, second, loopvars):
+  """Checks the dependences between two loop bodies fused over loopvars."""
+  (acc1, acc2) = (arrayAccesses(first), arrayAccesses(second))
+  for name in set(acc1.keys()) & set(acc2.keys()):
+    for a in acc1[name]:
+      for b in acc2[name]:
+        if not (a.writes > 0 or b.writes > 0):
+          continue
+        d = distance(a, b, loopvars)
+        if d is None:
+          return False
+        # the element a touches in iteration p is touched by b in iteration p + d
+        if d and d < (0,) * len(d):
+          return False
+  return True
+
+def fuseLoops(a, b, params):
+  """Fuses loop b into loop a, renaming b's loop variables to a's.
+
+     Loop levels are fused as long as both bodies consist of a single loop
+     with a matching header.  Returns the fused Loop, or None if the headers
+     do not match or fusion would reverse a dependence."""
+  if not sameHeader(a, b, params):
+    return None
+  names = {}
+  loopvars = []
+  (x, y) = (a, b)
+  while True:
+    names[y.loopvar] = x.loopvar
+    loopvars.append(x.loopvar)
+    if len(x.body.loops) == 1 and len(y.body.loops) == 1 and \
+       not x.body.codeblocks and not y.body.codeblocks and \
+       sameHeader(x.body.loops[0], y.body.loops[0], params):
+      (x, y) = (x.body.loops[0], y.body.loops[0])
+    else:
+      break
+  b = b.renameLoopvars(names)
+  if not isLegal(a.body, b.body, loopvars):
+    return None
+  def merge(x, y, depth):
+    result = x.copy()
+    result.body = Body()
+    if depth == 1:
+      result.body.codeblocks = x.body.codeblocks + y.body.codeblocks
+      result.body.loops = x.body.loops + y.body.loops
+    else:
+      result.body.codeblocks = []
+      result.body.loops = [merge(x.body.loops[0], y.body.loops[0], depth - 1)]
+    return result
+  return merge(a, b, len(loopvars))
+
+
+class FusionCandidate(object):
+  """Predicted effect of fusing a chain of consecutive top-level loops."""
+  __slots__ = ['function', 'loops', 'traffic_before', 'traffic_after', 'ws_bytes',
+               'time_before', 'time_after']
+  def __init__(self, function, loops, traffic_before, traffic_after, ws_bytes,
+               time_before, time_after):
+    self.function = function
+    self.loops = loops
+    self.traffic_before = traffic_before
+    self.traffic_after = traffic_after
+    self.ws_bytes = ws_bytes
+    self.time_before = time_before
+    self.time_after = time_after
+  def savings(self):
+    return self.traffic_before - self.traffic_after
+  def __str__(self):
+    return "FC %s loops %s: traffic %g -> %g bytes (saves %g), WS=%s bytes, time %s -> %s s" % \
+           (self.function, '+'.join(map(str, self.loops)), self.traffic_before, self.traffic_after,
+            self.savings(), self.ws_bytes, self.time_before, self.time_after)
+
+
+def fusionCandidates(sa, params, block_params, machine, conds_chk):
+  """Evaluates every legal chain of two or more consecutive top-level loops.
+
+     Returns a list of FusionCandidates ranked by traffic savings."""
+  def traffic(loop):
+    return sum(map(lambda x: x.bytes(), sa.collectLoop(loop, params, block_params, machine, conds_chk,
+                                                        True, ['traffic'])['traffic']))
+  def time(loop):
+    return sa.execTime(loop, params, block_params, machine, conds_chk, True).time()
+  P = frozenset(params.items())
+  result = []
+  for function in sa.functions:
+    loops = function.body.loops
+    for start in xrange(len(loops)):
+      fused = loops[start]
+      for end in xrange(start + 1, len(loops)):
+        chain = tuple(loops[start:end+1])
+        # memoized so that the analyses of the fused loop are shared across runs
+        fused = sa.memoize((chain, 'fused', P), lambda: fuseLoops(fused, loops[end], params))
+        if not fused:
+          break
+        ws = sa.collectLoop(fused, params, block_params, machine, conds_chk, True, ['ws'])['ws']
+        result.append(FusionCandidate(function.name, map(lambda x: x.linenum, chain),
+                                      sum(map(traffic, chain)), traffic(fused), totalBytes(ws),
+                                      sum(map(time, chain)), time(fused)))
+  return sorted(result, key=lambda x: -x.savings())
+
+def isHoistable(block):
+  """True if a code block only sets up the inner loops: no flops, and no
+     array accesses other than state variables (e.g. reads of lo/hi)."""
+  flops = block.flops
+  return not (flops.adds or flops.multiplies or flops.divides or flops.specials) and \
+         all(map(lambda x: x.onlyStateVars(), block.arrays))
+
+def perfectNest(loop):
+  """Splits a loop nest into its perfectly nested levels and the body of the innermost one.
+
+     A level is nested perfectly if its body is a single loop under the same
+     conditionals, plus code blocks that can be hoisted (see isHoistable).
+     The hoisted blocks are moved into the innermost body.  Returns
+     (levels, body) with the levels outermost first."""
+  levels = [loop]
+  hoisted = []
+  while len(loop.body.loops) == 1 and all(map(isHoistable, loop.body.codeblocks)) and \
+        condsKey(loop.body.loops[0].conds) == condsKey(loop.conds):
+    hoisted.extend(loop.body.codeblocks)
+    loop = loop.body.loops[0]
+    levels.append(loop)
+  body = Body()
+  body.codeblocks = hoisted + loop.body.codeblocks
+  body.loops = loop.body.loops
+  return (levels, body)
+
+def isRectangular(levels):
+  """True if no loop bound depends on the loop variable of another level."""
+  loopvars = map(lambda x: x.loopvar, levels)
+  for level in levels:
+    for bound in level.range:
+      if any(map(lambda x: re.search(r'\b%s\b' % re.escape(x), str(bound)), loopvars)):
+        return False
+  return True
+
+def sign(x):
+  return (x > 0) - (x < 0)
+
+def dependences(body, loopvars):
+  """Direction vectors (signs of the dependence distances) between iterations
+     of a nest over loopvars, each oriented to be lexicographically positive.
+
+     Signs are enough to decide the lexicographic order.  A loop variable an
+     array is invariant in may carry a dependence in either direction, so all
+     signs are enumerated for it.  Returns None if a distance cannot be
+     determined."""
+  result = set()
+  for accesses in arrayAccesses(body).values():
+    for (a, b) in itertools.combinations_with_replacement(accesses, 2):
+      if not (a.writes > 0 or b.writes > 0):
+        continue
+      dependent = filter(lambda x: x in a.loopvars, loopvars)
+      if dependent:
+        d = distance(a, b, dependent)
+        if d is None:
+          return None
+        if not d:
+          continue # never the same element
+        d = dict(zip(dependent, map(sign, d)))
+      else:
+        d = {}
+      choices = map(lambda x: [d[x]] if x in d else [-1, 0, 1], loopvars)
+      for v in itertools.product(*choices):
+        if any(v):
+          result.add(max(v, tuple(map(lambda x: -x, v))))
+  return result
+
+def legalOrders(levels, body):
+  """Loop orders of a perfect nest that keep every dependence, as tuples of
+     level indices (outermost first).  The original order is always legal."""
+  identity = tuple(range(len(levels)))
+  deps = dependences(body, map(lambda x: x.loopvar, levels))
+  if deps is None or not isRectangular(levels):
+    return [identity]
+  zero = (0,) * len(levels)
+  return filter(lambda p: all(map(lambda d: tuple(map(lambda i: d[i], p)) > zero, deps)),
+                itertools.permutations(identity))
+
+
+class InterchangeOrder(object):
+  """Predicted effect of one loop order of the perfect nest of a top-level loop."""
+  __slots__ = ['function', 'linenum', 'loopvars', 'original', 'traffic', 'ws_bytes',
+               'inner_ws_bytes', 'time']
+  def __init__(self, function, linenum, loopvars, original, traffic, ws_bytes,
+               inner_ws_bytes, time):
+    self.function = function
+    self.linenum = linenum
+    self.loopvars = loopvars # outermost first
+    self.original = original
+    self.traffic = traffic
+    self.ws_bytes = ws_bytes
+    self.inner_ws_bytes = inner_ws_bytes # working set of one outermost iteration
+    self.time = time
+  def __str__(self):
+    return "IO %s loop %d order %s%s: traffic %g bytes, WS=%s bytes (%s per outer iteration), time %s s" % \
+           (self.function, self.linenum, ','.join(self.loopvars), " (original)" if self.original else "",
+            self.traffic, self.ws_bytes, self.inner_ws_bytes, self.time)
+
+
+def interchangeOrders(sa, params, block_params, machine, conds_chk):
+  """Evaluates every legal loop order of the perfect nest of each top-level loop.
+
+     Returns a list of InterchangeOrders, nests in program order and the
+     orders of a nest ranked by traffic."""
+  machine = sa.lineMachine(machine)
+  inputs = (frozenDict(params), frozenDict(block_params), frozenDict(machine), conds_chk.key())
+  result = []
+  for function in sa.functions:
+    for root in function.body.loops:
+      (levels, body) = sa.memoize((root, 'nest'), lambda: perfectNest(root))
+      if len(levels) < 2:
+        continue
+      sub_body = sa.memoize((root, 'nest_body', inputs[0]), lambda: body.subParams(params))
+
+      # collections of the levels in suffix (outermost first) around the body
+      def traffic(suffix):
+        def f():
+          if not suffix:
+            return body.collect(Traffic.collector(conds_chk, params, block_params, machine))
+          return traffic(suffix[1:]).loop(levels[suffix[0]])
+        return sa.memoize((root, 'interchange', 'traffic', suffix) + inputs, f)
+      def ws(suffix):
+        def f():
+          if not suffix:
+            return sub_body.collect(WorkingSet.collector(conds_chk, machine))
+          level = levels[suffix[0]]
+          if len(suffix) == len(levels):
+            level = level.blocked(block_params) # only the outermost loop is blocked, as in collectLoop
+          return ws(suffix[1:]).loop(level.subParams(params, shallow=True))
+        return sa.memoize((root, 'interchange', 'ws', suffix) + inputs, f)
+
+      # flops and register use do not depend on the order of the levels
+      colls = sa.collectLoop(root, params, block_params, machine, conds_chk, True, ['flops', 'registers'])
+      flops = FlopCount.total(colls['flops'])
+      l1_accesses = sum(map(lambda x: x.l1_loads + x.l1_stores, colls['registers']))
+      orders = []
+      for order in legalOrders(levels, body):
+        traffic_bytes = sum(map(lambda x: x.bytes(), traffic(order)))
+        orders.append(InterchangeOrder(function.name, root.linenum,
+                                       map(lambda i: levels[i].loopvar, order),
+                                       order == tuple(sorted(order)), traffic_bytes,
+                                       totalBytes(ws(order)), totalBytes(ws(order[1:])),
+                                       ExecTime(flops, traffic_bytes, machine, None, l1_accesses).time()))
+      result.extend(sorted(orders, key=lambda x: x.traffic))
+  return result
+
+def run_interchange(args, out = sys.stdout):
+  """Writes a tab-separated table of the legal loop orders of each nest, best first."""
+  from run_model import load_numeric_analysis
+
+  (sa, model_kw_args) = load_numeric_analysis(args)
+
+  out.write('\t'.join(["function", "loop", "order", "original", "traffic_bytes", "ws_bytes",
+                       "inner_ws_bytes", "time"]) + '\n')
+  for x in interchangeOrders(sa, **model_kw_args):
+    out.write('\t'.join([x.function, str(x.linenum), ','.join(x.loopvars), "yes" if x.original else ""] +
+                        map(lambda v: "%g" % v if v is not None else "None",
+                            [x.traffic, x.ws_bytes, x.inner_ws_bytes, x.time])) + '\n')
+  out.flush()
+
+def run_fusion(args, out = sys.stdout):
+  """Writes a tab-separated table of the fusion candidates, best first."""
+  from run_model import load_numeric_analysis
+
+  (sa, model_kw_args) = load_numeric_analysis(args)
+
+  out.write('\t'.join(["function", "loops", "traffic_before", "traffic_after", "savings",
+                       "ws_bytes", "time_before", "time_after"]) + '\n')
+  for x in fusionCandidates(sa, **model_kw_args):
+    out.write('\t'.join([x.function, '+'.join(map(str, x.loops))] +
+                        map(lambda v: "%g" % v if v is not None else "None",
+                            [x.traffic_before, x.traffic_after, x.savings(), x.ws_bytes,
+                             x.time_before, x.time_after])) + '\n')
+  out.flush()
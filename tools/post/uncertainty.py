@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+""" Monte Carlo uncertainty analysis over the branch probabilities in conds.xml.
+
+    The probability of each conditional is drawn from a user-given
+    distribution.  Instead of re-running the analysis for every sample, the
+    conditionals checker returns a numpy vector holding all samples.  The
+    probabilities only enter the flop and traffic counts linearly (as
+    products along the code tree), so a single pass over the code yields
+    the results for all samples at once.
+
+    Distributions are given in an XML file with the same layout as
+    conds.xml, e.g.
+      <conds>
+      <prop key="present(courno)" val="beta(8,2)" />
+      </conds>
+    where val is one of
+      p                      fixed probability
+      uniform(lo,hi)
+      triangular(lo,mode,hi)
+      beta(a,b)
+      normal(mean,sd)        clipped to [0,1]
+    Conditionals without a distribution keep their conds.xml probability.
+
+    Requires numpy.
+"""
+__author__ = "Cy Chan"
+__copyright__ = "Copyright 2016, The Regents of the University of California, through Lawrence Berkeley National Laboratory"
+__credits__ = ["Cy Chan"]
+__license__ = "Modified BSD License (see LICENSE file)"
+__version__ = "2.0"
+__maintainer__ = "Cy Chan"
+__email__ = "cychan@lbl.gov"
+__status__ = "Production"
+
+import sys
+import re
+
+from analyze import TableCondsChecker
+from parser import KeyValXMLParser
+from common import options
+
+# name -> number of arguments
+distributions = {
+  "uniform"    : 2,
+  "triangular" : 3,
+  "beta"       : 2,
+  "normal"     : 2,
+}
+
+dist_re = re.compile(r'^\s*([a-z]+)\s*\((.*)\)\s*$')
+
+def parse_distribution(spec):
+  """Returns (name, args) for a distribution spec string, e.g. ('beta', (8.0, 2.0))."""
+  m = dist_re.match(spec)
+  if not m:
+    return ("fixed", (float(spec),))
+  (name, args) = (m.group(1), tuple(map(float, m.group(2).split(','))))
+  if name not in distributions:
+    raise Exception("Unknown distribution '%s' (expected one of %s)" % (name, sorted(distributions.keys())))
+  if len(args) != distributions[name]:
+    raise Exception("Distribution '%s' takes %d arguments, got '%s'" % (name, distributions[name], spec))
+  return (name, args)
+
+def draw(rng, dist, sample_n):
+  (name, args) = dist
+  if name == "fixed":
+    samples = rng.uniform(args[0], args[0], sample_n)
+  elif name == "uniform":
+    samples = rng.uniform(args[0], args[1], sample_n)
+  elif name == "triangular":
+    samples = rng.triangular(args[0], args[1], args[2], sample_n)
+  elif name == "beta":
+    samples = rng.beta(args[0], args[1], sample_n)
+  elif name == "normal":
+    samples = rng.normal(args[0], args[1], sample_n)
+  return samples.clip(0.0, 1.0)
+
+
+class SampledCondsChecker(TableCondsChecker):
+  """Conditionals checker whose probabilities are vectors of samples.
+
+     The table holds a numpy array for each conditional with a distribution
+     and the fixed conds.xml value for the others."""
+  __slots__ = ['dists', 'sample_n', 'seed']
+  def __init__(self, conds_table, dists, sample_n, seed = None):
+    import numpy
+    TableCondsChecker.__init__(self, conds_table)
+    self.dists = dict(dists)
+    self.sample_n = sample_n
+    self.seed = seed
+    rng = numpy.random.RandomState(seed)
+    # draw in sorted order so that a seed always gives the same samples
+    for cond in sorted(self.dists.keys()):
+      self.table[cond] = draw(rng, self.dists[cond], sample_n)
+  def key(self):
+    fixed = filter(lambda (k, v): k not in self.dists, self.table.items())
+    return (options.flag_ignore_conds, frozenset(fixed), frozenset(self.dists.items()),
+            self.sample_n, self.seed)
+
+
+def summarize(x, percentiles):
+  """Mean and percentiles of a vector of samples (or of a constant)."""
+  import numpy
+  x = numpy.asarray(x, dtype=float)
+  return [float(x.mean())] + map(lambda p: float(numpy.percentile(x, p)), percentiles)
+
+def run_monte_carlo(args, dists_file, sample_n, seed = None, percentiles = (5, 50, 95),
+                    out = sys.stdout):
+  """Evaluates the model once with sampled branch probabilities.
+
+     Writes a tab-separated table with the mean and percentiles of each
+     metric per (function, loop), plus a per-function total row."""
+  from run_model import load_numeric_analysis
+
+  (sa, model_kw_args) = load_numeric_analysis(args)
+
+  dists = map(lambda (k, v): (k, parse_distribution(v)), KeyValXMLParser(dists_file).items)
+  model_kw_args["conds_chk"] = SampledCondsChecker(model_kw_args["conds_chk"].table.items(),
+                                                   dists, sample_n, seed)
+
+  metrics = ["adds", "multiplies", "divides", "specials", "traffic_bytes"]
+  stats = ["mean"] + map(lambda p: "p%g" % p, percentiles)
+  out.write('\t'.join(["function", "loop", "metric"] + stats) + '\n')
+  for function in sa.summary(flag_sub_params=True, **model_kw_args):
+    rows = map(lambda x: (str(x["linenum"]), x), function["loops"]) + [("total", function)]
+    for (loop, result) in rows:
+      for metric in metrics:
+        values = summarize(result[metric], percentiles)
+        out.write('\t'.join([function["name"], loop, metric] + map(lambda x: "%g" % x, values)) + '\n')
+  out.flush()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+""" Differential analysis between variants of the same application.
+
+    Several programs (e.g. advance-flat, advance-nomod and advance-noalloc)
+    are evaluated with the same params, block_params, machine and conds,
+    and the top-level loops of each variant are aligned with those of the
+    first one (the base):
+
+      same     the loops have the same structure (bounds, conditionals,
+               flops and array accesses, ignoring line numbers), wherever
+               they are in the two programs
+      renamed  the same structure up to the names of the loop variables,
+               arrays and scalars (e.g. a loop inlined into the caller)
+      line     same function name and line number
+      similar  the array names or the structures overlap by at least
+               half (see similarity), best matches first
+      added / removed   no counterpart in the other program
+
+    For each aligned pair the flops, working set, traffic and time are
+    reported with their delta from the base, plus program totals.
+
+    All variants share one analysis memo, and structurally identical
+    loops are analyzed through one representative, so the loops a variant
+    did not change are evaluated only once.  Results that depend on the
+    whole program (the detected unit stride dimension, array extents and
+    the TLB model) are kept per program (see StaticAnalysis.memoize).
+"""
+__author__ = "Cy Chan"
+__copyright__ = "Copyright 2016, The Regents of the University of California, through Lawrence Berkeley National Laboratory"
+__credits__ = ["Cy Chan"]
+__license__ = "Modified BSD License (see LICENSE file)"
+__version__ = "2.0"
+__maintainer__ = "Cy Chan"
+__email__ = "cychan@lbl.gov"
+__status__ = "Production"
+
+import sys
+import difflib
+
+from analyze import FlopCount, totalBytes
+
+metrics = ["flops", "ws_bytes", "traffic_bytes", "time"]
+
+def conds_signature(conds):
+  return tuple(map(lambda x: (x.condition, x.when), conds))
+
+def body_signature(body, rename):
+  blocks = map(lambda b: (tuple(map(lambda x: getattr(b.flops, x), b.flops.slots)),
+                          conds_signature(b.conds),
+                          tuple(map(lambda x: (rename(x.name), x.type, x.reads, x.writes), b.scalars)),
+                          tuple(map(lambda a: (rename(a.name), a.type,
+                                               tuple(map(lambda x: (tuple(map(str, x.index)),
+                                                                    tuple(map(rename, x.loopvars)),
+                                                                    x.reads, x.writes), a.accesses))),
+                                    b.arrays))),
+               body.codeblocks)
+  calls = map(lambda x: (x.name, tuple(x.args), conds_signature(x.conds)), body.calls)
+  return (tuple(blocks), tuple(map(lambda x: signature(x, rename), body.loops)), tuple(calls))
+
+def signature(loop, rename = lambda x: x):
+  """Structure of a loop nest without line numbers: loops with equal
+     signatures have the same analysis results."""
+  return (rename(loop.loopvar), str(loop.range[0]), str(loop.range[1]), loop.stride,
+          conds_signature(loop.conds), body_signature(loop.body, rename))
+
+def anonymous_signature(loop):
+  """Signature with the loop variables, arrays and scalars renamed in order
+     of appearance, e.g. the same loop in a function and inlined into its
+     caller, where the formal arrays are replaced by the actual ones."""
+  names = {'': ''}
+  return signature(loop, lambda x: names.setdefault(x, '#%d' % len(names)))
+
+def flatten(x):
+  """Innermost tuples of a signature (flops, accesses, ...) in order."""
+  if type(x) != tuple or not any(map(lambda y: type(y) == tuple, x)):
+    return [x]
+  return sum(map(flatten, x), [])
+
+def array_names(loop):
+  """Names of the arrays accessed anywhere in a loop nest."""
+  return reduce(lambda s, x: s | array_names(x), loop.body.loops,
+                frozenset(sum(map(lambda b: map(lambda a: a.name, b.arrays), loop.body.codeblocks), [])))
+
+def jaccard(a, b):
+  return float(len(a & b)) / len(a | b) if a | b else 1.0
+
+def similarity(x, y, threshold = 0.0):
+  """Overlap of the arrays of two VariantLoops, or of their structures
+     regardless of names (the fraction of matching elements of the
+     records in the anonymous signatures), whichever is larger.  Structures
+     are only compared if they could beat threshold and the arrays."""
+  score = jaccard(x.arrays, y.arrays)
+  matcher = difflib.SequenceMatcher(None, x.tokens, y.tokens, autojunk=False)
+  bound = max(score, threshold)
+  if matcher.real_quick_ratio() > bound and matcher.quick_ratio() > bound:
+    score = max(score, matcher.ratio())
+  return score
+
+class VariantLoop(object):
+  """A top-level loop of a variant, with the loop analyzed in its place."""
+  __slots__ = ['function', 'loop', 'signature', 'anonymous', 'tokens', 'arrays', 'shared']
+  def __init__(self, function, loop, shared):
+    self.function = function
+    self.loop = loop
+    self.signature = signature(loop)
+    self.anonymous = anonymous_signature(loop)
+    self.tokens = flatten(self.anonymous)
+    self.arrays = array_names(loop)
+    # first loop seen with this structure, in any variant
+    self.shared = shared.setdefault(self.signature, loop)
+
+def variant_loops(sa, shared):
+  return sum(map(lambda f: map(lambda x: VariantLoop(f.name, x, shared), f.body.loops), sa.functions), [])
+
+def align(base, loops, threshold = 0.5):
+  """Pairs the VariantLoops of a variant with those of the base.
+
+     Returns a list of (base index or None, index or None, match kind)."""
+  pairs = []
+  (used_base, used) = (set(), set())
+  def pair(i, j, kind):
+    pairs.append((i, j, kind))
+    used_base.add(i)
+    used.add(j)
+  # identical structure (up to names), preferring the same function
+  for (kind, key) in [('same', lambda x: x.signature), ('renamed', lambda x: x.anonymous)]:
+    for (i, x) in enumerate(base):
+      if i in used_base:
+        continue
+      candidates = filter(lambda j: j not in used and key(loops[j]) == key(x), range(len(loops)))
+      if candidates:
+        same = filter(lambda j: loops[j].function == x.function, candidates)
+        pair(i, (same or candidates)[0], kind)
+  # same place in the same function
+  for (i, x) in enumerate(base):
+    if i in used_base:
+      continue
+    candidates = filter(lambda j: j not in used and loops[j].function == x.function and
+                                  loops[j].loop.linenum == x.loop.linenum, range(len(loops)))
+    if candidates:
+      pair(i, candidates[0], 'line')
+  # most similar first, then closest in program order
+  scores = []
+  for (i, x) in enumerate(base):
+    for (j, y) in enumerate(loops):
+      if i not in used_base and j not in used:
+        score = similarity(x, y, threshold)
+        if score >= threshold:
+          scores.append((-score, abs(i - j), i, j))
+  for (score, distance, i, j) in sorted(scores):
+    if i not in used_base and j not in used:
+      pair(i, j, 'similar')
+  pairs.extend(map(lambda i: (i, None, 'removed'), filter(lambda i: i not in used_base, range(len(base)))))
+  pairs.extend(map(lambda j: (None, j, 'added'), filter(lambda j: j not in used, range(len(loops)))))
+  # base order, with added loops after the pair preceding them in the variant
+  def order((i, j, kind)):
+    if i is not None:
+      return (i, 0, j)
+    preceding = filter(lambda (i2, j2, k): j2 is not None and j2 < j and i2 is not None, pairs)
+    return (max(map(lambda x: x[0], preceding)) if preceding else -1, 1, j)
+  return sorted(pairs, key=order)
+
+def evaluate(sa, x, params, block_params, machine, conds_chk):
+  """{metric: value} of a VariantLoop, analyzed through its shared representative."""
+  colls = sa.collectLoop(x.shared, params, block_params, machine, conds_chk, True, ['flops', 'ws', 'traffic'])
+  flops = FlopCount.total(colls['flops'])
+  return {
+    'flops'         : flops.adds + flops.multiplies + flops.divides + flops.specials,
+    'ws_bytes'      : totalBytes(colls['ws']),
+    'traffic_bytes' : sum(map(lambda x: x.bytes(), colls['traffic'])),
+    'time'          : sa.execTime(x.shared, params, block_params, machine, conds_chk, True).time(),
+  }
+
+def totals(results):
+  """Program totals: loops run one after the other, the largest working set is the program's."""
+  return {
+    'flops'         : sum(map(lambda x: x['flops'], results)),
+    'ws_bytes'      : max([0] + map(lambda x: x['ws_bytes'], results)),
+    'traffic_bytes' : sum(map(lambda x: x['traffic_bytes'], results)),
+    'time'          : sum(map(lambda x: x['time'] or 0, results)),
+  }
+
+def run_diff(args, xmls, out = sys.stdout):
+  """Writes a tab-separated table comparing each program in xmls (each a
+     comma-separated list of files, like the xml arg) with the program of
+     args: a row per aligned loop pair and metric with the base and variant
+     values, their difference and ratio, and the program totals."""
+  from run_model import load_numeric_analyses
+
+  (programs, model_kw_args) = load_numeric_analyses(args, [args["xml"]] + xmls)
+
+  shared = {}
+  loops = map(lambda sa: variant_loops(sa, shared), programs)
+  results = map(lambda (sa, xs): map(lambda x: evaluate(sa, x, **model_kw_args), xs), zip(programs, loops))
+
+  out.write('\t'.join(["variant", "base_function", "base_loop", "function", "loop", "match", "metric",
+                       "base", "value", "delta", "ratio"]) + '\n')
+  fmt = lambda v: "%g" % v if v is not None else "None"
+  def write(xml, base_place, place, kind, base_values, values):
+    for metric in metrics:
+      (b, v) = (base_values[metric] if base_values else 0, values[metric] if values else 0)
+      out.write('\t'.join([xml] + base_place + place + [kind, metric] +
+                          map(fmt, [b, v, v - b if None not in [b, v] else None,
+                                    float(v) / b if b and v is not None else None])) + '\n')
+  for (xml, xs, rs) in zip(xmls, loops[1:], results[1:]):
+    for (i, j, kind) in align(loops[0], xs):
+      place = lambda ys, k: [ys[k].function, str(ys[k].loop.linenum)] if k is not None else ["-", "-"]
+      write(xml, place(loops[0], i), place(xs, j), kind,
+            results[0][i] if i is not None else None, rs[j] if j is not None else None)
+    write(xml, ["total", "total"], ["total", "total"], "program", totals(results[0]), totals(rs))
+  out.flush()